@@ -0,0 +1,189 @@
+"""
+向量索引类型
+
+flat 为精确的暴力检索；ivf_flat / ivf_pq / hnsw 为近似最近邻索引，数据量大时检索更快。
+所有类型都以表主键为向量ID，支持按ID写入；除 hnsw 外都支持按ID删除。
+"""
+import os
+import math
+from typing import Dict, Any, Optional
+
+import faiss
+import numpy as np
+
+# auto 时按表的记录数自动选择
+VECTOR_INDEX_TYPE = os.getenv("VECTOR_INDEX_TYPE", "auto")
+# auto 模式下记录数达到该值改用 ivf_flat
+VECTOR_INDEX_IVF_THRESHOLD = int(os.getenv("VECTOR_INDEX_IVF_THRESHOLD", 20000))
+# auto 模式下记录数达到该值改用 ivf_pq
+VECTOR_INDEX_PQ_THRESHOLD = int(os.getenv("VECTOR_INDEX_PQ_THRESHOLD", 500000))
+# IVF 检索时访问的聚类数
+VECTOR_INDEX_NPROBE = int(os.getenv("VECTOR_INDEX_NPROBE", 16))
+# HNSW 检索时的候选队列长度
+VECTOR_INDEX_EF_SEARCH = int(os.getenv("VECTOR_INDEX_EF_SEARCH", 128))
+# HNSW 每个节点的连接数
+VECTOR_INDEX_HNSW_M = int(os.getenv("VECTOR_INDEX_HNSW_M", 32))
+# HNSW 构建时的候选队列长度
+VECTOR_INDEX_EF_CONSTRUCTION = int(os.getenv("VECTOR_INDEX_EF_CONSTRUCTION", 200))
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+# 每个聚类用于训练的样本数
+_TRAIN_POINTS_PER_LIST = 64
+
+
+def choose_index_type(n: int, index_type: str = VECTOR_INDEX_TYPE) -> str:
+    """根据配置和记录数确定索引类型"""
+    if index_type != "auto":
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"不支持的向量索引类型: {index_type}")
+        return index_type
+    if n >= VECTOR_INDEX_PQ_THRESHOLD:
+        return "ivf_pq"
+    if n >= VECTOR_INDEX_IVF_THRESHOLD:
+        return "ivf_flat"
+    return "flat"
+
+
+def default_params(index_type: str, n: int, dim: int) -> Dict[str, Any]:
+    """索引的构建和检索参数，随元数据一起保存"""
+    params: Dict[str, Any] = {"type": index_type, "dim": dim}
+    if index_type in ("ivf_flat", "ivf_pq"):
+        # 聚类数取 4*sqrt(n)，并保证每个聚类有足够的训练样本
+        nlist = int(4 * math.sqrt(max(n, 1)))
+        params["nlist"] = max(1, min(nlist, n // _TRAIN_POINTS_PER_LIST or 1))
+        params["nprobe"] = VECTOR_INDEX_NPROBE
+        if index_type == "ivf_pq":
+            # 每 8 维一个子量化器，需整除维度
+            m = dim // 8
+            while m > 1 and dim % m:
+                m -= 1
+            params["pq_m"] = m
+    elif index_type == "hnsw":
+        params["hnsw_m"] = VECTOR_INDEX_HNSW_M
+        params["ef_search"] = VECTOR_INDEX_EF_SEARCH
+    return params
+
+
+def create_index(params: Dict[str, Any], train_vectors: Optional[np.ndarray] = None) -> faiss.Index:
+    """按参数创建空索引；IVF 类索引用 train_vectors 的抽样进行训练"""
+    index_type, dim = params["type"], params["dim"]
+    if index_type == "flat":
+        index = faiss.index_factory(dim, "IDMap2,Flat", faiss.METRIC_INNER_PRODUCT)
+    elif index_type == "hnsw":
+        index = faiss.index_factory(dim, f"IDMap2,HNSW{params['hnsw_m']},Flat", faiss.METRIC_INNER_PRODUCT)
+        faiss.downcast_index(index.index).hnsw.efConstruction = VECTOR_INDEX_EF_CONSTRUCTION
+    elif index_type == "ivf_flat":
+        index = faiss.index_factory(dim, f"IVF{params['nlist']},Flat", faiss.METRIC_INNER_PRODUCT)
+    elif index_type == "ivf_pq":
+        index = faiss.index_factory(dim, f"IVF{params['nlist']},PQ{params['pq_m']}", faiss.METRIC_INNER_PRODUCT)
+        # 检索不使用多义编码（polysemous），关闭其训练；开启时训练耗时增加约百倍
+        faiss.downcast_index(faiss.extract_index_ivf(index)).do_polysemous_training = False
+    else:
+        raise ValueError(f"不支持的向量索引类型: {index_type}")
+
+    if not index.is_trained:
+        if train_vectors is None or len(train_vectors) < params.get("nlist", 1):
+            raise ValueError(f"{index_type} 索引需要至少 {params.get('nlist', 1)} 条训练样本")
+        sample_size = min(len(train_vectors), params["nlist"] * _TRAIN_POINTS_PER_LIST)
+        rng = np.random.default_rng(0)
+        sample = train_vectors[rng.choice(len(train_vectors), sample_size, replace=False)]
+        index.train(np.ascontiguousarray(sample, dtype=np.float32))
+
+    configure(index, params)
+    return index
+
+
+def build_index(embeddings: np.ndarray, ids: np.ndarray, index_type: Optional[str] = None) -> faiss.Index:
+    """用已归一化的向量构建索引，index_type 为空时按向量数量选择"""
+    index_type = index_type or choose_index_type(len(ids))
+    params = default_params(index_type, len(ids), embeddings.shape[1])
+    index = create_index(params, embeddings)
+    index.add_with_ids(np.ascontiguousarray(embeddings, dtype=np.float32), np.asarray(ids, dtype=np.int64))
+    return index
+
+
+def read_index(path: str, mmap: bool = False) -> faiss.Index:
+    """
+    读取索引文件；mmap=True 时以只读内存映射方式打开，IVF 的倒排表（以及 faiss 支持时 flat / HNSW 的向量数据）
+    直接映射索引文件，多个进程共享同一份页缓存，打开几乎不耗时。映射打开的索引不能再写入
+    """
+    if not mmap:
+        return faiss.read_index(path)
+    ifc = getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+    if ifc:
+        try:
+            # flat / HNSW 的向量数据；IVF 索引不支持与倒排表映射同时使用，改用下面的方式
+            return faiss.read_index(path, faiss.IO_FLAG_MMAP | ifc | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            pass
+    return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+
+
+def index_type_of(index: faiss.Index) -> str:
+    """根据索引对象判断其类型"""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return "ivf_pq" if isinstance(faiss.downcast_index(ivf), faiss.IndexIVFPQ) else "ivf_flat"
+    inner = faiss.downcast_index(index.index) if hasattr(index, "id_map") else index
+    return "hnsw" if isinstance(inner, faiss.IndexHNSW) else "flat"
+
+
+def params_of(index: faiss.Index) -> Dict[str, Any]:
+    """读取索引当前的类型和检索参数，保存到元数据中"""
+    index_type = index_type_of(index)
+    params: Dict[str, Any] = {"type": index_type, "dim": index.d}
+    if index_type in ("ivf_flat", "ivf_pq"):
+        ivf = faiss.downcast_index(faiss.extract_index_ivf(index))
+        params["nlist"] = ivf.nlist
+        params["nprobe"] = ivf.nprobe
+        if index_type == "ivf_pq":
+            params["pq_m"] = ivf.pq.M
+    elif index_type == "hnsw":
+        hnsw = faiss.downcast_index(index.index).hnsw
+        params["ef_search"] = hnsw.efSearch
+    return params
+
+
+def configure(index: faiss.Index, params: Dict[str, Any]):
+    """设置检索参数；IVF 索引启用哈希直接映射，以支持按ID删除和取回向量"""
+    index_type = index_type_of(index)
+    if index_type in ("ivf_flat", "ivf_pq"):
+        ivf = faiss.extract_index_ivf(index)
+        if ivf.direct_map.type != faiss.DirectMap.Hashtable:
+            ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+        ivf.nprobe = int(params.get("nprobe", VECTOR_INDEX_NPROBE))
+    elif index_type == "hnsw":
+        hnsw = faiss.downcast_index(index.index)
+        hnsw.hnsw.efSearch = int(params.get("ef_search", VECTOR_INDEX_EF_SEARCH))
+
+
+def supports_remove(index: faiss.Index) -> bool:
+    """HNSW 不支持删除向量，更新时旧向量会残留到下次重建"""
+    return index_type_of(index) != "hnsw"
+
+
+def stores_exact_vectors(index: faiss.Index) -> bool:
+    """flat / ivf_flat / hnsw 保存原始向量，reconstruct 取回的即原向量；ivf_pq 只保存量化编码，取回的是近似值"""
+    return index_type_of(index) != "ivf_pq"
+
+
+def index_ids(index: faiss.Index) -> np.ndarray:
+    """索引中全部向量的ID"""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is None:
+        return faiss.vector_to_array(index.id_map)
+    invlists = ivf.invlists
+    ids = [faiss.rev_swig_ptr(invlists.get_ids(i), invlists.list_size(i)).copy()
+           for i in range(ivf.nlist) if invlists.list_size(i)]
+    return np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64)
+
+
+def upgrade_needed(index: faiss.Index, n: int) -> bool:
+    """auto 模式下表的记录数增长到应使用更大规模的索引类型时返回 True（不会自动降级）"""
+    if VECTOR_INDEX_TYPE != "auto":
+        return False
+    current = index_type_of(index)
+    if current not in ("flat", "ivf_flat", "ivf_pq"):
+        return False
+    order = ("flat", "ivf_flat", "ivf_pq")
+    return order.index(choose_index_type(n)) > order.index(current)
@@ -7,7 +7,8 @@ from typing import Dict, Any
 from dotenv import load_dotenv
 from db_client import DBClient
 from llm_client import LLMClient
-from duplicate_checker import DuplicateChecker
+from duplicate_checker import DuplicateChecker, BATCH_MAX_TARGETS
+from single_flight import SingleFlight
 import hmac
 import hashlib
 
@@ -24,6 +25,8 @@ db = DBClient(
 )
 llm = LLMClient()
 checker = DuplicateChecker(db, llm)
+# 相同 (类型, ID, 索引代数) 的并发查重请求只计算一次，同一主机的各 worker 之间也会合并
+flights = SingleFlight()
 
 app = FastAPI(title="Demand Duplicate Checker API")
 
@@ -35,6 +38,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+@app.on_event("shutdown")
+async def close_llm_client():
+    """关闭 LLM 客户端的连接池"""
+    if hasattr(llm, "close"):
+        await llm.close()
+
+
+@app.on_event("shutdown")
+async def close_checker():
+    """停止查重线程池"""
+    checker.close()
+
 # -------------------------------
 # 验签：获取 secret key
 # -------------------------------
@@ -93,10 +109,41 @@ async def handle_duplications(request: Request):
             if not record_id or not record_type:
                 raise HTTPException(status_code=400, detail="Missing id or type in bizContent")
 
-            result = checker.check_duplicates(record_id, record_type)
+            # 候选的 LLM 比对并发进行，等待期间不阻塞其他请求
+            key = (record_type, str(record_id), checker.index_generation())
+            result = await flights.run(key, lambda: checker.check_duplicates_async(record_id, record_type))
+            # 结果可能与其他请求共享，复制后再修改
+            result = dict(result)
             result["bizType"] = biz_type
             return result
         except Exception as e:
             return {"code": 500, "msg": str(e), "bizType": biz_type, "bizContent": {}}
+    elif biz_type == "demandDuplicationBatch":
+        try:
+            targets = biz_content.get("targets")
+            if not isinstance(targets, list) or not targets:
+                raise HTTPException(status_code=400, detail="Missing targets in bizContent")
+            if len(targets) > BATCH_MAX_TARGETS:
+                raise HTTPException(status_code=400, detail=f"Too many targets (max {BATCH_MAX_TARGETS})")
+            if any(not isinstance(t, dict) or not t.get("id") or not t.get("type") for t in targets):
+                raise HTTPException(status_code=400, detail="Missing id or type in bizContent.targets")
+
+            # 整批一次读取、向量化和检索，LLM 比对共享并发数
+            pairs = [(t["id"], t["type"]) for t in targets]
+            results = await checker.check_duplicates_batch_async(pairs)
+            items = []
+            for (record_id, record_type), result in zip(pairs, results):
+                items.append({"id": record_id, "type": record_type, "code": result["code"], "msg": result["msg"],
+                              "similarDemands": result.get("bizContent", {}).get("similarDemands", [])})
+            return {"code": 100, "msg": "success", "bizType": biz_type, "bizContent": {"results": items}}
+        except Exception as e:
+            return {"code": 500, "msg": str(e), "bizType": biz_type, "bizContent": {}}
+    elif biz_type == "vectorIndexRefresh":
+        # 触发后台索引刷新，立即返回，不等待刷新完成
+        if checker.refresher is None:
+            return {"code": 400, "msg": "Vector index is not available", "bizType": biz_type, "bizContent": {}}
+        checker.refresher.trigger()
+        return {"code": 100, "msg": "success", "bizType": biz_type,
+                "bizContent": {"generation": checker.refresher.generation}}
     else:
         return {"code": 400, "msg": f"Unsupported bizType: {biz_type}", "bizType": biz_type, "bizContent": {}}
\ No newline at end of file
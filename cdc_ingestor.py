@@ -0,0 +1,262 @@
+"""
+CDC（变更数据捕获）增量同步
+
+订阅 MySQL binlog 的行事件（或用于测试的本地回放文件），把插入、更新、删除
+逐行应用到内存中的向量索引上，每条变更只向量化一行，不再全表扫描比对。
+依赖 python-mysql-replication（pip install mysql-replication），
+MySQL 需开启 binlog_format=ROW、binlog_row_image=FULL。
+"""
+import os
+import json
+import time
+import threading
+from typing import Dict, Any, List, Tuple, Optional, Iterator
+
+from db_client import DBClient, TABLE_PK_MAP
+from vector_index_builder import VectorIndexBuilder
+from index_refresher import IndexRefresher, IndexPair
+
+# poll: 后台定时全量比对（默认）；cdc: 订阅行变更逐行更新
+INDEX_SYNC_MODE = os.getenv("INDEX_SYNC_MODE", "poll")
+# 设置后使用本地回放文件代替 binlog
+CDC_REPLAY_FILE = os.getenv("CDC_REPLAY_FILE")
+# binlog 复制客户端的 server_id，同一 MySQL 上必须唯一，多 worker 时按进程号区分
+CDC_SERVER_ID = int(os.getenv("CDC_SERVER_ID", 1000))
+# 内存中的变更落盘间隔（秒）
+CDC_FLUSH_INTERVAL = float(os.getenv("CDC_FLUSH_INTERVAL", 30))
+
+# 一条变更：{"table": 表名, "op": "insert" | "update" | "delete", "row": 整行数据}
+# 位置：可用于断点续传的字典，随索引一起落盘
+Change = Dict[str, Any]
+Position = Dict[str, Any]
+
+
+class BinlogChangeSource:
+    """从 MySQL binlog 读取行事件"""
+
+    def __init__(self, db: DBClient, server_id: int = CDC_SERVER_ID):
+        self.db = db
+        self.server_id = server_id
+
+    def initial_position(self) -> Optional[Position]:
+        pos = self.db.get_binlog_position()
+        if pos is None:
+            return None
+        return {"source": "binlog", **pos}
+
+    def changes(self, position: Optional[Position] = None) -> Iterator[Tuple[Change, Position]]:
+        from pymysqlreplication import BinLogStreamReader
+        from pymysqlreplication.row_event import WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent
+
+        params = self.db.conn_params
+        kwargs = {}
+        if position and position.get("source") == "binlog":
+            kwargs = {"log_file": position["log_file"], "log_pos": position["log_pos"]}
+
+        stream = BinLogStreamReader(
+            connection_settings={
+                "host": params["host"],
+                "port": params["port"],
+                "user": params["user"],
+                "passwd": params["password"],
+            },
+            server_id=self.server_id,
+            only_events=[WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent],
+            only_schemas=[params["db"]],
+            only_tables=list(TABLE_PK_MAP.keys()),
+            resume_stream=True,
+            blocking=True,
+            **kwargs
+        )
+        try:
+            for event in stream:
+                pos = {"source": "binlog", "log_file": stream.log_file, "log_pos": stream.log_pos}
+                for row in event.rows:
+                    if isinstance(event, WriteRowsEvent):
+                        yield {"table": event.table, "op": "insert", "row": row["values"]}, pos
+                    elif isinstance(event, UpdateRowsEvent):
+                        yield {"table": event.table, "op": "update", "row": row["after_values"]}, pos
+                    elif isinstance(event, DeleteRowsEvent):
+                        yield {"table": event.table, "op": "delete", "row": row["values"]}, pos
+        finally:
+            stream.close()
+
+
+class ReplayFileChangeSource:
+    """
+    从本地 JSON Lines 回放文件读取变更，用于测试时替代 binlog
+    每行格式：{"table": "demandProposal", "op": "update", "row": {"idDemandProposal": 1, ...}}
+    """
+
+    def __init__(self, path: str, follow: bool = True, poll_interval: float = 1.0):
+        self.path = path
+        self.follow = follow
+        self.poll_interval = poll_interval
+
+    def initial_position(self) -> Optional[Position]:
+        return {"source": "replay", "path": self.path, "offset": 0}
+
+    def changes(self, position: Optional[Position] = None) -> Iterator[Tuple[Change, Position]]:
+        offset = 0
+        if position and position.get("source") == "replay" and position.get("path") == self.path:
+            offset = position["offset"]
+
+        while not os.path.exists(self.path):
+            if not self.follow:
+                return
+            time.sleep(self.poll_interval)
+
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            while True:
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    # 文件末尾或尚未写完的一行：回到行首等待追加
+                    if not self.follow:
+                        return
+                    f.seek(offset)
+                    time.sleep(self.poll_interval)
+                    continue
+                offset = f.tell()
+                if not line.strip():
+                    continue
+                change = json.loads(line.decode("utf-8"))
+                yield change, {"source": "replay", "path": self.path, "offset": offset}
+
+
+def create_change_source(db: DBClient):
+    """根据环境变量选择变更来源"""
+    if CDC_REPLAY_FILE:
+        return ReplayFileChangeSource(CDC_REPLAY_FILE)
+    return BinlogChangeSource(db.clone(), server_id=CDC_SERVER_ID + os.getpid() % 10000)
+
+
+class CDCIngestor:
+    """
+    消费变更流并逐行应用到 IndexRefresher 发布的索引上
+
+    应用变更时持有 refresher.index_lock，检索通过 refresher.read_lock() 与之互斥；已应用的变更按 CDC_FLUSH_INTERVAL
+    定期落盘，落盘成功后再保存消费位置，重启后从该位置继续（重复应用是幂等的）。
+    """
+
+    def __init__(self, builder: VectorIndexBuilder, refresher: IndexRefresher, source,
+                 flush_interval: float = CDC_FLUSH_INTERVAL):
+        self.builder = builder
+        self.refresher = refresher
+        self.source = source
+        self.flush_interval = flush_interval
+        self.position_file = os.path.join(builder.index_dir, "cdc_position.json")
+        self._position: Optional[Position] = None
+        self._dirty: set = set()
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def prepare(self):
+        """
+        确定起始消费位置，需在 refresher.start() 之前调用：
+        没有断点时先记下当前位置，全量对齐期间发生的变更随后会被重放
+        """
+        self._position = self._load_position()
+        if self._position is None:
+            self._position = self.source.initial_position()
+        print(f"CDC 起始位置: {self._position}")
+
+    def start(self):
+        for target, name in ((self._consume, "cdc-consumer"), (self._flush_loop, "cdc-flusher")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+    def _consume(self):
+        while not self._stop.is_set():
+            try:
+                for change, position in self.source.changes(self._position):
+                    self.apply_change(change, position)
+                    if self._stop.is_set():
+                        return
+                return  # 非跟随模式的回放文件已读完
+            except Exception as e:
+                print(f"CDC 读取变更失败: {e}，稍后重试")
+                self._stop.wait(5)
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"CDC 落盘失败: {e}")
+
+    def apply_change(self, change: Change, position: Optional[Position] = None):
+        """把一条行变更应用到当前索引；不涉及索引的变更（其他表、删除没有索引的表中的行）只推进消费位置"""
+        table = change.get("table")
+
+        def _apply(snapshot: Dict[str, IndexPair]) -> Optional[Dict[str, IndexPair]]:
+            replaced = None
+            if table in TABLE_PK_MAP:
+                replaced = self._apply_row(snapshot, table, change)
+            if position is not None:
+                self._position = position
+            return replaced
+
+        self.refresher.apply(_apply)
+
+    def _apply_row(self, snapshot: Dict[str, IndexPair], table: str, change: Change) -> Optional[Dict[str, IndexPair]]:
+        pk = TABLE_PK_MAP[table]
+        replaced = None
+        index, records = snapshot.get(table, (None, {}))
+        if index is None:
+            if change["op"] == "delete":
+                return None
+            # 该表此前没有索引，创建新索引并整体发布
+            index, records = self.builder.new_index(), {}
+            replaced = {table: (index, records)}
+
+        if change["op"] == "delete":
+            changed = self.builder.delete_record(table, records, change["row"][pk])
+        else:
+            record = self.builder.to_index_record(table, change["row"])
+            changed = self.builder.upsert_record(table, index, records, record)
+
+        if changed:
+            self._dirty.add(table)
+            # 内存中的索引已变化而索引文件代数要到落盘时才变，查重结果缓存键据此失效
+            self.refresher.generation += 1
+        return replaced
+
+    def has_unsaved_changes(self) -> bool:
+        """内存中是否有已应用但尚未落盘的变更"""
+        return bool(self._dirty)
+
+    def flush(self):
+        """把有变更的表落盘，并保存对应的消费位置"""
+        def _flush(snapshot: Dict[str, IndexPair]) -> None:
+            for table in self._dirty:
+                index, records = snapshot.get(table, (None, {}))
+                if index is not None:
+                    self.builder.save_index(table, index, records)
+            self._dirty.clear()
+            self._save_position()
+
+        self.refresher.apply(_flush)
+
+    def _load_position(self) -> Optional[Position]:
+        if not os.path.exists(self.position_file):
+            return None
+        try:
+            with open(self.position_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"读取 CDC 位置失败: {e}")
+            return None
+
+    def _save_position(self):
+        if self._position is None:
+            return
+        tmp_file = f"{self.position_file}.tmp{os.getpid()}"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(self._position, f, ensure_ascii=False)
+        os.replace(tmp_file, self.position_file)
@@ -1,5 +1,8 @@
+import os
+import functools
+import threading
 import pymysql
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple, Set
 
 TABLE_PK_MAP = {
     "demandProposal": "idDemandProposal",
@@ -7,8 +10,29 @@ TABLE_PK_MAP = {
     "demandCollection": "idDemandCollection",
 }
 
+# 增量拉取使用的水位列（如 updateTime），各表需同名；未配置时退化为按自增主键拉取，只能发现新增记录
+WATERMARK_COLUMN = os.getenv("DB_WATERMARK_COLUMN")
+
+
+def get_watermark_column(table: str) -> str:
+    """获取表的水位列，未配置更新时间列时使用主键"""
+    return WATERMARK_COLUMN or TABLE_PK_MAP[table]
+
+
+def _locked(method):
+    """同一连接上的查询串行执行：查重请求在线程池中运行，多个线程会共用同一个客户端"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
 class DBClient:
     def __init__(self, host: str, port: int, user: str, password: str, db: str):
+        # 保存连接参数，便于为后台线程创建独立连接（pymysql 连接不是线程安全的）
+        self.conn_params = dict(host=host, port=port, user=user, password=password, db=db)
+        # pymysql 连接不是线程安全的，可重入锁保证同一时刻只有一个查询使用该连接
+        self._lock = threading.RLock()
         self.conn = pymysql.connect(
             host=host, port=port, user=user, password=password, db=db,
             read_timeout=600,  # <-- 增加这个
@@ -16,7 +40,11 @@ class DBClient:
             autocommit=True  # 开启自动提交，避免长事务旧快照
         )
 
+    def clone(self) -> "DBClient":
+        """使用相同参数创建一个拥有独立连接的新客户端"""
+        return DBClient(**self.conn_params)
 
+    @_locked
     def get_text_columns(self, table: str) -> List[str]:
         """获取某表的 text 类型列"""
         sql = """
@@ -29,6 +57,7 @@ class DBClient:
             cur.execute(sql, (self.conn.db.decode(), table))
             return [row[0] for row in cur.fetchall()]
 
+    @_locked
     def get_record_by_id(self, table: str, record_id: int) -> Dict[str, Any]:
         """根据主键获取一条记录（只取 text 字段）"""
         pk = TABLE_PK_MAP[table]
@@ -41,12 +70,92 @@ class DBClient:
             print("SQL:", sql)
             return cur.fetchone()
 
+    @_locked
+    def get_records_by_ids(self, table: str, record_ids: List[Any]) -> List[Dict[str, Any]]:
+        """根据一组主键一次查询取出多条记录（只取 text 字段），不存在的主键不返回"""
+        if not record_ids:
+            return []
+        pk = TABLE_PK_MAP[table]
+        text_cols = self.get_text_columns(table)
+        cols = ",".join(text_cols)
+        sql = f"SELECT {pk}, {cols} FROM {table} WHERE {pk} IN ({','.join(['%s'] * len(record_ids))})"
+        self.conn.ping(reconnect=True)
+        with self.conn.cursor(pymysql.cursors.DictCursor) as cur:
+            cur.execute(sql, list(record_ids))
+            return cur.fetchall()
+
+    @_locked
     def get_all_records(self, table: str) -> List[Dict[str, Any]]:
         """获取所有记录（只取 text 字段）"""
         pk = TABLE_PK_MAP[table]
         text_cols = self.get_text_columns(table)
         cols = ",".join(text_cols)
         sql = f"SELECT {pk}, {cols} FROM {table}"
+        self.conn.ping(reconnect=True)  # 后台刷新线程的连接可能长时间空闲
         with self.conn.cursor(pymysql.cursors.DictCursor) as cur:
             cur.execute(sql)
             return cur.fetchall()
+
+    @_locked
+    def get_max_watermark(self, table: str) -> Any:
+        """获取表当前的最大水位值，表为空时返回 None"""
+        wcol = get_watermark_column(table)
+        sql = f"SELECT MAX({wcol}) FROM {table}"
+        self.conn.ping(reconnect=True)
+        with self.conn.cursor() as cur:
+            cur.execute(sql)
+            return cur.fetchone()[0]
+
+    @_locked
+    def get_records_since(self, table: str, watermark: Any) -> Tuple[List[Dict[str, Any]], Any, Set[str]]:
+        """
+        获取水位之后变更的记录（只取 text 字段），返回 (记录列表, 新水位, 处于新水位上的记录主键)
+
+        按更新时间列拉取时使用 >=，避免漏掉与上次水位同一时刻更新的记录（重复拉取由调用方去重）；
+        按主键拉取时使用 >。
+        """
+        pk = TABLE_PK_MAP[table]
+        wcol = get_watermark_column(table)
+        text_cols = self.get_text_columns(table)
+        cols = ",".join(text_cols)
+        op = ">" if wcol == pk else ">="
+        sql = f"SELECT {pk}, {cols}, {wcol} AS __watermark__ FROM {table} WHERE {wcol} {op} %s ORDER BY {wcol}"
+        self.conn.ping(reconnect=True)
+        with self.conn.cursor(pymysql.cursors.DictCursor) as cur:
+            cur.execute(sql, (watermark,))
+            rows = cur.fetchall()
+
+        new_watermark = watermark
+        boundary_pks: Set[str] = set()
+        for row in rows:
+            row_watermark = row.pop("__watermark__")
+            if row_watermark != new_watermark:
+                new_watermark = row_watermark
+                boundary_pks = set()
+            boundary_pks.add(str(row[pk]))
+        return list(rows), new_watermark, boundary_pks
+
+    @_locked
+    def get_all_pks(self, table: str) -> Set[str]:
+        """获取表的全部主键（字符串形式），只走主键索引，用于发现被删除的记录"""
+        pk = TABLE_PK_MAP[table]
+        sql = f"SELECT {pk} FROM {table}"
+        self.conn.ping(reconnect=True)
+        with self.conn.cursor() as cur:
+            cur.execute(sql)
+            return {str(row[0]) for row in cur.fetchall()}
+
+    @_locked
+    def get_binlog_position(self) -> Dict[str, Any] | None:
+        """获取当前 binlog 写入位置，用于 CDC 从该位置开始订阅"""
+        self.conn.ping(reconnect=True)
+        with self.conn.cursor(pymysql.cursors.DictCursor) as cur:
+            try:
+                cur.execute("SHOW MASTER STATUS")
+            except pymysql.err.MySQLError:
+                # MySQL 8.2+ 将该语句更名为 SHOW BINARY LOG STATUS
+                cur.execute("SHOW BINARY LOG STATUS")
+            row = cur.fetchone()
+        if not row:
+            return None  # 未开启 binlog
+        return {"log_file": row["File"], "log_pos": int(row["Position"])}
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+离线全表查重：找出一个表内所有互相重复的记录对，并按重复关系聚成簇
+
+不逐条调用接口，而是对整表向量做一次 FAISS 自连接：
+    1. 读取已落盘的索引和记录（先运行 python vector_index_builder.py 构建），
+       把每条记录的向量按主键顺序写入工作目录下的内存映射文件：
+       flat / hnsw / ivf_flat 索引中存的是原始向量，直接取出；ivf_pq 只存压缩编码，重新向量化（大多命中向量缓存）
+    2. 自连接使用已落盘的索引（--rebuild-index 时按记录数从向量文件分块重建），
+       查询矩阵按 --chunk-size 分块，在 --workers 个线程中并行做 k 近邻检索
+    3. 相似度低于 --min-score 的对直接丢弃；ivf_pq 的得分是近似值，接近阈值的对用原始向量重新计算后再判断
+    4. 去重后的记录对写入 CSV（按得分降序），用并查集合并成的重复簇写入 JSONL（按簇大小降序）
+
+内存只与索引大小、分块大小和保留下来的记录对数有关，全部向量留在内存映射文件中，
+单机可处理百万条记录。
+
+用法：
+    python dedup_job.py --table demandProposal --min-score 92 --k 10
+"""
+import os
+import csv
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+import faiss
+import numpy as np
+from dotenv import load_dotenv
+
+import ann_index
+from db_client import TABLE_PK_MAP
+from vector_index_builder import VectorIndexBuilder, Records
+
+# 相似度（0~100）不低于该值的记录对视为重复
+DEDUP_MIN_SCORE = float(os.getenv("DEDUP_MIN_SCORE", 92))
+# 每条记录检索的近邻数
+DEDUP_TOP_K = int(os.getenv("DEDUP_TOP_K", 10))
+# 每块查询的记录数
+DEDUP_CHUNK_SIZE = int(os.getenv("DEDUP_CHUNK_SIZE", 4096))
+# ivf_pq 近似得分不低于 (阈值 - 该值) 的对用原始向量重新计算
+_RESCORE_MARGIN = 10
+
+
+class UnionFind:
+    """按主键合并重复簇的并查集"""
+
+    def __init__(self):
+        self.parent: Dict[int, int] = {}
+
+    def find(self, x: int) -> int:
+        root = self.parent.setdefault(x, x)
+        while root != self.parent[root]:
+            root = self.parent[root]
+        # 路径压缩
+        while x != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, a: int, b: int):
+        ra, rb = self.find(a), self.find(b)
+        if ra != rb:
+            self.parent[max(ra, rb)] = min(ra, rb)
+
+    def clusters(self) -> List[List[int]]:
+        groups: Dict[int, List[int]] = {}
+        for x in self.parent:
+            groups.setdefault(self.find(x), []).append(x)
+        return sorted((sorted(ids) for ids in groups.values()), key=lambda ids: (-len(ids), ids[0]))
+
+
+class DedupJob:
+    def __init__(self, builder: VectorIndexBuilder, table: str, work_dir: str,
+                 min_score: float = DEDUP_MIN_SCORE, k: int = DEDUP_TOP_K,
+                 chunk_size: int = DEDUP_CHUNK_SIZE, workers: int = os.cpu_count() or 1):
+        self.builder = builder
+        self.table = table
+        self.work_dir = work_dir
+        self.min_score = min_score
+        self.k = k
+        self.chunk_size = chunk_size
+        self.workers = max(1, workers)
+        os.makedirs(work_dir, exist_ok=True)
+
+    def run(self, rebuild_index: bool = False) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """执行自连接，返回按得分降序的 (主键A, 主键B, 得分)，主键A < 主键B"""
+        index, records = self.builder.load_index(self.table, mmap=True)
+        # 行号 i 对应主键 ids[i]，主键升序便于用二分查找把近邻主键换成行号
+        ids = np.sort(np.fromiter(records.keys(), dtype=np.int64, count=len(records)))
+        print(f"表 {self.table} 共 {len(ids)} 条记录，索引类型 {ann_index.index_type_of(index)}")
+
+        vectors_file = os.path.join(self.work_dir, f"{self.table}_vectors.f32")
+        try:
+            started = time.perf_counter()
+            vectors, has_text = self._write_vectors(index, records, ids, vectors_file)
+            print(f"向量已写入 {vectors_file}，耗时 {time.perf_counter() - started:.1f} 秒")
+            if rebuild_index or index.d != vectors.shape[1]:
+                index = self._build_join_index(vectors, ids, has_text)
+            started = time.perf_counter()
+            pairs = self._self_join(index, records, vectors, ids, has_text)
+            print(f"自连接完成，耗时 {time.perf_counter() - started:.1f} 秒，得到 {len(pairs[0])} 个重复对")
+            return pairs
+        finally:
+            if os.path.exists(vectors_file):
+                os.remove(vectors_file)
+
+    def _write_vectors(self, index: faiss.Index, records: Records, ids: np.ndarray,
+                       vectors_file: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        按主键顺序把各记录的归一化向量分块写入内存映射文件，返回 (向量, 是否有文本)
+        没有文本的记录向量为全 0，不参与查重
+        """
+        dim = index.d
+        reuse = ann_index.stores_exact_vectors(index)
+        if not reuse:
+            dim = self.builder.model.get_sentence_embedding_dimension()
+        vectors = np.lib.format.open_memmap(vectors_file, mode="w+", dtype=np.float32, shape=(len(ids), dim))
+        has_text = np.zeros(len(ids), dtype=bool)
+        for start in range(0, len(ids), self.chunk_size):
+            chunk_ids = ids[start:start + self.chunk_size]
+            texts = [self.builder.combine_text(self.table, records[int(pk)]) for pk in chunk_ids]
+            mask = np.array([bool(text.strip()) for text in texts], dtype=bool)
+            chunk = np.zeros((len(chunk_ids), dim), dtype=np.float32)
+            if mask.any():
+                if reuse:
+                    chunk[mask] = index.reconstruct_batch(chunk_ids[mask])
+                else:
+                    embeddings = self.builder.model.encode([t for t, m in zip(texts, mask) if m])
+                    faiss.normalize_L2(embeddings)
+                    chunk[mask] = embeddings
+            vectors[start:start + len(chunk_ids)] = chunk
+            has_text[start:start + len(chunk_ids)] = mask
+            print(f"已处理 {min(start + self.chunk_size, len(ids))}/{len(ids)} 条记录的向量")
+        vectors.flush()
+        return np.load(vectors_file, mmap_mode="r"), has_text
+
+    def _build_join_index(self, vectors: np.ndarray, ids: np.ndarray, has_text: np.ndarray) -> faiss.Index:
+        """按记录数选择索引类型，从向量文件分块建索引（IVF 类只用抽样向量训练）"""
+        rows = np.flatnonzero(has_text)
+        params = ann_index.default_params(ann_index.choose_index_type(len(rows)), len(rows), vectors.shape[1])
+        print(f"重建自连接索引（{params['type']}）...")
+        train = None
+        if params["type"] in ("ivf_flat", "ivf_pq"):
+            sample_size = min(len(rows), params["nlist"] * 64)
+            sample = np.sort(np.random.default_rng(0).choice(rows, sample_size, replace=False))
+            train = np.ascontiguousarray(vectors[sample])
+        index = ann_index.create_index(params, train)
+        for start in range(0, len(rows), self.chunk_size):
+            chunk_rows = rows[start:start + self.chunk_size]
+            index.add_with_ids(np.ascontiguousarray(vectors[chunk_rows]), ids[chunk_rows])
+        return index
+
+    def _self_join(self, index: faiss.Index, records: Records, vectors: np.ndarray, ids: np.ndarray,
+                   has_text: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """分块并行 k 近邻检索，按阈值剪枝并去重"""
+        # 多取目标自身和已删除但未压缩的向量，保证过滤后仍有 k 个近邻
+        fetch = min(self.k + 1 + VectorIndexBuilder.orphan_count(index, records), index.ntotal)
+        rescore = ann_index.index_type_of(index) == "ivf_pq"
+        # 多个线程同时检索时，每个线程内 faiss 使用的 OpenMP 线程数
+        faiss.omp_set_num_threads(max(1, (os.cpu_count() or 1) // self.workers))
+
+        def _search_chunk(start: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+            rows = np.arange(start, min(start + self.chunk_size, len(ids)))
+            rows = rows[has_text[rows]]
+            if not len(rows):
+                return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, np.float32)
+            query = np.ascontiguousarray(vectors[rows])
+            scores, neighbors = index.search(query, fetch)
+            scores *= 100
+
+            # 近邻主键换成行号；-1、已删除和没有文本的记录以及目标自身都丢弃
+            neighbor_rows = np.minimum(np.searchsorted(ids, neighbors), len(ids) - 1)
+            floor = self.min_score - _RESCORE_MARGIN if rescore else self.min_score
+            keep = ((neighbors >= 0) & (ids[neighbor_rows] == neighbors) & has_text[neighbor_rows]
+                    & (neighbor_rows != rows[:, None]) & (scores >= floor))
+            query_at, rank = np.nonzero(keep)
+            a, b, score = rows[query_at], neighbor_rows[query_at, rank], scores[query_at, rank]
+            if rescore and len(a):
+                # 近似得分只用于筛选，按原始向量重新计算
+                score = np.einsum("ij,ij->i", query[query_at], vectors[b]) * 100
+                selected = score >= self.min_score
+                a, b, score = a[selected], b[selected], score[selected]
+            return np.minimum(a, b), np.maximum(a, b), score.astype(np.float32)
+
+        parts = []
+        starts = range(0, len(ids), self.chunk_size)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for i, part in enumerate(executor.map(_search_chunk, starts), 1):
+                parts.append(part)
+                if i % 10 == 0 or i == len(starts):
+                    print(f"已检索 {i}/{len(starts)} 块，累计 {sum(len(p[0]) for p in parts)} 个候选对")
+
+        if not parts:
+            return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, np.float32)
+        a, b, score = (np.concatenate(column) for column in zip(*parts))
+        # 同一对记录可能从两端各被检索到一次，保留得分较高的一个
+        order = np.lexsort((-score, b, a))
+        a, b, score = a[order], b[order], score[order]
+        first = np.ones(len(a), dtype=bool)
+        first[1:] = (a[1:] != a[:-1]) | (b[1:] != b[:-1])
+        a, b, score = a[first], b[first], score[first]
+        order = np.argsort(-score, kind="stable")
+        return ids[a[order]], ids[b[order]], score[order]
+
+
+def write_pairs(path: str, pairs: Tuple[np.ndarray, np.ndarray, np.ndarray]):
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id_a", "id_b", "score"])
+        for a, b, score in zip(*(column.tolist() for column in pairs)):
+            writer.writerow([a, b, round(score, 2)])
+
+
+def write_clusters(path: str, pairs: Tuple[np.ndarray, np.ndarray, np.ndarray]) -> int:
+    """用并查集把重复对合并成簇，每行一个簇；返回簇数"""
+    uf = UnionFind()
+    for a, b in zip(pairs[0].tolist(), pairs[1].tolist()):
+        uf.union(a, b)
+    clusters = uf.clusters()
+    with open(path, "w", encoding="utf-8") as f:
+        for cluster_id, members in enumerate(clusters):
+            f.write(json.dumps({"cluster": cluster_id, "size": len(members), "ids": members}) + "\n")
+    return len(clusters)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线全表查重：FAISS 自连接找出表内全部重复记录对和重复簇")
+    parser.add_argument("--table", choices=list(TABLE_PK_MAP.keys()), default="demandProposal", help="查重的表")
+    parser.add_argument("--min-score", type=float, default=DEDUP_MIN_SCORE, help="视为重复的最低相似度（0~100）")
+    parser.add_argument("--k", type=int, default=DEDUP_TOP_K, help="每条记录检索的近邻数")
+    parser.add_argument("--chunk-size", type=int, default=DEDUP_CHUNK_SIZE, help="每块查询的记录数")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="并行检索的线程数")
+    parser.add_argument("--rebuild-index", action="store_true",
+                        help="不使用已落盘的索引，按记录数从向量文件重建自连接索引")
+    parser.add_argument("--output-dir", default=os.path.join("vector_indexes", "dedup"),
+                        help="结果文件和临时向量文件所在目录")
+    args = parser.parse_args()
+
+    load_dotenv()
+    # 只读取已落盘的索引和记录，不需要数据库连接
+    builder = VectorIndexBuilder(None)
+    if not os.path.exists(os.path.join(builder.index_dir, f"{args.table}_index.faiss")) \
+            or not os.path.exists(builder.records_file(args.table)):
+        print(f"表 {args.table} 的索引文件不存在，请先运行 python vector_index_builder.py 构建索引")
+        return
+
+    job = DedupJob(builder, args.table, args.output_dir, min_score=args.min_score, k=args.k,
+                   chunk_size=args.chunk_size, workers=args.workers)
+    pairs = job.run(rebuild_index=args.rebuild_index)
+
+    pairs_file = os.path.join(args.output_dir, f"{args.table}_pairs.csv")
+    clusters_file = os.path.join(args.output_dir, f"{args.table}_clusters.jsonl")
+    write_pairs(pairs_file, pairs)
+    count = write_clusters(clusters_file, pairs)
+    print(f"重复对已写入 {pairs_file}")
+    print(f"{count} 个重复簇已写入 {clusters_file}")
+
+
+if __name__ == "__main__":
+    main()
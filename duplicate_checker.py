@@ -1,12 +1,14 @@
 import json
 import os
+import asyncio
+import hashlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, List, Tuple
-import base64
 try:
+    # 向量模型由 embedding_service 按 EMBEDDING_BACKEND 创建，这里不直接依赖 sentence_transformers
     import faiss
     import numpy as np
-    from sentence_transformers import SentenceTransformer
-    import pickle
     VECTOR_SIMILARITY_AVAILABLE = True
 except ImportError:
     VECTOR_SIMILARITY_AVAILABLE = False
@@ -14,28 +16,112 @@ except ImportError:
     from rapidfuzz import fuzz
 
 from db_client import DBClient, TABLE_PK_MAP
-from llm_client import LLMClient
+from llm_client import LLMClient, PROMPT_VERSION
 from vector_index_builder import VectorIndexBuilder
+import ann_index
+from embedding_service import get_embedding_model
+from index_refresher import IndexRefresher
+from multi_table_search import FederatedSearcher, VECTOR_TOP_K
+from cdc_ingestor import CDCIngestor, INDEX_SYNC_MODE, create_change_source
+from reranker import create_reranker, RERANK_TOP_N
+from sqlite_cache import SQLiteCache
+
+# 单个查重请求同时进行的 LLM 比对数
+LLM_REQUEST_CONCURRENCY = int(os.getenv("LLM_REQUEST_CONCURRENCY", 8))
+# 向量得分（0~100）低于该值的候选直接丢弃，不交给 LLM；设为 0 时不丢弃
+VECTOR_SCORE_FLOOR = float(os.getenv("VECTOR_SCORE_FLOOR", 40))
+# 向量得分不低于该值的候选直接判定为重复，不交给 LLM；设为大于 100 时不启用
+VECTOR_SCORE_CEILING = float(os.getenv("VECTOR_SCORE_CEILING", 98))
+# LLM 得分不低于该值视为确认重复
+LLM_CONFIRM_SCORE = float(os.getenv("LLM_CONFIRM_SCORE", 80))
+# 每轮交给 LLM 比对的候选数，确认的重复达到 SIMILAR_RESULT_LIMIT 条后不再进行下一轮
+LLM_CASCADE_STEP = max(1, int(os.getenv("LLM_CASCADE_STEP", 15)))
+# 返回的相似数据条数
+SIMILAR_RESULT_LIMIT = 5
+# 异步查重中数据库查询、向量化、FAISS 检索和重排序等阻塞阶段使用的线程数（每个 worker 进程）
+CHECK_EXECUTOR_WORKERS = int(os.getenv("CHECK_EXECUTOR_WORKERS", 4))
+# 查重结果缓存（各 worker 共享）：键包含目标内容哈希和索引代数，目标记录修改或索引落盘后自然失效
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "1") == "1"
+RESULT_CACHE_PATH = os.getenv("RESULT_CACHE_PATH", os.path.join("vector_indexes", "result_cache.sqlite3"))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", 24 * 3600))
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", 50000))
+# 批量查重一次最多的目标数
+BATCH_MAX_TARGETS = int(os.getenv("BATCH_MAX_TARGETS", 500))
+# 批量查重中所有目标共享的 LLM 并发数
+BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", 16))
+
+# 一个 LLM 比对任务：(表名, 候选记录, 字段, 目标文本, 候选文本, 粗筛得分)
+LLMTask = Tuple[str, Dict[str, Any], str, Any, Any, float]
 
 class DuplicateChecker:
-    def __init__(self, db: DBClient, llm: LLMClient):
+    def __init__(self, db: DBClient, llm: LLMClient, reranker=None):
+        """
+        Args:
+            reranker: 可选的重排序器（提供 rerank(pairs, top_n) 方法），
+                      为 None 时按 RERANKER_MODEL_PATH 创建，未配置则不做重排序
+        """
         self.db = db
         self.llm = llm
         self.index_dir = "vector_indexes"
-        # 创建索引构建器
-        self.builder = VectorIndexBuilder(db)
+        self.reranker = reranker if reranker is not None else create_reranker()
+        # 异步查重的阻塞阶段在该线程池中执行，事件循环只负责调度和等待 LLM 响应
+        self._executor = ThreadPoolExecutor(max_workers=CHECK_EXECUTOR_WORKERS, thread_name_prefix="dup-check")
+        self.result_cache = SQLiteCache(RESULT_CACHE_PATH, "results", ttl=RESULT_CACHE_TTL,
+                                        max_entries=RESULT_CACHE_MAX_ENTRIES) if RESULT_CACHE_ENABLED else None
 
         if VECTOR_SIMILARITY_AVAILABLE:
-            # 初始化句子转换模型
-            # self.model = SentenceTransformer(r"F:\Downloads\modelscope\models\sentence-transformers")
-            self.model = SentenceTransformer(r"/DB_Duplication_Check/sentence-transformers/all-MiniLM-L6-v2")
-            # 存储每个表的向量索引
-            self.vector_indexes: Dict[str, Tuple[faiss.Index, List[Dict[str, Any]]]] = {}
-            # 尝试从磁盘加载向量索引
-            # self._load_vector_indexes()
+            # 初始化句子转换模型：与索引构建器共用进程内的同一份带缓存模型（LOCAL_MODEL_PATH），
+            # 推理后端（torch / onnx / openvino）由 EMBEDDING_BACKEND 选择
+            self.model = get_embedding_model()
+            # 创建索引构建器，使用独立的数据库连接供后台刷新线程使用
+            self.builder = VectorIndexBuilder(db.clone())
+            self.cdc = None
+            # 多个 worker 中只有抢到写锁的进程维护索引（刷新或消费 CDC），其余进程只读 mmap 加载索引文件
+            if INDEX_SYNC_MODE == "cdc":
+                # CDC 模式：启动时全量对齐一次，之后由行变更逐行更新索引，不再定时全表比对
+                self.refresher = IndexRefresher(self.builder, interval=None, in_place=True)
+                self.cdc = CDCIngestor(self.builder, self.refresher, create_change_source(db))
+                self.refresher.start(on_writer=self._start_cdc)
+            else:
+                # 后台刷新每个表的向量索引，请求路径只读取其发布的快照
+                self.refresher = IndexRefresher(self.builder)
+                self.refresher.start()
+            # 多表联合检索；只有 CDC 写进程原地修改索引时才与之加锁互斥，其余情况并发检索快照
+            self.searcher = FederatedSearcher(self.refresher.read_lock)
         else:
             self.model = None
-            self.vector_indexes = None
+            self.builder = None
+            self.refresher = None
+            self.cdc = None
+            self.searcher = None
+
+    def close(self):
+        """停止查重线程池，不等待正在执行的阶段"""
+        self._executor.shutdown(wait=False)
+
+    def _start_cdc(self):
+        """本进程成为索引写进程时开始消费变更：先确定起始位置，全量对齐期间的变更随后重放"""
+        self.cdc.prepare()
+        self.cdc.start()
+
+    def index_generation(self) -> str:
+        """
+        当前索引的代数，用于结果缓存键和请求合并：索引文件的代数（各 worker 一致），索引落盘后变化；
+        CDC 写进程内存中有尚未落盘的变更时再加上本进程的快照代数（每应用一条变更加一）。没有向量索引时为 "0"
+        """
+        if self.builder is None:
+            return "0"
+        generation = str(self.builder.known_generation())
+        if self.cdc is not None and self.cdc.has_unsaved_changes():
+            generation += f".{self.refresher.generation}"
+        return generation
+
+    @property
+    def vector_indexes(self) -> Dict[str, Tuple[Any, Dict[int, Dict[str, Any]]]] | None:
+        """当前发布的向量索引快照"""
+        if self.refresher is None:
+            return None
+        return self.refresher.snapshot()
 
 
     def _load_vector_indexes(self):
@@ -47,25 +133,20 @@ class DuplicateChecker:
         print("正在从磁盘加载向量索引...")
         for table in TABLE_PK_MAP.keys():
             index_file = os.path.join(self.index_dir, f"{table}_index.faiss")
-            records_file = os.path.join(self.index_dir, f"{table}_records.pkl")
+            records_file = self.builder.records_file(table)
 
             if os.path.exists(index_file) and os.path.exists(records_file):
                 try:
-                    # 加载FAISS索引
-                    index = faiss.read_index(index_file)
-
-                    # 加载记录数据
-                    with open(records_file, 'rb') as f:
-                        records = pickle.load(f)
-
-                    self.vector_indexes[table] = (index, records)
+                    # 加载FAISS索引和记录数据
+                    index, records = self.builder.load_index(table)
+                    self.refresher.publish(table, (index, records))
                     print(f"已加载表 {table} 的索引和记录 (共{len(records)}条记录)")
                 except Exception as e:
                     print(f"加载表 {table} 的索引失败: {e}")
-                    self.vector_indexes[table] = (None, [])
+                    self.refresher.publish(table, (None, {}))
             else:
                 print(f"表 {table} 的索引文件不存在，将在需要时实时构建")
-                self.vector_indexes[table] = (None, [])
+                self.refresher.publish(table, (None, {}))
 
 
     def build_vector_index(self, table: str):
@@ -74,30 +155,18 @@ class DuplicateChecker:
             return
 
         # 获取表的所有记录
-        records = self.db.get_all_records(table)
-        if not records:
-            self.vector_indexes[table] = (None, [])
+        rows = self.db.get_all_records(table)
+        if not rows:
+            self.refresher.publish(table, (None, {}))
             return
 
-        # 收集所有文本内容用于向量化
-        texts = []
-        for record in records:
-            # 将记录的所有文本字段合并为一个文本
-            text_fields = [str(record[col]) for col in record.keys() if col != TABLE_PK_MAP[table] and record[col]]
-            combined_text = ' '.join(text_fields)
-            texts.append(combined_text)
-
-        # 向量化所有文本
-        embeddings = self.model.encode(texts)
-
-        # 创建FAISS索引
-        dimension = embeddings.shape[1]
-        index = faiss.IndexFlatIP(dimension)  # 使用内积相似度
-        faiss.normalize_L2(embeddings)  # 归一化向量以获得更好的相似度计算
-        index.add(embeddings.astype(np.float32))
+        # 向量化所有记录，按记录数选择索引类型，并以主键为ID写入索引
+        pk = TABLE_PK_MAP[table]
+        records = {int(row[pk]): row for row in rows}
+        index = self.builder.build_index(table, records)
 
         # 保存索引和对应的记录
-        self.vector_indexes[table] = (index, records)
+        self.refresher.publish(table, (index, records))
 
 
     def vector_similarity(self, text1: str, text2: str) -> float:
@@ -128,9 +197,13 @@ class DuplicateChecker:
         pair = self.vector_indexes.get(table)  # 返回table表的元组 (index, records)
         if not pair or pair[0] is None:
             return  # 没有已载入索引就不动，build_vector_index 会重建
+        if not self.refresher.writable:
+            return  # 只读 mmap 加载的索引不能修改，由写进程的刷新补上
+        if not self.refresher.in_place:
+            return  # 轮询模式下检索不加锁，已发布的索引只能整体替换，由后台刷新补上
         index, records = pair
         pk_name = TABLE_PK_MAP[table]
-        if any(str(r[pk_name]) == str(target_id) for r in records):
+        if int(target_id) in records:
             return  # 已存在向量索引，直接返回
 
         parts = [str(row[c]) for c in text_cols if row.get(c)]  # 拼成一个单一的字符串，供后续向量化使用
@@ -138,15 +211,12 @@ class DuplicateChecker:
         if not joined:
             return
 
-        vec = self.model.encode([joined])[0].astype(np.float32, copy=False)
-        faiss.normalize_L2(vec.reshape(1, -1))
-        index.add(vec.reshape(1, -1))  # index 是一个 FAISS 向量索引对象，这里直接添加新向量
-        # 只向内存 records 追加一条字典行，字段用于后续 LLM 细筛无需改动
-        new_row = {pk_name: target_id}  # 一条用于内存维护的记录字典，用来和索引里的向量一一对应，包含主键和需要的文本字段
+        # 一条用于内存维护的记录字典，以主键为ID与索引里的向量对应，包含主键和需要的文本字段
+        new_row = {pk_name: target_id}
         for c in text_cols:
             new_row[c] = row.get(c)
-        records.append(new_row)
-        self.vector_indexes[table] = (index, records)
+        with self.refresher.index_lock:
+            self.builder.upsert_record(table, index, records, new_row)
 
     def alreadyExist(self, table: str, target_id: int):
         """判断目标记录是否已在索引中"""
@@ -154,175 +224,470 @@ class DuplicateChecker:
         if not pair or pair[0] is None:
             return  # 没有已载入索引就不动，build_vector_index 会重建
         index, records = pair
-        pk_name = TABLE_PK_MAP[table]
-        if any(str(r[pk_name]) == str(target_id) for r in records):
-            return True  # 已存在向量索引，直接返回
-        return False
+        return int(target_id) in records
+
+    def _target_embeddings(self, targets: List[Tuple[str, Any, Dict[str, Any], Dict[str, str]]],
+                           vector_indexes) -> List[Dict[str, "np.ndarray"]]:
+        """
+        获取各目标在各表检索用的向量（已归一化，形状为 (dim,)）
+        targets: [(目标表, 目标ID, 目标记录, {表名: 检索文本})]
+
+        目标记录在本表索引中已有原始向量（ivf_pq 只存量化编码，不复用）且内容未变时直接取出复用；
+        相同的文本（各表公共列相同、或批量中的多个目标内容相同）只计算一次，所有目标未命中的文本合并为一次 encode
+        """
+        vectors: Dict[str, np.ndarray] = {}
+        reusable = []
+        for target_type, target_id, target_record, _ in targets:
+            index, records = vector_indexes.get(target_type, (None, {}))
+            stored = records.get(int(target_id))
+            if index is not None and ann_index.stores_exact_vectors(index) and stored == target_record:
+                reusable.append((index, target_id, self.builder.combine_text(target_type, stored)))
+        if reusable:
+            with self.refresher.read_lock():
+                for index, target_id, text in reusable:
+                    try:
+                        vectors[text] = index.reconstruct(int(target_id))
+                    except RuntimeError as e:
+                        print(f"读取目标记录的已存向量失败: {e}")
+
+        missing = [text for text in dict.fromkeys(text for *_, text_by_table in targets
+                                                  for text in text_by_table.values()) if text not in vectors]
+        if missing:
+            embeddings = self.model.encode(missing)
+            faiss.normalize_L2(embeddings)
+            vectors.update(zip(missing, embeddings))
+        return [{table: vectors[text] for table, text in text_by_table.items()} for *_, text_by_table in targets]
 
     def check_duplicates(self, target_id: int, target_type: str) -> Dict[str, Any]:
-        result = {"code": 100, "msg": "success", "bizType": None, "bizContent": {"similarDemands": []}}
+        loaded = self._load_target(target_id, target_type)
+        if loaded is None:
+            return {"code": 404, "msg": f"No record found in {target_type} with id={target_id}"}
+        target_record, column_table = loaded
+        cache_key = self._result_cache_key(target_type, target_id, target_record)
+        cached = self._cached_result(cache_key)
+        if cached is not None:
+            return cached
+        top_candidates = self._search_candidates(target_id, target_type, target_record, column_table)
+        accepted, uncertain = self._cascade(target_record, top_candidates)
+        tasks, verdicts = self._judge(accepted, uncertain)
+        result = self._build_result(tasks, verdicts)
+        self._store_result(cache_key, result, verdicts)
+        return result
 
-        # 构建所有表的向量索引（如果尚未构建且未从磁盘加载、或者有新的记录被添加）
-        if VECTOR_SIMILARITY_AVAILABLE:
-            for table in TABLE_PK_MAP.keys():
-                if table not in self.vector_indexes or self.vector_indexes[table][0] is None:
-                    print(f"正在为表 {table} 构建向量索引...")
-                    self.build_vector_index(table)
-            # 增量更新所有表的索引
-            updated = self.builder.update_all_indexes_incremental()
-            if updated is not None:
-                self.vector_indexes.update(updated)
-        # ##########################
-        # pass
-        # # 将每个表的完整索引与记录保存为txt（索引以base64文本形式保存）
-        # os.makedirs(self.index_dir, exist_ok=True)
-        # try:
-        #     for t, (idx, recs) in self.vector_indexes.items():
-        #         out_file = os.path.join(self.index_dir, f"{t}_index_full1.txt")
-        #         data = {"table": t, "index_base64": None, "records": recs}
-        #         if idx is not None:
-        #             try:
-        #                 idx_bytes = faiss.serialize_index(idx)
-        #                 data["index_base64"] = base64.b64encode(idx_bytes).decode("ascii")
-        #             except Exception as e:
-        #                 data["index_error"] = str(e)
-        #         try:
-        #             payload = json.dumps(data, ensure_ascii=False, indent=2)
-        #         except TypeError:
-        #             data_fallback = dict(data)
-        #             data_fallback["records"] = None
-        #             data_fallback["records_repr"] = repr(recs)
-        #             payload = json.dumps(data_fallback, ensure_ascii=False, indent=2)
-        #         with open(out_file, "w", encoding="utf-8") as f:
-        #             f.write(payload)
-        # except Exception as e:
-        #     err_file = os.path.join(self.index_dir, "vector_indexes_full_error.txt")
-        #     with open(err_file, "w", encoding="utf-8") as ef:
-        #         ef.write(str(e))
-        # ##########################
+    async def check_duplicates_async(self, target_id: int, target_type: str) -> Dict[str, Any]:
+        """
+        check_duplicates 的异步版本：读取目标记录、向量化与检索、重排序这些阻塞阶段依次交给
+        有界线程池执行，不占用事件循环；每轮 LLM 精细比对的各次调用并发进行，
+        单个请求的并发数不超过 LLM_REQUEST_CONCURRENCY
+        """
+        loaded = await self._run_blocking(self._load_target, target_id, target_type)
+        if loaded is None:
+            return {"code": 404, "msg": f"No record found in {target_type} with id={target_id}"}
+        target_record, column_table = loaded
+        cache_key = self._result_cache_key(target_type, target_id, target_record)
+        cached = await self._run_blocking(self._cached_result, cache_key)
+        if cached is not None:
+            return cached
+        top_candidates = await self._run_blocking(self._search_candidates, target_id, target_type,
+                                                  target_record, column_table)
+        accepted, uncertain = await self._run_blocking(self._cascade, target_record, top_candidates)
+        tasks, verdicts = await self._judge_async(accepted, uncertain, asyncio.Semaphore(LLM_REQUEST_CONCURRENCY))
+        result = self._build_result(tasks, verdicts)
+        await self._run_blocking(self._store_result, cache_key, result, verdicts)
+        return result
 
+    async def check_duplicates_batch_async(self, targets: List[Tuple[Any, str]]) -> List[Dict[str, Any]]:
+        """
+        批量查重：targets 为 [(目标ID, 目标表)]，按相同顺序返回每个目标的结果（code、msg、bizContent）
+
+        各阶段对整批目标一次完成：每个表一次数据库查询读取目标记录，一次读取结果缓存，
+        所有未命中的目标文本一次向量化，同一目标表的目标以整个查询矩阵一次检索；
+        LLM 精细比对按目标并发进行，整批共享 BATCH_LLM_CONCURRENCY 个并发
+        """
+        results: List[Dict[str, Any] | None] = [None] * len(targets)
+        # 同一目标重复出现时只计算一次
+        positions: Dict[Tuple[str, str], List[int]] = {}
+        unique: List[Tuple[Any, str]] = []
+        for i, (target_id, target_type) in enumerate(targets):
+            if target_type not in TABLE_PK_MAP:
+                results[i] = {"code": 400, "msg": f"Unsupported type: {target_type}"}
+                continue
+            key = (target_type, str(target_id))
+            if key not in positions:
+                positions[key] = []
+                unique.append((target_id, target_type))
+            positions[key].append(i)
+
+        def _set(target: Tuple[Any, str], result: Dict[str, Any]):
+            for i in positions[(target[1], str(target[0]))]:
+                results[i] = result
+
+        loaded = await self._run_blocking(self._load_targets, unique)
+        found = []
+        for target, item in zip(unique, loaded):
+            if item is None:
+                _set(target, {"code": 404, "msg": f"No record found in {target[1]} with id={target[0]}"})
+            else:
+                found.append((target, item))
+
+        cache_keys = await self._run_blocking(lambda: [
+            self._result_cache_key(target_type, target_id, target_record)
+            for (target_id, target_type), (target_record, _) in found])
+        cached = await self._run_blocking(self._cached_results, cache_keys)
+        pending = []
+        for (target, item), cache_key in zip(found, cache_keys):
+            if cache_key in cached:
+                _set(target, cached[cache_key])
+            else:
+                pending.append((target, item, cache_key))
+
+        if pending:
+            items = [(target_id, target_type, target_record, column_table)
+                     for (target_id, target_type), (target_record, column_table), _ in pending]
+            all_candidates = await self._run_blocking(self._search_candidates_batch, items)
+            cascades = await self._run_blocking(lambda: [
+                self._cascade(item[2], top_candidates) for item, top_candidates in zip(items, all_candidates)])
+            semaphore = asyncio.Semaphore(BATCH_LLM_CONCURRENCY)
+            judged = await asyncio.gather(*(self._judge_async(accepted, uncertain, semaphore)
+                                            for accepted, uncertain in cascades), return_exceptions=True)
+            entries = []
+            for (target, _, cache_key), outcome in zip(pending, judged):
+                if isinstance(outcome, Exception):
+                    _set(target, {"code": 500, "msg": str(outcome)})
+                    continue
+                tasks, verdicts = outcome
+                result = self._build_result(tasks, verdicts)
+                entries.append((cache_key, result, verdicts))
+                _set(target, result)
+            await self._run_blocking(self._store_results, entries)
+        return results
+
+    def _judge(self, accepted: List[LLMTask], uncertain: List[LLMTask]) -> Tuple[List[LLMTask], List[Dict[str, Any]]]:
+        """
+        直接判定的任务使用向量得分；待比对的任务调用 LLM 做精细比对：
+        按向量得分从高到低分轮进行，已确认足够多的重复时停止。返回 (任务, 比对结果)
+        """
+        tasks, verdicts = list(accepted), [self._accepted_verdict(task) for task in accepted]
+        confirmed = len(accepted)
+        for start in range(0, len(uncertain), LLM_CASCADE_STEP):
+            if confirmed >= SIMILAR_RESULT_LIMIT:
+                break
+            round_tasks = uncertain[start:start + LLM_CASCADE_STEP]
+            round_verdicts = self._compare_tasks(round_tasks)
+            tasks += round_tasks
+            verdicts += round_verdicts
+            confirmed += sum(1 for v in round_verdicts if v.get("score", 0) >= LLM_CONFIRM_SCORE)
+        return tasks, verdicts
+
+    async def _judge_async(self, accepted: List[LLMTask], uncertain: List[LLMTask],
+                           semaphore: asyncio.Semaphore) -> Tuple[List[LLMTask], List[Dict[str, Any]]]:
+        """_judge 的异步版本，每轮的 LLM 调用在 semaphore 限制下并发进行"""
+        tasks, verdicts = list(accepted), [self._accepted_verdict(task) for task in accepted]
+        confirmed = len(accepted)
+        for start in range(0, len(uncertain), LLM_CASCADE_STEP):
+            if confirmed >= SIMILAR_RESULT_LIMIT:
+                break
+            round_tasks = uncertain[start:start + LLM_CASCADE_STEP]
+            round_verdicts = await self._compare_tasks_async(round_tasks, semaphore)
+            tasks += round_tasks
+            verdicts += round_verdicts
+            confirmed += sum(1 for v in round_verdicts if v.get("score", 0) >= LLM_CONFIRM_SCORE)
+        return tasks, verdicts
+
+    def _result_cache_key(self, target_type: str, target_id: int, target_record: Dict[str, Any]) -> str:
+        """
+        (类型, ID, 目标内容哈希, 索引代数, 大模型与提示词版本, 分流参数) 组成的结果缓存键：
+        目标记录修改、索引落盘（候选集合变化）、提示词或阈值调整后都不会命中旧结果
+        """
+        content = hashlib.sha1(json.dumps(target_record, sort_keys=True, ensure_ascii=False,
+                                          default=str).encode("utf-8")).hexdigest()
+        settings = (VECTOR_TOP_K, VECTOR_SCORE_FLOOR, VECTOR_SCORE_CEILING, LLM_CONFIRM_SCORE, LLM_CASCADE_STEP,
+                    RERANK_TOP_N if self.reranker is not None else None)
+        return hashlib.sha1(json.dumps([target_type, str(target_id), content, self.index_generation(),
+                                        self._llm_model_id(), PROMPT_VERSION, settings],
+                                       default=str).encode("utf-8")).hexdigest()
+
+    def _cached_result(self, cache_key: str) -> Dict[str, Any] | None:
+        if self.result_cache is None:
+            return None
+        return self.result_cache.get(cache_key)
+
+    def _llm_model_id(self) -> str:
+        """大模型标识：优先使用客户端的 model_id；model 只有是字符串（模型名）时才可用，本地客户端的 model 是模型对象"""
+        model_id = getattr(self.llm, "model_id", None) or getattr(self.llm, "model", None)
+        return model_id if isinstance(model_id, str) else type(self.llm).__name__
+
+    def _cached_results(self, cache_keys: List[str]) -> Dict[str, Dict[str, Any]]:
+        if self.result_cache is None or not cache_keys:
+            return {}
+        return self.result_cache.get_many(cache_keys)
+
+    def _store_result(self, cache_key: str, result: Dict[str, Any], verdicts: List[Dict[str, Any]]):
+        self._store_results([(cache_key, result, verdicts)])
+
+    def _store_results(self, entries: List[Tuple[str, Dict[str, Any], List[Dict[str, Any]]]]):
+        """批量写入 (缓存键, 结果, 比对结果)；LLM 调用失败时结果不完整，不缓存，下次重新比对"""
+        if self.result_cache is None:
+            return
+        self.result_cache.set_many({
+            cache_key: result for cache_key, result, verdicts in entries
+            if not any(str(v.get("reason", "")).startswith("调用失败") for v in verdicts)})
+
+    async def _run_blocking(self, fn, *args):
+        """在查重线程池中执行阻塞函数"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(fn, *args))
+
+    def _compare_tasks(self, tasks: List[LLMTask]) -> List[Dict[str, Any]]:
+        """LLM 比对一组任务：同一字段的候选合并到尽量少的调用中"""
+        verdicts: List[Dict[str, Any] | None] = [None] * len(tasks)
+        for (col, target_val), positions in self._group_tasks(tasks).items():
+            candidate_vals = [str(tasks[i][4]) for i in positions]
+            if hasattr(self.llm, "compare_many"):
+                group_verdicts = self.llm.compare_many(str(target_val), candidate_vals, col)
+            else:
+                group_verdicts = [self.llm.compare_texts(str(target_val), val, col) for val in candidate_vals]
+            for i, verdict in zip(positions, group_verdicts):
+                verdicts[i] = verdict
+        return verdicts
+
+    async def _compare_tasks_async(self, tasks: List[LLMTask], semaphore: asyncio.Semaphore) -> List[Dict[str, Any]]:
+        """_compare_tasks 的异步版本，各组并发进行"""
+        async def _compare_group(col: str, target_val: Any, candidate_vals: List[str]) -> List[Dict[str, Any]]:
+            if hasattr(self.llm, "compare_many_async"):
+                return await self.llm.compare_many_async(str(target_val), candidate_vals, col, semaphore=semaphore)
+            # 没有异步接口的客户端（如本地模型）在线程池中执行
+            async with semaphore:
+                if hasattr(self.llm, "compare_many"):
+                    return await self._run_blocking(self.llm.compare_many, str(target_val), candidate_vals, col)
+                return await self._run_blocking(
+                    lambda: [self.llm.compare_texts(str(target_val), val, col) for val in candidate_vals])
+
+        groups = self._group_tasks(tasks)
+        group_verdicts = await asyncio.gather(*(
+            _compare_group(col, target_val, [str(tasks[i][4]) for i in positions])
+            for (col, target_val), positions in groups.items()))
+        verdicts: List[Dict[str, Any] | None] = [None] * len(tasks)
+        for positions, results in zip(groups.values(), group_verdicts):
+            for i, verdict in zip(positions, results):
+                verdicts[i] = verdict
+        return verdicts
+
+    def _load_target(self, target_id: int, target_type: str) -> Tuple[Dict[str, Any], Dict[str, List[str]]] | None:
+        """
+        数据库阶段：读取目标记录，以及各表与目标表公共的 text 列（按目标表的列顺序）
+        返回 (目标记录, {表名: 公共列})，目标不存在时返回 None
+        """
         target_record = self.db.get_record_by_id(target_type, target_id)
         if not target_record:
             print("【get_record_by_id failed for", target_type, target_id)
-            return {"code": 404, "msg": f"No record found in {target_type} with id={target_id}"}
+            return None
+        return target_record, self._column_table(target_type)
+
+    def _load_targets(self, targets: List[Tuple[Any, str]]) -> List[Tuple[Dict[str, Any], Dict[str, List[str]]] | None]:
+        """
+        _load_target 的批量版本：targets 为 [(目标ID, 目标表)]，每个目标表只查询一次数据库
+        按相同顺序返回 (目标记录, {表名: 公共列})，目标不存在时为 None
+        """
+        ids_by_type: Dict[str, List[Any]] = {}
+        for target_id, target_type in targets:
+            ids_by_type.setdefault(target_type, []).append(target_id)
+        loaded = {}
+        for target_type, ids in ids_by_type.items():
+            column_table = self._column_table(target_type)
+            pk = TABLE_PK_MAP[target_type]
+            for record in self.db.get_records_by_ids(target_type, ids):
+                loaded[(target_type, str(record[pk]))] = (record, column_table)
+        return [loaded.get((target_type, str(target_id))) for target_id, target_type in targets]
+
+    def _column_table(self, target_type: str) -> Dict[str, List[str]]:
+        """各表与目标表公共的 text 列（按目标表的列顺序，保证拼接出的目标文本稳定）"""
         target_text_cols = self.db.get_text_columns(target_type)
-
-        top_candidates = []
         column_table = {}
         for table in TABLE_PK_MAP.keys():
             if table == target_type:
-                common_cols = target_text_cols
-                column_table[table] = common_cols
+                column_table[table] = target_text_cols
             else:
-                candidate_text_cols = self.db.get_text_columns(table)
-                common_cols = set(target_text_cols) & set(candidate_text_cols)
-                column_table[table] = common_cols
-
+                candidate_text_cols = set(self.db.get_text_columns(table))
+                column_table[table] = [col for col in target_text_cols if col in candidate_text_cols]
+        return column_table
+
+    def _search_candidates(self, target_id: int, target_type: str, target_record: Dict[str, Any],
+                           column_table: Dict[str, List[str]]) -> List[Tuple[float, Dict[str, Any], str]]:
+        """计算阶段：向量化目标文本并联合检索各表索引，返回 [(粗筛得分, 候选记录, 表名)]"""
+        return self._search_candidates_batch([(target_id, target_type, target_record, column_table)])[0]
+
+    def _search_candidates_batch(self, items: List[Tuple[Any, str, Dict[str, Any], Dict[str, List[str]]]]
+                                 ) -> List[List[Tuple[float, Dict[str, Any], str]]]:
+        """
+        _search_candidates 的批量版本：items 为 [(目标ID, 目标表, 目标记录, {表名: 公共列})]
+        所有目标的文本一次向量化；同一目标表的目标检索文本所用的表相同，按目标表分组后以整个查询矩阵一次检索
+        """
+        if not VECTOR_SIMILARITY_AVAILABLE:
+            return [self._fuzz_candidates(*item) for item in items]
+
+        # 索引由后台刷新器维护，这里只取当前快照，整批请求期间使用同一份
+        vector_indexes = self.vector_indexes
+        targets = []
+        for target_id, target_type, target_record, column_table in items:
+            # 各表检索用的目标文本
+            text_by_table = {
+                table: ' '.join(str(target_record[col]) for col in cols if target_record.get(col))
+                for table, cols in column_table.items() if cols
+            }
+            targets.append((target_type, target_id, target_record, text_by_table))
+        embeddings = self._target_embeddings(targets, vector_indexes)
+
+        positions_by_type: Dict[str, List[int]] = {}
+        for i, (_, target_type, _, _) in enumerate(items):
+            positions_by_type.setdefault(target_type, []).append(i)
+
+        top_candidates: List[List[Tuple[float, Dict[str, Any], str]]] = [[] for _ in items]
+        for target_type, positions in positions_by_type.items():
+            # 使用向量相似度检索替代RapidFuzz：所有表联合检索，按得分全局排序取前 K 条（排除目标数据本身）
+            queries = {table: np.stack([embeddings[i][table] for i in positions])
+                       for table in embeddings[positions[0]]}
+            if not queries:
+                continue
+            results = self.searcher.search(vector_indexes, queries, k=VECTOR_TOP_K,
+                                           exclude=[(target_type, items[i][0]) for i in positions])
+            for i, hits in zip(positions, results):
+                top_candidates[i] = [(score, record, table) for score, table, record in hits]
+        self._rescore_approximate(top_candidates, embeddings, vector_indexes)
+        return top_candidates
+
+    def _rescore_approximate(self, top_candidates: List[List[Tuple[float, Dict[str, Any], str]]],
+                             embeddings: List[Dict[str, "np.ndarray"]], vector_indexes):
+        """
+        ivf_pq 索引的检索得分由量化编码近似计算，可能偏高甚至超过 100；
+        这类候选中达到直接判定阈值的重新向量化（多数命中向量缓存），按原始向量计算精确得分后再参与分流
+        """
+        approximate = {table: not ann_index.stores_exact_vectors(pair[0])
+                       for table, pair in vector_indexes.items() if pair[0] is not None}
+        pending = [(i, j, self.builder.combine_text(table, record))
+                   for i, candidates in enumerate(top_candidates)
+                   for j, (score, record, table) in enumerate(candidates)
+                   if score >= VECTOR_SCORE_CEILING and approximate.get(table)]
+        if not pending:
+            return
+        vectors = self.model.encode([text for *_, text in pending])
+        faiss.normalize_L2(vectors)
+        for (i, j, _), vector in zip(pending, vectors):
+            _, record, table = top_candidates[i][j]
+            top_candidates[i][j] = (float(np.dot(embeddings[i][table], vector)) * 100, record, table)
+
+    def _fuzz_candidates(self, target_id: int, target_type: str, target_record: Dict[str, Any],
+                         column_table: Dict[str, List[str]]) -> List[Tuple[float, Dict[str, Any], str]]:
+        """未安装向量依赖时的回退：用 RapidFuzz 与各表全部记录比对"""
+        top_candidates = []
+        for table in TABLE_PK_MAP.keys():
+            common_cols = column_table[table]
             if not common_cols:
                 continue
 
-            if VECTOR_SIMILARITY_AVAILABLE:
-                # 使用向量相似度检索替代RapidFuzz
-                index, records = self.vector_indexes[table]
-                if index is None or not records:
+            # 原有逻辑：使用RapidFuzz
+            candidates = self.db.get_all_records(table)
+
+            # 1️⃣ 先用快速相似度筛选前 5 条
+            scored_candidates = []
+            for candidate in candidates:
+                # 跳过目标数据本身
+                if table == target_type and candidate[TABLE_PK_MAP[table]] == target_id:
                     continue
 
-                # 准备目标文本
-                target_texts = [str(target_record[col]) for col in common_cols if target_record.get(col)]
-                target_combined_text = ' '.join(target_texts)
-
-                # 向量化目标文本
-                target_embedding = self.model.encode([target_combined_text])
-                faiss.normalize_L2(target_embedding)
-
-                # 搜索最相似的条记录（多搜索一条，后面会移除目标数据本身）
-                search_count = min(16, len(records))
-                scores, indices = index.search(target_embedding.astype(np.float32), search_count)
-
-                # 收集候选结果
-                scored_candidates = []
-                for i, idx in enumerate(indices[0]):
-                    if idx < len(records):  # 确保索引有效
-                        # 如果是目标数据本身，跳过（相似度最高的那条）
-                        if table == target_type and records[idx][TABLE_PK_MAP[table]] == target_id:
-                            continue
-                        if records[idx].get("__deleted__") is True:
-                            continue  # 跳过墓碑（应该被删除的记录）
-                        scored_candidates.append((float(scores[0][i]) * 100, records[idx], table))
-                        # print("表:", table, "候选ID:", records[idx][TABLE_PK_MAP[table]], "粗筛得分:", float(scores[0][i]) * 100,"records[idx]",records[idx])
-
-                # 合并到top_candidates中，并确保最多只有5个候选者
-                top_candidates.extend(scored_candidates[:15])
-            else:
-                # 原有逻辑：使用RapidFuzz
-                candidates = self.db.get_all_records(table)
-
-                # 1️⃣ 先用快速相似度筛选前 5 条
-                scored_candidates = []
-                for candidate in candidates:
-                    # 跳过目标数据本身
-                    if table == target_type and candidate[TABLE_PK_MAP[table]] == target_id:
-                        continue
-
-                    rough_scores = []
-                    for col in common_cols:
-                        if target_record.get(col) and candidate.get(col):
-                            rough_scores.append(self.rough_similarity(target_record[col], candidate[col]))
-                    if rough_scores:
-                        avg_score = sum(rough_scores) / len(rough_scores)
-                        scored_candidates.append((avg_score, candidate, table))
-                        print("表:", table, "候选ID:", candidate[TABLE_PK_MAP[table]], "粗筛得分:", avg_score)
-
-                # 获取前5个最相似的候选者
-                scored_candidates = sorted(scored_candidates, key=lambda x: x[0], reverse=True)[:5]
-                top_candidates.extend(scored_candidates)
-
-        # 2️⃣ 再调用 LLM 做精细比对
-        for _, candidate, table in top_candidates:
-            alike_fields = {}
-            scores = []
-            # for col in column_table[table]:  # mainConsultContent
-            #     target_val = target_record.get(col)
-            #     candidate_val = candidate.get(col)
-            #     if target_val and candidate_val:
-            #         cmp_result = self.llm.compare_texts(str(target_val), str(candidate_val), col)
-            #         score = cmp_result.get("score", 0)
-            #         if score > 0:
-            #             alike_fields[col] = {
-            #                 "target_content": target_val,
-            #                 "candidate_content": candidate_val,
-            #                 "score": score,
-            #                 "reason": cmp_result.get("reason", "无")
-            #             }
-            #         scores.append(cmp_result.get("score", 0))
+                rough_scores = []
+                for col in common_cols:
+                    if target_record.get(col) and candidate.get(col):
+                        rough_scores.append(self.rough_similarity(target_record[col], candidate[col]))
+                if rough_scores:
+                    avg_score = sum(rough_scores) / len(rough_scores)
+                    scored_candidates.append((avg_score, candidate, table))
+                    print("表:", table, "候选ID:", candidate[TABLE_PK_MAP[table]], "粗筛得分:", avg_score)
+
+            # 获取前5个最相似的候选者
+            scored_candidates = sorted(scored_candidates, key=lambda x: x[0], reverse=True)[:5]
+            top_candidates.extend(scored_candidates)
+
+        return top_candidates
+
+    def _llm_tasks(self, target_record: Dict[str, Any],
+                   top_candidates: List[Tuple[float, Dict[str, Any], str]]) -> List[LLMTask]:
+        """
+        需要 LLM 精细比对的 (表名, 候选记录, 字段, 目标文本, 候选文本, 粗筛得分)
+        目前只比对 mainConsultContent，两边都有内容时才比对
+        """
+        tasks = []
+        for rough_score, candidate, table in top_candidates:
             col = "mainConsultContent"
-            pass
             target_val = target_record.get(col)
             candidate_val = candidate.get(col)
             if target_val and candidate_val:
-                cmp_result = self.llm.compare_texts(str(target_val), str(candidate_val), col)
-                score = cmp_result.get("score", 0)
-                if score > 0:
-                    alike_fields[col] = {
-                        "target_content": target_val,
-                        "candidate_content": candidate_val,
-                        "score": score,
-                        "reason": cmp_result.get("reason", "无")
-                    }
-                scores.append(cmp_result.get("score", 0))
-
-            if scores:
-                avg_score = sum(scores) / len(scores)
-                result["bizContent"]["similarDemands"].append({
-                    "type": table,
-                    "id": candidate[TABLE_PK_MAP[table]],
-                    "score": avg_score,
-                    "alikeFields": alike_fields
-                })
+                tasks.append((table, candidate, col, target_val, candidate_val, rough_score))
+        return tasks
+
+    def _cascade(self, target_record: Dict[str, Any],
+                 top_candidates: List[Tuple[float, Dict[str, Any], str]]) -> Tuple[List[LLMTask], List[LLMTask]]:
+        """
+        按向量得分分流：低于 VECTOR_SCORE_FLOOR 的丢弃，不低于 VECTOR_SCORE_CEILING 的直接判定为重复，
+        其余需要 LLM 比对；配置了重排序器时，待比对的候选再经重排序只保留前 RERANK_TOP_N 个。
+        返回 (直接判定的任务, 待 LLM 比对的任务)，均按得分降序
+        RapidFuzz 回退时得分含义不同，全部交给 LLM
+        """
+        tasks = sorted(self._llm_tasks(target_record, top_candidates), key=lambda t: t[5], reverse=True)
+        if not VECTOR_SIMILARITY_AVAILABLE:
+            return [], self._rerank(tasks)
+        accepted = [t for t in tasks if t[5] >= VECTOR_SCORE_CEILING]
+        uncertain = [t for t in tasks if VECTOR_SCORE_FLOOR <= t[5] < VECTOR_SCORE_CEILING]
+        return accepted, self._rerank(uncertain)
+
+    def _rerank(self, tasks: List[LLMTask]) -> List[LLMTask]:
+        """用本地重排序模型对所有候选一次批量打分，按重排序得分保留前 RERANK_TOP_N 个"""
+        if self.reranker is None or len(tasks) <= RERANK_TOP_N:
+            return tasks
+        try:
+            order = self.reranker.rerank([(str(t[3]), str(t[4])) for t in tasks], top_n=RERANK_TOP_N)
+        except Exception as e:
+            print(f"重排序失败: {e}，按向量得分交给 LLM")
+            return tasks
+        return [tasks[i] for i in order]
+
+    @staticmethod
+    def _accepted_verdict(task: LLMTask) -> Dict[str, Any]:
+        """直接判定为重复的候选使用向量得分（限制在 0~100）作为结果"""
+        rough_score = min(max(task[5], 0.0), 100.0)
+        return {"score": int(round(rough_score)),
+                "reason": f"向量相似度{rough_score:.1f}，高于直接判定阈值{VECTOR_SCORE_CEILING:g}"}
+
+    @staticmethod
+    def _group_tasks(tasks: List[LLMTask]) -> Dict[Tuple[str, str], List[int]]:
+        """按 (字段, 目标文本) 分组，返回每组任务的下标，同组候选可在一次 LLM 调用中比对"""
+        groups: Dict[Tuple[str, str], List[int]] = {}
+        for i, (_, _, col, target_val, _, _) in enumerate(tasks):
+            groups.setdefault((col, str(target_val)), []).append(i)
+        return groups
+
+    def _build_result(self, tasks: List[LLMTask], verdicts: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """汇总 LLM 比对结果"""
+        result = {"code": 100, "msg": "success", "bizType": None, "bizContent": {"similarDemands": []}}
+        for (table, candidate, col, target_val, candidate_val, _), cmp_result in zip(tasks, verdicts):
+            alike_fields = {}
+            score = cmp_result.get("score", 0)
+            if score > 0:
+                alike_fields[col] = {
+                    "target_content": target_val,
+                    "candidate_content": candidate_val,
+                    "score": score,
+                    "reason": cmp_result.get("reason", "无")
+                }
+            result["bizContent"]["similarDemands"].append({
+                "type": table,
+                "id": candidate[TABLE_PK_MAP[table]],
+                "score": score,
+                "alikeFields": alike_fields
+            })
 
         # 按 LLM 平均分降序，仅保留前 5 条
         similar_list = result["bizContent"]["similarDemands"]
         if similar_list:
             similar_list.sort(key=lambda x: x["score"], reverse=True)
-            result["bizContent"]["similarDemands"] = similar_list[:5]
+            result["bizContent"]["similarDemands"] = similar_list[:SIMILAR_RESULT_LIMIT]
         return result
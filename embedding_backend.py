@@ -0,0 +1,163 @@
+"""
+向量模型推理后端
+
+torch：完整的 PyTorch SentenceTransformer（默认）
+onnx：ONNX Runtime 推理导出的模型（如 onnx/model.onnx 或量化后的 onnx/model_qint8_avx512.onnx）
+openvino：OpenVINO 推理模型目录中的 openvino/openvino_model_qint8_quantized.xml（int8 量化，需同名 .bin 权重文件）
+
+三种后端提供相同的 encode / get_sentence_embedding_dimension 接口；onnx 和 openvino 只依赖
+tokenizers 分词，按模型目录中的 Pooling / Normalize 配置做平均池化和归一化，与 torch 的输出一致。
+"""
+import os
+import abc
+import json
+from typing import List
+
+import numpy as np
+
+# torch | onnx | openvino
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+# 相对模型目录的模型文件，未配置时使用各后端的默认文件
+EMBEDDING_MODEL_FILE = os.getenv("EMBEDDING_MODEL_FILE")
+# 推理线程数，0 表示由推理库决定
+EMBEDDING_NUM_THREADS = int(os.getenv("EMBEDDING_NUM_THREADS", 0))
+
+BACKENDS = ("torch", "onnx", "openvino")
+
+_DEFAULT_MODEL_FILES = {
+    "onnx": os.path.join("onnx", "model.onnx"),
+    "openvino": os.path.join("openvino", "openvino_model_qint8_quantized.xml"),
+}
+
+
+class _TransformerBackend(abc.ABC):
+    """onnx / openvino 共用的分词、池化和归一化"""
+
+    def __init__(self, model_path: str):
+        from tokenizers import Tokenizer
+
+        self.model_path = model_path
+        self.max_seq_length = 256
+        config_file = os.path.join(model_path, "sentence_bert_config.json")
+        if os.path.exists(config_file):
+            with open(config_file, "r", encoding="utf-8") as f:
+                self.max_seq_length = json.load(f).get("max_seq_length", self.max_seq_length)
+
+        # 平均池化与归一化，与模型目录 modules.json 中的配置保持一致
+        self.normalize = False
+        modules_file = os.path.join(model_path, "modules.json")
+        if os.path.exists(modules_file):
+            with open(modules_file, "r", encoding="utf-8") as f:
+                self.normalize = any(m.get("type", "").endswith("Normalize") for m in json.load(f))
+        pooling_file = os.path.join(model_path, "1_Pooling", "config.json")
+        self.dimension = None
+        if os.path.exists(pooling_file):
+            with open(pooling_file, "r", encoding="utf-8") as f:
+                pooling = json.load(f)
+            if not pooling.get("pooling_mode_mean_tokens", True):
+                raise ValueError(f"{model_path} 不是平均池化模型，请使用 torch 后端")
+            self.dimension = pooling.get("word_embedding_dimension")
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_path, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=self.max_seq_length)
+        self.tokenizer.enable_padding()
+
+    @abc.abstractmethod
+    def _forward(self, input_ids: np.ndarray, attention_mask: np.ndarray, token_type_ids: np.ndarray) -> np.ndarray:
+        """返回 (batch, seq_len, dim) 的最后一层隐状态"""
+
+    def get_sentence_embedding_dimension(self) -> int:
+        if self.dimension is None:
+            self.dimension = int(self.encode(["维度"]).shape[1])
+        return self.dimension
+
+    def encode(self, texts: List[str], batch_size: int = 32, **kwargs) -> np.ndarray:
+        """向量化文本列表，返回 (len(texts), dim) 的 float32 矩阵"""
+        if isinstance(texts, str):
+            texts = [texts]
+        if not texts:
+            return np.zeros((0, self.get_sentence_embedding_dimension()), dtype=np.float32)
+
+        # 按长度排序后分批，减少每批的填充长度，最后按原顺序返回
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        outputs = [None] * len(texts)
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            encodings = self.tokenizer.encode_batch([str(texts[i]) for i in batch])
+            input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+            attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+            token_type_ids = np.array([e.type_ids for e in encodings], dtype=np.int64)
+            hidden = self._forward(input_ids, attention_mask, token_type_ids)
+
+            mask = attention_mask[:, :, None].astype(np.float32)
+            embeddings = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            for i, vec in zip(batch, embeddings):
+                outputs[i] = vec
+
+        embeddings = np.stack(outputs).astype(np.float32)
+        if self.normalize or kwargs.get("normalize_embeddings"):
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings
+
+
+class OnnxBackend(_TransformerBackend):
+    def __init__(self, model_path: str, model_file: str = None):
+        super().__init__(model_path)
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        if EMBEDDING_NUM_THREADS:
+            options.intra_op_num_threads = EMBEDDING_NUM_THREADS
+        model_file = os.path.join(model_path, model_file or _DEFAULT_MODEL_FILES["onnx"])
+        self.session = ort.InferenceSession(model_file, options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def _forward(self, input_ids, attention_mask, token_type_ids):
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask, "token_type_ids": token_type_ids}
+        return self.session.run(None, {k: v for k, v in feeds.items() if k in self.input_names})[0]
+
+
+class OpenVINOBackend(_TransformerBackend):
+    def __init__(self, model_path: str, model_file: str = None):
+        super().__init__(model_path)
+        import openvino as ov
+
+        core = ov.Core()
+        config = {"INFERENCE_NUM_THREADS": EMBEDDING_NUM_THREADS} if EMBEDDING_NUM_THREADS else {}
+        model_file = os.path.join(model_path, model_file or _DEFAULT_MODEL_FILES["openvino"])
+        self.compiled = core.compile_model(core.read_model(model_file), "CPU", config)
+        self.input_names = {i.get_any_name() for i in self.compiled.inputs}
+        self.output = self.compiled.output(0)
+
+    def _forward(self, input_ids, attention_mask, token_type_ids):
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask, "token_type_ids": token_type_ids}
+        # 每次推理新建请求，多线程并发调用时互不影响
+        request = self.compiled.create_infer_request()
+        return request.infer({k: v for k, v in feeds.items() if k in self.input_names})[self.output]
+
+
+def _resolve_backend(backend: str = None) -> str:
+    """确定使用的后端（未指定时取 EMBEDDING_BACKEND），不支持的后端抛出 ValueError"""
+    backend = backend or EMBEDDING_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"不支持的向量模型后端: {backend}（可选 {' / '.join(BACKENDS)}）")
+    return backend
+
+
+def embedding_model_id(model_path: str, backend: str = None) -> str:
+    """向量缓存使用的模型标识：不同后端的输出有细微差异（尤其是 int8），缓存互不混用"""
+    backend = _resolve_backend(backend)
+    if backend == "torch":
+        return model_path
+    return f"{model_path}#{backend}:{EMBEDDING_MODEL_FILE or _DEFAULT_MODEL_FILES[backend]}"
+
+
+def create_embedding_model(model_path: str, backend: str = None):
+    """按 EMBEDDING_BACKEND 创建向量模型，返回与 SentenceTransformer 接口相同的对象"""
+    backend = _resolve_backend(backend)
+    if backend == "torch":
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(model_path)
+    if backend == "onnx":
+        return OnnxBackend(model_path, EMBEDDING_MODEL_FILE)
+    return OpenVINOBackend(model_path, EMBEDDING_MODEL_FILE)
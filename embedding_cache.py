@@ -0,0 +1,119 @@
+import os
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import List, Dict
+
+import numpy as np
+
+from sqlite_cache import SQLiteConnections, select_in
+
+# 磁盘缓存文件，多个 worker 进程共享
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", os.path.join("vector_indexes", "embedding_cache.sqlite3"))
+# 内存 LRU 最多缓存的向量条数
+EMBEDDING_CACHE_MEMORY_SIZE = int(os.getenv("EMBEDDING_CACHE_MEMORY_SIZE", 20000))
+
+
+def normalize_text(text: str) -> str:
+    """规范化文本：去掉首尾空白并把连续空白合并为一个空格"""
+    return " ".join(str(text).split())
+
+
+class EmbeddingCache:
+    """
+    带缓存的向量化模型
+
+    以 (模型标识, 规范化文本的 sha1) 为键缓存向量：先查内存 LRU，再查磁盘 SQLite，
+    都未命中的文本才交给模型，且合并为一次 encode。
+    提供与 SentenceTransformer 相同的 encode / get_sentence_embedding_dimension 接口，可直接替换。
+    """
+
+    def __init__(self, model, model_id: str, path: str = EMBEDDING_CACHE_PATH,
+                 memory_size: int = EMBEDDING_CACHE_MEMORY_SIZE):
+        self.model = model
+        self.model_id = model_id
+        self.path = path
+        self.memory_size = memory_size
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._memory_lock = threading.Lock()
+        self._connections = SQLiteConnections(
+            path, ["CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vec BLOB NOT NULL)"])
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.model.get_sentence_embedding_dimension()
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha1(f"{self.model_id}\n{text}".encode("utf-8")).hexdigest()
+
+    def _conn(self) -> sqlite3.Connection:
+        return self._connections.get()
+
+    def _memory_get(self, key: str):
+        with self._memory_lock:
+            vec = self._memory.get(key)
+            if vec is not None:
+                self._memory.move_to_end(key)
+            return vec
+
+    def _memory_put(self, key: str, vec: np.ndarray):
+        with self._memory_lock:
+            self._memory[key] = vec
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    def _disk_get(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        found = {}
+        try:
+            sql = "SELECT key, vec FROM embeddings WHERE key IN ({placeholders})"
+            for key, blob in select_in(self._conn(), sql, keys):
+                found[key] = np.frombuffer(blob, dtype=np.float32)
+        except sqlite3.Error as e:
+            print(f"读取向量缓存失败: {e}")
+        return found
+
+    def _disk_put(self, items: Dict[str, np.ndarray]):
+        try:
+            conn = self._conn()
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO embeddings (key, vec) VALUES (?, ?)",
+                                 [(key, vec.tobytes()) for key, vec in items.items()])
+        except sqlite3.Error as e:
+            print(f"写入向量缓存失败: {e}")
+
+    def encode(self, texts: List[str], **kwargs) -> np.ndarray:
+        """向量化文本列表，返回 (len(texts), dim) 的 float32 矩阵"""
+        texts = [normalize_text(t) for t in texts]
+        if not texts:
+            return np.zeros((0, self.get_sentence_embedding_dimension()), dtype=np.float32)
+
+        keys = [self._key(t) for t in texts]
+        vectors: Dict[str, np.ndarray] = {}
+        for key in set(keys):
+            vec = self._memory_get(key)
+            if vec is not None:
+                vectors[key] = vec
+
+        missing = [key for key in set(keys) if key not in vectors]
+        if missing:
+            for key, vec in self._disk_get(missing).items():
+                vectors[key] = vec
+                self._memory_put(key, vec)
+
+        # 内存和磁盘都未命中的文本，去重后一次性交给模型
+        to_encode = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                to_encode[key] = text
+        if to_encode:
+            embeddings = np.asarray(self.model.encode(list(to_encode.values()), **kwargs), dtype=np.float32)
+            # 逐行拷贝，避免 LRU 中的单行视图引用整个大矩阵
+            encoded = {key: vec.copy() for key, vec in zip(to_encode.keys(), embeddings)}
+            self._disk_put(encoded)
+            for key, vec in encoded.items():
+                vectors[key] = vec
+                self._memory_put(key, vec)
+
+        # np.stack 会拷贝出新矩阵，调用方可以原地归一化而不影响缓存
+        return np.stack([vectors[key] for key in keys])
@@ -0,0 +1,261 @@
+"""
+独立的向量化服务进程
+
+所有 API worker 通过 Unix socket 把文本发给同一个服务进程，由它加载唯一一份模型，
+并把各 worker 同时到达的请求合并成一批推理（动态微批处理：凑满 EMBEDDING_SERVER_MAX_BATCH 条
+或等待 EMBEDDING_SERVER_MAX_WAIT_MS 毫秒后执行），避免多个 worker 各持一份模型争抢 CPU。
+
+启动：python embedding_server.py（或 python start_server.py --mode prod --embedding-server）
+worker 侧设置 EMBEDDING_SERVER_SOCKET 后，get_embedding_model() 会返回连接该服务的客户端。
+
+协议：请求和响应都是 4 字节大端长度 + JSON 头；encode 的响应头之后紧跟 float32 向量数据。
+    {"op": "info"}                  -> {"ok": true, "dim": 384, "model_id": "..."}
+    {"op": "encode", "texts": [...]} -> {"ok": true, "shape": [n, dim]} + n*dim*4 字节
+"""
+import os
+import json
+import time
+import socket
+import struct
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Tuple
+
+import numpy as np
+
+# Unix socket 路径；worker 侧设置后通过该服务向量化
+EMBEDDING_SERVER_SOCKET = os.getenv("EMBEDDING_SERVER_SOCKET")
+# 每批最多的文本数
+EMBEDDING_SERVER_MAX_BATCH = int(os.getenv("EMBEDDING_SERVER_MAX_BATCH", 64))
+# 第一条请求到达后最多等待多久再执行（毫秒）
+EMBEDDING_SERVER_MAX_WAIT_MS = float(os.getenv("EMBEDDING_SERVER_MAX_WAIT_MS", 5))
+# 客户端等待响应的超时（秒），按单个请求计算
+EMBEDDING_SERVER_TIMEOUT = float(os.getenv("EMBEDDING_SERVER_TIMEOUT", 60))
+# 客户端单个请求最多携带的文本数：大批量（如重建索引）拆成多个请求依次发送，
+# 单个请求不会超时或整批重发，服务端在各请求之间也能穿插处理在线查重的请求
+EMBEDDING_SERVER_REQUEST_SIZE = max(1, int(os.getenv("EMBEDDING_SERVER_REQUEST_SIZE", 256)))
+
+_HEADER = struct.Struct(">I")
+
+
+def _pack(header: Dict[str, Any], payload: bytes = b"") -> bytes:
+    data = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    return _HEADER.pack(len(data)) + data + payload
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    chunks, remaining = [], size
+    while remaining:
+        chunk = sock.recv(min(remaining, 1 << 20))
+        if not chunk:
+            raise ConnectionError("向量化服务连接已关闭")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+class EmbeddingServer:
+    """接收各 worker 的请求，合并成批后在单独的推理线程中执行"""
+
+    def __init__(self, model, model_id: str, socket_path: str,
+                 max_batch: int = EMBEDDING_SERVER_MAX_BATCH, max_wait_ms: float = EMBEDDING_SERVER_MAX_WAIT_MS):
+        self.model = model
+        self.model_id = model_id
+        self.socket_path = socket_path
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.dim = model.get_sentence_embedding_dimension()
+        # 推理只在一个线程中进行，模型内部自行使用多核
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding")
+        self._queue: "asyncio.Queue[Tuple[List[str], asyncio.Future]]" = None
+
+    async def serve_forever(self):
+        self._queue = asyncio.Queue()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = await asyncio.start_unix_server(self._handle, path=self.socket_path)
+        os.chmod(self.socket_path, 0o660)
+        print(f"向量化服务已启动: {self.socket_path}（模型 {self.model_id}，维度 {self.dim}）")
+        batcher = asyncio.create_task(self._batch_loop())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """一个 worker 连接，连接上的请求依次处理"""
+        try:
+            while True:
+                try:
+                    size = _HEADER.unpack(await reader.readexactly(_HEADER.size))[0]
+                except asyncio.IncompleteReadError:
+                    break
+                request = json.loads(await reader.readexactly(size))
+                try:
+                    if request.get("op") == "info":
+                        writer.write(_pack({"ok": True, "dim": self.dim, "model_id": self.model_id}))
+                    elif request.get("op") == "encode":
+                        future = asyncio.get_running_loop().create_future()
+                        await self._queue.put((request["texts"], future))
+                        embeddings = await future
+                        writer.write(_pack({"ok": True, "shape": list(embeddings.shape)}, embeddings.tobytes()))
+                    else:
+                        writer.write(_pack({"ok": False, "error": f"未知操作: {request.get('op')}"}))
+                except Exception as e:
+                    writer.write(_pack({"ok": False, "error": str(e)}))
+                await writer.drain()
+        except Exception as e:
+            print(f"向量化服务连接异常: {e}")
+        finally:
+            writer.close()
+
+    async def _batch_loop(self):
+        """取出第一条请求后在 max_wait 内继续收集，凑满 max_batch 条文本或超时即执行一批"""
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self._queue.get()]
+            count = len(items[0][0])
+            deadline = loop.time() + self.max_wait
+            while count < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                items.append(item)
+                count += len(item[0])
+
+            texts = [text for item_texts, _ in items for text in item_texts]
+            try:
+                embeddings = await loop.run_in_executor(self._executor, self._encode, texts)
+            except Exception as e:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            start = 0
+            for item_texts, future in items:
+                if not future.done():
+                    future.set_result(embeddings[start:start + len(item_texts)])
+                start += len(item_texts)
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.ascontiguousarray(self.model.encode(texts), dtype=np.float32)
+
+
+class EmbeddingClient:
+    """
+    向量化服务客户端，提供与 SentenceTransformer 相同的 encode / get_sentence_embedding_dimension 接口
+    每个线程使用独立连接，连接断开时重连一次
+    """
+
+    def __init__(self, socket_path: str = EMBEDDING_SERVER_SOCKET, timeout: float = EMBEDDING_SERVER_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._info = None
+
+    def _sock(self) -> socket.socket:
+        sock = getattr(self._local, "sock", None)
+        if sock is None or self._local.pid != os.getpid():
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.socket_path)
+            except OSError:
+                sock.close()
+                raise
+            self._local.sock = sock
+            self._local.pid = os.getpid()
+        return sock
+
+    def _request(self, request: Dict[str, Any]) -> Tuple[Dict[str, Any], bytes]:
+        for attempt in range(2):
+            try:
+                sock = self._sock()
+                sock.sendall(_pack(request))
+                header = json.loads(_recv_exact(sock, _HEADER.unpack(_recv_exact(sock, _HEADER.size))[0]))
+                payload = b""
+                if header.get("ok") and "shape" in header:
+                    rows, dim = header["shape"]
+                    payload = _recv_exact(sock, rows * dim * 4)
+                break
+            except (OSError, ConnectionError):
+                # 服务重启等导致连接失效：关闭并丢弃连接后重试一次
+                sock = getattr(self._local, "sock", None)
+                self._local.sock = None
+                if sock is not None:
+                    try:
+                        sock.close()
+                    except OSError:
+                        pass
+                if attempt:
+                    raise
+        if not header.get("ok"):
+            raise RuntimeError(f"向量化服务返回错误: {header.get('error')}")
+        return header, payload
+
+    def info(self) -> Dict[str, Any]:
+        if self._info is None:
+            self._info = self._request({"op": "info"})[0]
+        return self._info
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.info()["dim"]
+
+    def encode(self, texts: List[str], **kwargs) -> np.ndarray:
+        """按 EMBEDDING_SERVER_REQUEST_SIZE 条一个请求分块发送，结果按原顺序拼接"""
+        if isinstance(texts, str):
+            texts = [texts]
+        texts = [str(t) for t in texts]
+        if not texts:
+            return np.zeros((0, self.get_sentence_embedding_dimension()), dtype=np.float32)
+        chunks = []
+        for start in range(0, len(texts), EMBEDDING_SERVER_REQUEST_SIZE):
+            header, payload = self._request({"op": "encode",
+                                             "texts": texts[start:start + EMBEDDING_SERVER_REQUEST_SIZE]})
+            chunks.append(np.frombuffer(payload, dtype=np.float32).reshape(header["shape"]))
+        return np.concatenate(chunks) if len(chunks) > 1 else chunks[0].copy()
+
+
+def connect(socket_path: str = EMBEDDING_SERVER_SOCKET, wait: float = 30) -> EmbeddingClient:
+    """连接向量化服务，服务尚未就绪时最多等待 wait 秒，仍不可用则抛出异常"""
+    client = EmbeddingClient(socket_path)
+    deadline = time.monotonic() + wait
+    while True:
+        try:
+            client.info()
+            return client
+        except (OSError, ConnectionError):
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.5)
+
+
+def main():
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    from embedding_backend import create_embedding_model, embedding_model_id
+    from embedding_service import LOCAL_MODEL_PATH
+
+    socket_path = EMBEDDING_SERVER_SOCKET or "/tmp/dup_check_embedding.sock"
+    model = create_embedding_model(LOCAL_MODEL_PATH)
+    server = EmbeddingServer(model, embedding_model_id(LOCAL_MODEL_PATH), socket_path)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        print("向量化服务已停止")
+    finally:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    main()
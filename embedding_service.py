@@ -0,0 +1,67 @@
+"""
+进程内共享的向量模型
+
+DuplicateChecker 和 VectorIndexBuilder 都通过 get_embedding_model() 获取同一个带缓存的模型，
+每个进程只加载一份。设置 EMBEDDING_PRELOAD=1 时 gunicorn 会在 master 进程中预先加载
+（见 gunicorn.conf.py 的 on_starting），fork 出的 worker 以写时复制方式共享模型内存。
+设置 EMBEDDING_SERVER_SOCKET 时不在本进程加载模型，而是连接独立的向量化服务（见 embedding_server.py），
+所有 worker 的请求由该服务合并成批推理。
+"""
+import os
+import threading
+from typing import Dict
+
+from embedding_cache import EmbeddingCache
+from embedding_backend import create_embedding_model, embedding_model_id
+
+# DEFAULT_MODEL_PATH = r"F:\Downloads\modelscope\models\sentence-transformers\all-MiniLM-L6-v2"
+DEFAULT_MODEL_PATH = r"/DB_Duplication_Check/sentence-transformers/all-MiniLM-L6-v2"
+LOCAL_MODEL_PATH = os.getenv("LOCAL_MODEL_PATH", DEFAULT_MODEL_PATH)
+# 是否在 gunicorn master 进程中预加载模型
+EMBEDDING_PRELOAD = os.getenv("EMBEDDING_PRELOAD", "0") == "1"
+# 独立向量化服务的 Unix socket 路径，未配置时在本进程加载模型
+EMBEDDING_SERVER_SOCKET = os.getenv("EMBEDDING_SERVER_SOCKET")
+# 连接向量化服务时等待其就绪的最长时间（秒）
+EMBEDDING_SERVER_WAIT = float(os.getenv("EMBEDDING_SERVER_WAIT", 30))
+
+_models: Dict[str, EmbeddingCache] = {}
+_lock = threading.Lock()
+
+
+def _connect_server(model_path: str):
+    """连接独立向量化服务；服务不可用或模型不一致时返回 None，回退到本进程加载"""
+    from embedding_server import connect
+    try:
+        client = connect(EMBEDDING_SERVER_SOCKET, wait=EMBEDDING_SERVER_WAIT)
+    except Exception as e:
+        print(f"连接向量化服务 {EMBEDDING_SERVER_SOCKET} 失败: {e}，在本进程加载模型")
+        return None
+    if client.info()["model_id"] != embedding_model_id(model_path):
+        print(f"向量化服务的模型 {client.info()['model_id']} 与 {model_path} 不一致，在本进程加载模型")
+        return None
+    return client
+
+
+def get_embedding_model(model_path: str = LOCAL_MODEL_PATH) -> EmbeddingCache:
+    """获取进程内共享的向量模型，首次调用时加载（或连接向量化服务）"""
+    model_id = embedding_model_id(model_path)
+    with _lock:
+        model = _models.get(model_id)
+        if model is None:
+            encoder = _connect_server(model_path) if EMBEDDING_SERVER_SOCKET else None
+            if encoder is None:
+                print(f"正在加载向量模型: {model_id}（进程 {os.getpid()}）")
+                encoder = create_embedding_model(model_path)
+            else:
+                print(f"使用向量化服务: {EMBEDDING_SERVER_SOCKET}（进程 {os.getpid()}）")
+            # 按文本内容缓存向量，重复出现的文本不再调用模型（缓存命中时也不访问向量化服务）
+            model = EmbeddingCache(encoder, model_id=model_id)
+            _models[model_id] = model
+        return model
+
+
+def preload():
+    """在 fork worker 之前加载模型；只加载不推理，避免推理库的线程池在 fork 后失效"""
+    # 使用独立向量化服务时 worker 不持有模型，无需预加载
+    if EMBEDDING_PRELOAD and not EMBEDDING_SERVER_SOCKET:
+        get_embedding_model()
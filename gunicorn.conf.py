@@ -43,4 +43,10 @@ pidfile = "/tmp/gunicorn.pid"
 # daemon = True
 
 # Worker进程名前缀
-proc_name = "duplication_checker"
\ No newline at end of file
+proc_name = "duplication_checker"
+
+# 设置 EMBEDDING_PRELOAD=1 时在 master 进程中预先加载向量模型，
+# fork 出的 worker 以写时复制方式共享模型内存，不再各自加载一份
+def on_starting(server):
+    from embedding_service import preload
+    preload()
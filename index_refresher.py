@@ -0,0 +1,261 @@
+import os
+import time
+import threading
+import contextlib
+from typing import Dict, Tuple, Optional, Callable
+
+import faiss
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 flock，每个进程各自维护索引
+    fcntl = None
+
+import ann_index
+from vector_index_builder import VectorIndexBuilder, Records
+
+# 后台定时刷新间隔（秒）
+INDEX_REFRESH_INTERVAL = float(os.getenv("INDEX_REFRESH_INTERVAL", 60))
+# 后台检查是否需要压缩索引的间隔（秒）
+INDEX_COMPACT_INTERVAL = float(os.getenv("INDEX_COMPACT_INTERVAL", 300))
+# 已删除但未移除的向量占比超过该值时压缩索引
+INDEX_COMPACT_RATIO = float(os.getenv("INDEX_COMPACT_RATIO", 0.1))
+# 多个 worker 共用索引目录：只有抢到写锁的进程更新索引文件，其余进程以只读 mmap 方式加载
+INDEX_SHARED = os.getenv("INDEX_SHARED", "1") == "1"
+# 只读进程检查索引文件是否更新（以及写进程是否退出）的间隔（秒）
+INDEX_RELOAD_INTERVAL = float(os.getenv("INDEX_RELOAD_INTERVAL", 2))
+
+IndexPair = Tuple[Optional[faiss.Index], Records]
+
+
+class IndexRefresher:
+    """
+    后台向量索引刷新器
+
+    在后台线程中定时（或被 trigger 唤醒时）执行增量更新，
+    构建好新的 {table: (index, records)} 字典后整体替换引用发布。
+    请求路径只读取 snapshot()，不会再触发任何数据库扫描或磁盘读写。
+
+    shared 模式下多个 worker 通过索引目录中的文件锁选出一个写进程：写进程负责刷新、压缩和落盘，
+    其余进程以只读 mmap 方式打开索引文件，在写进程落盘（索引代数变化）后重新映射；
+    写进程退出后由某个只读进程接管。
+    """
+
+    def __init__(self, builder: VectorIndexBuilder, interval: Optional[float] = INDEX_REFRESH_INTERVAL,
+                 shared: bool = INDEX_SHARED, in_place: bool = False):
+        """
+        interval 为 None 时不做定时刷新，只在 trigger 时刷新
+        in_place 为 True 表示写进程会通过 apply 原地修改已发布的索引（CDC 逐行应用），检索需要与之互斥
+        """
+        self.builder = builder
+        self.interval = interval
+        self.shared = shared and fcntl is not None
+        self.in_place = in_place
+        # 是否由本进程维护索引；只读进程快照中的索引是 mmap 映射的，不能原地修改
+        self.writable = False
+        self._on_writer: Optional[Callable[[], None]] = None
+        self._lock_file = None
+        self._request_file = os.path.join(builder.index_dir, "refresh_request")
+        self._request_seen = self._request_mtime()
+        self._file_generation = None
+        # 当前发布的快照字典；只会被整体替换，不会原地增删表
+        self._snapshot: Dict[str, IndexPair] = {}
+        # 每发布一次新快照（或原地应用一条变更）加一，便于调用方判断索引是否变化
+        self.generation = 0
+        self._refresh_lock = threading.Lock()
+        # 保护对快照中索引的原地修改（CDC 逐行应用）与检索之间的并发，通过 read_lock 获取
+        self.index_lock = threading.Lock()
+        self._trigger = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def snapshot(self) -> Dict[str, IndexPair]:
+        """获取当前索引快照（只读）"""
+        return self._snapshot
+
+    def read_lock(self):
+        """
+        检索或取回向量期间需持有的锁：只有本进程是写进程且会原地修改索引时才返回 index_lock；
+        否则已发布的索引只会被整体替换，各线程可并发检索同一份快照，不加锁。
+        writable 只会由 False 变为 True，且在换成可修改的索引之前设置，先取快照后取锁的调用方不会漏锁
+        """
+        if self.in_place and self.writable:
+            return self.index_lock
+        return contextlib.nullcontext()
+
+    def publish(self, table: str, pair: IndexPair):
+        """替换单个表的索引并发布新快照"""
+        with self._refresh_lock:
+            self._swap({table: pair})
+
+    def apply(self, fn: Callable[[Dict[str, IndexPair]], Optional[Dict[str, IndexPair]]]):
+        """
+        在写锁内对当前快照执行 fn，用于逐行原地修改索引
+        fn 返回需要整体替换的表（例如首次为空表创建索引），没有则返回 None
+        """
+        with self._refresh_lock, self.index_lock:
+            replaced = fn(self._snapshot)
+            if replaced:
+                self._swap(replaced)
+
+    def _swap(self, updated: Dict[str, IndexPair]):
+        new_snapshot = dict(self._snapshot)
+        new_snapshot.update(updated)
+        # 引用赋值是原子的，正在使用旧快照的请求不受影响
+        self._snapshot = new_snapshot
+        self.generation += 1
+
+    def refresh(self):
+        """同步执行一次增量刷新并发布"""
+        with self._refresh_lock:
+            self._refresh()
+
+    def _refresh(self, reload_all: bool = False):
+        # 已加载的表没有变更时不重新读取索引文件，也不发布新快照；
+        # reload_all 用于只读进程接管写锁后，把 mmap 映射的索引全部换成可修改的副本
+        # 顺带读取一次索引代数，索引文件被其他程序（如 update_vector_indexes.py）改写过时缓存键随之变化
+        self.builder.read_generation()
+        loaded = [] if reload_all else [table for table, (index, _) in self._snapshot.items() if index is not None]
+        updated = self.builder.update_all_indexes_incremental(skip_unchanged=loaded)
+        if updated:
+            self._swap(updated)
+
+    def reload(self):
+        """只读进程：索引代数变化后，以 mmap 方式重新加载文件有变化的表并发布"""
+        generation = self.builder.read_generation()
+        if generation == self._file_generation:
+            return
+        with self._refresh_lock:
+            updated = self.builder.reload_changed_indexes()
+            if updated:
+                self._swap(updated)
+            self._file_generation = generation
+
+    def _acquire_writer_lock(self) -> bool:
+        """非阻塞地获取索引目录的写锁，进程退出时锁自动释放"""
+        if not self.shared:
+            return True
+        if self._lock_file is None:
+            self._lock_file = open(os.path.join(self.builder.index_dir, "index_writer.lock"), "a")
+        try:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+
+    def _become_writer(self, reload_all: bool = False):
+        """成为写进程：先执行 on_writer（例如开始消费 CDC），再加载可修改的索引并完成一次刷新"""
+        with self._refresh_lock:
+            self.writable = True
+            if self._on_writer is not None:
+                # 持有刷新锁期间回调中产生的写入（CDC 应用变更）会等到刷新完成后才执行
+                self._on_writer()
+            self._refresh(reload_all=reload_all)
+
+    def _request_mtime(self) -> float:
+        try:
+            return os.stat(self._request_file).st_mtime
+        except OSError:
+            return 0.0
+
+    def compact(self):
+        """
+        压缩已删除记录残留的向量：在索引副本上移除（或重建）后整体发布，
+        检索始终使用完整可用的索引，不需要等待压缩
+        """
+        with self._refresh_lock:
+            compacted = {}
+            for table, (index, records) in self._snapshot.items():
+                if index is None:
+                    continue
+                orphans = self.builder.orphan_count(index, records)
+                # 残留向量过多，或记录数已达到更大规模索引类型（auto 模式）的阈值
+                if (orphans and orphans >= INDEX_COMPACT_RATIO * index.ntotal) \
+                        or ann_index.upgrade_needed(index, len(records)):
+                    compacted[table] = (self.builder.compact_index(table, index, records), records)
+            if compacted:
+                self._swap(compacted)
+
+    def trigger(self):
+        """唤醒后台线程立即刷新一次；只读进程通过请求文件通知写进程刷新"""
+        if self.writable or not self.shared:
+            self._trigger.set()
+            return
+        with open(self._request_file, "a"):
+            pass
+        os.utime(self._request_file)
+
+    def start(self, on_writer: Optional[Callable[[], None]] = None):
+        """
+        先同步加载一次索引，再启动后台刷新线程
+
+        Args:
+            on_writer: 本进程成为写进程时调用（启动时或接管时），在首次刷新之前执行
+        """
+        self._on_writer = on_writer
+        try:
+            if self._acquire_writer_lock():
+                self._become_writer()
+            else:
+                print(f"索引由其他进程维护，以只读 mmap 方式加载（进程 {os.getpid()}）")
+                self.reload()
+        except Exception as e:
+            print(f"初始化向量索引失败: {e}")
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="index-refresher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._trigger.set()
+
+    def _run(self):
+        if not self.writable:
+            self._follow()
+        if not self._stop.is_set():
+            self._run_writer()
+
+    def _follow(self):
+        """只读进程：定期检查索引代数并重新映射；写锁空出时接管为写进程"""
+        while not self._stop.wait(INDEX_RELOAD_INTERVAL):
+            try:
+                if self._acquire_writer_lock():
+                    print(f"获得索引写锁，进程 {os.getpid()} 接管索引维护")
+                    self._become_writer(reload_all=True)
+                    return
+                self.reload()
+            except Exception as e:
+                print(f"重新加载向量索引失败: {e}")
+
+    def _run_writer(self):
+        next_refresh = time.monotonic() + self.interval if self.interval else None
+        next_compact = time.monotonic() + INDEX_COMPACT_INTERVAL
+        while not self._stop.is_set():
+            deadline = next_compact if next_refresh is None else min(next_refresh, next_compact)
+            timeout = max(deadline - time.monotonic(), 0)
+            if self.shared:
+                # 定期检查只读进程留下的刷新请求
+                timeout = min(timeout, INDEX_RELOAD_INTERVAL)
+            triggered = self._trigger.wait(timeout)
+            self._trigger.clear()
+            if self._stop.is_set():
+                break
+            requested = self._request_mtime()
+            if requested != self._request_seen:
+                self._request_seen = requested
+                triggered = True
+
+            now = time.monotonic()
+            if triggered or (next_refresh is not None and now >= next_refresh):
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"后台刷新向量索引失败: {e}")
+                if self.interval:
+                    next_refresh = time.monotonic() + self.interval
+            if now >= next_compact:
+                try:
+                    self.compact()
+                except Exception as e:
+                    print(f"后台压缩向量索引失败: {e}")
+                next_compact = time.monotonic() + INDEX_COMPACT_INTERVAL
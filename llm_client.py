@@ -108,25 +108,51 @@
 #############################################
 
 import os
-import requests
 import json
+import asyncio
+import hashlib
+import threading
+from typing import Dict, Any, Optional, List
+
+import requests
 from dotenv import load_dotenv
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from embedding_cache import normalize_text
+from sqlite_cache import SQLiteCache
+
 load_dotenv()
 
 TONGYI_API_KEY = os.getenv("TONGYI_API_KEY")
 TONGYI_API_URL = os.getenv("TONGYI_API_URL")
 TONGYI_MODEL = os.getenv("TONGYI_MODEL", "qwen-plus")
+# 单次调用的总超时和建立连接的超时（秒）
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 30))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", 5))
+# 每个 worker 进程同时进行的大模型调用上限（连接池大小）
+LLM_WORKER_CONCURRENCY = int(os.getenv("LLM_WORKER_CONCURRENCY", 32))
+# 是否把多个候选合并到一次调用中比对
+LLM_BATCH_COMPARE = os.getenv("LLM_BATCH_COMPARE", "1") == "1"
+# 合并调用时单次提示词（含预计输出）的 token 预算，以及单次最多的候选数
+LLM_BATCH_TOKEN_BUDGET = int(os.getenv("LLM_BATCH_TOKEN_BUDGET", 6000))
+LLM_BATCH_MAX_CANDIDATES = int(os.getenv("LLM_BATCH_MAX_CANDIDATES", 15))
+# 比对结果缓存：多个 worker 共享的 SQLite 文件、有效期（秒）和最大条数
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") == "1"
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", os.path.join("vector_indexes", "llm_verdict_cache.sqlite3"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", 7 * 24 * 3600))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", 200000))
+# 提示词或打分规则变化时修改，使旧的缓存结果失效
+PROMPT_VERSION = "1"
+# 每个候选的编号、格式和输出（分数 + 不超过20字的原因）预留的 token 数
+_BATCH_TOKENS_PER_CANDIDATE = 40
 
-class LLMClient:
-    def __init__(self):
-        self.api_key = TONGYI_API_KEY
-        self.url = TONGYI_API_URL
-        self.model = TONGYI_MODEL
 
-    def compare_texts(self, text1: str, text2: str, field_name: str = "未知字段"):
-        """调用通义大模型对两个字段进行相似度比较"""
-        prompt = f"""
+def build_compare_prompt(text1: str, text2: str, field_name: str) -> str:
+    return f"""
 你是一个文本相似度分析助手。
 现在有两个文本需要比较，请完成以下任务：
 
@@ -145,21 +171,280 @@ class LLMClient:
 - 目标文本: {text1}
 - 候选文本: {text2}
 """
-        headers = {
+
+
+def build_batch_prompt(text1: str, texts2: List[str], field_name: str) -> str:
+    """一个目标文本与多个候选文本比对的提示词，候选从 1 开始编号"""
+    candidates = "\n".join(f"[{i}] {text}" for i, text in enumerate(texts2, 1))
+    return f"""
+你是一个文本相似度分析助手。
+现在有一个目标文本和 {len(texts2)} 个候选文本，请把每个候选文本分别与目标文本比较，完成以下任务：
+
+1. 根据语义相似度给出一个 0~100 的分数（整数，越高表示越相似）。
+2. 用简短中文解释打分原因（不超过20字）。
+
+请严格按照以下 JSON 数组格式返回结果，每个候选一项，id 为候选编号，不要输出其他多余内容：
+
+[
+  {{"id": <int>, "score": <int>, "reason": "<string>"}}
+]
+
+下面是待比较的内容：
+- 字段名称: {field_name}
+- 目标文本: {text1}
+- 候选文本:
+{candidates}
+"""
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估计 token 数：中文约一字一个 token，按字符数估计偏保守"""
+    return len(text)
+
+
+def chunk_by_token_budget(text1: str, texts2: List[str], field_name: str,
+                          budget: int = LLM_BATCH_TOKEN_BUDGET,
+                          max_candidates: int = LLM_BATCH_MAX_CANDIDATES) -> List[List[int]]:
+    """按 token 预算把候选分组，返回每组候选的下标；单个候选超出预算时独占一组"""
+    fixed = estimate_tokens(build_batch_prompt(text1, [], field_name))
+    chunks, current, used = [], [], fixed
+    for i, text in enumerate(texts2):
+        cost = estimate_tokens(text) + _BATCH_TOKENS_PER_CANDIDATE
+        if current and (used + cost > budget or len(current) >= max_candidates):
+            chunks.append(current)
+            current, used = [], fixed
+        current.append(i)
+        used += cost
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def strip_code_fence(content: str) -> str:
+    """移除可能的 markdown 代码块标记"""
+    content = content.strip()
+    if content.startswith("```json"):
+        content = content[7:]
+    if content.startswith("```"):
+        content = content[3:]
+    if content.endswith("```"):
+        content = content[:-3]
+    return content.strip()
+
+
+def parse_batch_output(raw_output: str, count: int) -> Dict[int, Dict[str, Any]]:
+    """
+    解析合并比对的 JSON 数组，返回 {候选编号: {"score", "reason"}}；输出不是 JSON 时抛出 ValueError
+    格式不对或编号超出范围的项忽略；同一编号出现多次时无法判断哪项可信，该编号也忽略（由调用方逐条比对）
+    """
+    items = json.loads(strip_code_fence(raw_output))
+    if isinstance(items, dict):
+        items = items.get("results", [])
+    parsed, repeated = {}, set()
+    for item in items if isinstance(items, list) else []:
+        try:
+            idx = int(item["id"])
+            verdict = {"score": int(item["score"]), "reason": str(item.get("reason", "无"))}
+        except (KeyError, TypeError, ValueError):
+            continue
+        if not 1 <= idx <= count:
+            continue
+        if idx in parsed:
+            repeated.add(idx)
+        parsed[idx] = verdict
+    for idx in repeated:
+        del parsed[idx]
+    return parsed
+
+
+class LLMClient:
+    def __init__(self):
+        self.api_key = TONGYI_API_KEY
+        self.url = TONGYI_API_URL
+        self.model = TONGYI_MODEL
+        # 结果缓存等使用的模型标识
+        self.model_id = TONGYI_MODEL
+        # 同步调用复用 keep-alive 连接
+        self._session = requests.Session()
+        # 异步会话和并发上限绑定在创建它们的事件循环上
+        self._async_session = None
+        self._async_loop = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._async_lock = threading.Lock()
+        # 相同文本对的比对结果缓存，命中时不再调用大模型
+        self.cache = SQLiteCache(LLM_CACHE_PATH, "verdicts", ttl=LLM_CACHE_TTL,
+                                 max_entries=LLM_CACHE_MAX_ENTRIES) if LLM_CACHE_ENABLED else None
+
+    def _cache_key(self, text1: str, text2: str, field_name: str) -> str:
+        """(模型, 提示词版本, 字段, 两个文本的哈希) 组成的键；两个文本的哈希排序后拼接，正反比对共用同一条"""
+        h1, h2 = sorted(hashlib.sha1(normalize_text(t).encode("utf-8")).hexdigest() for t in (text1, text2))
+        return hashlib.sha1(f"{self.model}\n{PROMPT_VERSION}\n{field_name}\n{h1}\n{h2}".encode("utf-8")).hexdigest()
+
+    def _cache_lookup(self, text1: str, texts2: List[str], field_name: str) -> List[Optional[Dict[str, Any]]]:
+        """查询缓存，返回与 texts2 一一对应的结果，未命中为 None"""
+        if self.cache is None:
+            return [None] * len(texts2)
+        keys = [self._cache_key(text1, text2, field_name) for text2 in texts2]
+        found = self.cache.get_many(list(set(keys)))
+        return [found.get(key) for key in keys]
+
+    def _cache_store(self, text1: str, verdicts: Dict[str, Dict[str, Any]], field_name: str):
+        """缓存成功解析的结果 {候选文本: 结果}，调用失败的结果不缓存"""
+        if self.cache is not None and verdicts:
+            self.cache.set_many({self._cache_key(text1, text2, field_name): verdict
+                                 for text2, verdict in verdicts.items()
+                                 if isinstance(verdict, dict) and "score" in verdict})
+
+    async def _cache_lookup_async(self, text1: str, texts2: List[str],
+                                  field_name: str) -> List[Optional[Dict[str, Any]]]:
+        """_cache_lookup 的异步版本：SQLite 查询在线程池中执行，不阻塞事件循环"""
+        if self.cache is None:
+            return [None] * len(texts2)
+        return await asyncio.get_running_loop().run_in_executor(None, self._cache_lookup, text1, texts2, field_name)
+
+    async def _cache_store_async(self, text1: str, verdicts: Dict[str, Dict[str, Any]], field_name: str):
+        """_cache_store 的异步版本"""
+        if self.cache is not None and verdicts:
+            await asyncio.get_running_loop().run_in_executor(None, self._cache_store, text1, verdicts, field_name)
+
+    def _headers(self) -> Dict[str, str]:
+        return {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.api_key}"
         }
-        payload = {
+
+    def _payload(self, prompt: str) -> Dict[str, Any]:
+        return {
             "model": self.model,
             "input": {"messages": [{"role": "user", "content": prompt}]}
         }
 
+    def _call(self, prompt: str) -> str:
+        """同步调用大模型，返回输出文本"""
+        response = self._session.post(self.url, headers=self._headers(), json=self._payload(prompt),
+                                      timeout=(LLM_CONNECT_TIMEOUT, LLM_TIMEOUT))
+        result = response.json()
+        return result["output"]["text"]
+
+    def _get_async_session(self):
+        """获取当前事件循环上的连接池会话，首次调用时创建"""
+        loop = asyncio.get_running_loop()
+        with self._async_lock:
+            if self._async_session is None or self._async_loop is not loop or self._async_session.closed:
+                connector = aiohttp.TCPConnector(limit=LLM_WORKER_CONCURRENCY, keepalive_timeout=60)
+                timeout = aiohttp.ClientTimeout(total=LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+                self._async_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+                self._async_loop = loop
+                self._semaphore = asyncio.Semaphore(LLM_WORKER_CONCURRENCY)
+            return self._async_session, self._semaphore
+
+    async def _call_async(self, prompt: str) -> str:
+        """异步调用大模型：复用连接池，同一 worker 内并发数不超过 LLM_WORKER_CONCURRENCY"""
+        if aiohttp is None:
+            # 未安装 aiohttp 时在线程池中执行同步调用
+            return await asyncio.get_running_loop().run_in_executor(None, self._call, prompt)
+        session, semaphore = self._get_async_session()
+        async with semaphore:
+            async with session.post(self.url, headers=self._headers(), json=self._payload(prompt)) as response:
+                result = await response.json(content_type=None)
+        return result["output"]["text"]
+
+    def compare_texts(self, text1: str, text2: str, field_name: str = "未知字段"):
+        """调用通义大模型对两个字段进行相似度比较"""
+        cached = self._cache_lookup(text1, [text2], field_name)[0]
+        if cached is not None:
+            return cached
         try:
-            response = requests.post(self.url, headers=headers, json=payload, timeout=30)
-            result = response.json()
             # 解析 LLM 输出
-            raw_output = result["output"]["text"]
-            return json.loads(raw_output)
+            verdict = json.loads(self._call(build_compare_prompt(text1, text2, field_name)))
+        except Exception as e:
+            return {"score": 0, "reason": f"调用失败: {e}"}
+        self._cache_store(text1, {text2: verdict}, field_name)
+        return verdict
+
+    async def compare_texts_async(self, text1: str, text2: str, field_name: str = "未知字段"):
+        """compare_texts 的异步版本"""
+        cached = (await self._cache_lookup_async(text1, [text2], field_name))[0]
+        if cached is not None:
+            return cached
+        try:
+            verdict = json.loads(await self._call_async(build_compare_prompt(text1, text2, field_name)))
+        except asyncio.TimeoutError:
+            return {"score": 0, "reason": f"调用失败: 请求超时（{LLM_TIMEOUT}秒）"}
         except Exception as e:
             return {"score": 0, "reason": f"调用失败: {e}"}
+        await self._cache_store_async(text1, {text2: verdict}, field_name)
+        return verdict
+
+    def compare_many(self, text1: str, texts2: List[str], field_name: str = "未知字段") -> List[Dict[str, Any]]:
+        """
+        一个目标文本与多个候选文本比对，返回与 texts2 一一对应的 {"score", "reason"}
+        先查缓存，未命中的候选按 token 预算分组，每组一次调用；模型回答中缺失的候选逐条单独比对
+        """
+        verdicts = self._cache_lookup(text1, texts2, field_name)
+        pending = [i for i, verdict in enumerate(verdicts) if verdict is None]
+        if LLM_BATCH_COMPARE:
+            for chunk in chunk_by_token_budget(text1, [texts2[i] for i in pending], field_name):
+                chunk = [pending[j] for j in chunk]
+                self._fill_chunk(verdicts, chunk, self._call_batch(text1, [texts2[i] for i in chunk], field_name))
+        return [verdict if verdict is not None else self.compare_texts(text1, text2, field_name)
+                for verdict, text2 in zip(verdicts, texts2)]
+
+    async def compare_many_async(self, text1: str, texts2: List[str], field_name: str = "未知字段",
+                                 semaphore: Optional[asyncio.Semaphore] = None) -> List[Dict[str, Any]]:
+        """compare_many 的异步版本：各组及缺失候选的单独比对并发进行，semaphore 可限制单个请求的并发数"""
+        semaphore = semaphore or asyncio.Semaphore(LLM_WORKER_CONCURRENCY)
+
+        async def _single(text2: str) -> Dict[str, Any]:
+            async with semaphore:
+                return await self.compare_texts_async(text1, text2, field_name)
+
+        async def _batch(chunk: List[int]) -> Dict[int, Dict[str, Any]]:
+            async with semaphore:
+                return await self._call_batch_async(text1, [texts2[i] for i in chunk], field_name)
+
+        verdicts = await self._cache_lookup_async(text1, texts2, field_name)
+        pending = [i for i, verdict in enumerate(verdicts) if verdict is None]
+        chunks = []
+        if LLM_BATCH_COMPARE:
+            chunks = [[pending[j] for j in chunk]
+                      for chunk in chunk_by_token_budget(text1, [texts2[i] for i in pending], field_name)]
+        for chunk, parsed in zip(chunks, await asyncio.gather(*(_batch(chunk) for chunk in chunks))):
+            self._fill_chunk(verdicts, chunk, parsed)
+        missing = [i for i, verdict in enumerate(verdicts) if verdict is None]
+        for i, verdict in zip(missing, await asyncio.gather(*(_single(texts2[i]) for i in missing))):
+            verdicts[i] = verdict
+        return verdicts
+
+    def _call_batch(self, text1: str, texts2: List[str], field_name: str) -> Dict[int, Dict[str, Any]]:
+        try:
+            parsed = parse_batch_output(self._call(build_batch_prompt(text1, texts2, field_name)), len(texts2))
+        except Exception as e:
+            print(f"合并比对 {len(texts2)} 个候选失败: {e}，改为逐条比对")
+            return {}
+        self._cache_store(text1, {texts2[number - 1]: verdict for number, verdict in parsed.items()}, field_name)
+        return parsed
+
+    async def _call_batch_async(self, text1: str, texts2: List[str], field_name: str) -> Dict[int, Dict[str, Any]]:
+        try:
+            raw_output = await self._call_async(build_batch_prompt(text1, texts2, field_name))
+            parsed = parse_batch_output(raw_output, len(texts2))
+        except Exception as e:
+            print(f"合并比对 {len(texts2)} 个候选失败: {e!r}，改为逐条比对")
+            return {}
+        await self._cache_store_async(text1, {texts2[number - 1]: verdict for number, verdict in parsed.items()},
+                                      field_name)
+        return parsed
+
+    @staticmethod
+    def _fill_chunk(verdicts: List[Optional[Dict[str, Any]]], chunk: List[int], parsed: Dict[int, Dict[str, Any]]):
+        """把一组的结果按候选编号写回对应位置"""
+        for number, i in enumerate(chunk, 1):
+            if number in parsed:
+                verdicts[i] = parsed[number]
 
+    async def close(self):
+        """关闭异步连接池，在应用退出时调用"""
+        if self._async_session is not None and not self._async_session.closed:
+            await self._async_session.close()
+        self._session.close()
@@ -1,11 +1,11 @@
 import os
 import json
+from typing import List, Dict, Any
 from dotenv import load_dotenv
 import logging
 
 # --- 1. 导入你测试代码中需要的库 ---
 from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
 import numpy as np
 
 load_dotenv()
@@ -21,6 +21,8 @@ class LLMClient:
         # --- 3. 修改 __init__：不再获取 API Key，而是加载本地模型 ---
         logging.info(f"正在从本地路径加载模型: {LOCAL_MODEL_PATH}")
         self.model = None
+        # 结果缓存等使用的模型标识（self.model 是模型对象，不能用作标识）
+        self.model_id = f"local:{LOCAL_MODEL_PATH}"
         try:
             # 加载你在 test_code.py 中使用的模型
             self.model = SentenceTransformer(LOCAL_MODEL_PATH)
@@ -34,35 +36,35 @@ class LLMClient:
         重写此方法：使用本地 embedding 模型计算相似度。
         不再调用通义 API。
         """
+        return self.compare_many(text1, [text2], field_name)[0]
+
+    def compare_many(self, text1: str, texts2: List[str], field_name: str = "未知字段") -> List[Dict[str, Any]]:
+        """
+        一个目标文本与多个候选文本比对：目标和所有候选在一次 encode 中批量编码，
+        归一化后用一次矩阵-向量乘得到全部余弦相似度
+        """
 
         # 检查模型是否加载成功
         if self.model is None:
-            return {"score": 0, "reason": "本地模型未加载"}
+            return [{"score": 0, "reason": "本地模型未加载"} for _ in texts2]
+        if not texts2:
+            return []
 
         try:
-            # --- 4. 替换核心逻辑：使用你 test_client.py 中的方法 ---
-
-            # 1. 编码：获取两个文本的向量
-            embeddings_np = self.model.encode([text1, text2])
-
-            # 2. 准备计算：将 1D 向量 reshape 为 2D
-            vec_a = embeddings_np[0].reshape(1, -1)
-            vec_b = embeddings_np[1].reshape(1, -1)
+            # 1. 编码：第 0 行为目标文本，其余为候选文本（目标只编码一次）
+            embeddings_np = np.asarray(self.model.encode([text1] + list(texts2), normalize_embeddings=True),
+                                       dtype=np.float32)
 
-            # 3. 计算：获取余弦相似度
-            #    结果是一个 2D 矩阵，我们取 [0][0] 得到那个浮点数值
-            sim = cosine_similarity(vec_a, vec_b)[0][0]
+            # 2. 计算：归一化后余弦相似度即点积
+            sims = embeddings_np[1:] @ embeddings_np[0]
 
-            # 4. 转换：将相似度 (0.0 ~ 1.0) 转换为 0-100 的整数分数
-            score = int(np.round(sim * 100))
+            # 3. 转换：将相似度 (0.0 ~ 1.0) 转换为 0-100 的整数分数
+            scores = np.rint(sims * 100).astype(int)
 
-            # 5. 返回：
+            # 4. 返回：
             #    注意：我们无法生成 "reason"，所以提供一个占位符
-            return {
-                "score": score,
-                "reason": "本地模型相似度计算"
-            }
+            return [{"score": int(score), "reason": "本地模型相似度计算"} for score in scores]
 
         except Exception as e:
             logging.error(f"本地模型推理失败: {e}")
-            return {"score": 0, "reason": f"调用失败: {e}"}
\ No newline at end of file
+            return [{"score": 0, "reason": f"调用失败: {e}"} for _ in texts2]
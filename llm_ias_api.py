@@ -10,6 +10,9 @@ load_dotenv()
 IAS_API_BASE_URL = os.getenv("IAS_API_BASE_URL", "http://dmx-api.zj.sgcc.com.cn")
 IAS_API_KEY = os.getenv("IAS_API_KEY", "33768df4e44e41d2a5a621065fa7d552")
 IAS_MODEL = os.getenv("IAS_MODEL", "[2.0-模型中心]Qwen3-32B-A100")
+# 请求总超时和建立连接的超时（秒）
+IAS_API_TIMEOUT = float(os.getenv("IAS_API_TIMEOUT", 60))
+IAS_API_CONNECT_TIMEOUT = float(os.getenv("IAS_API_CONNECT_TIMEOUT", 5))
 
 
 class LLMIasApi:
@@ -19,6 +22,10 @@ class LLMIasApi:
         self.base_url = IAS_API_BASE_URL
         self.api_key = IAS_API_KEY
         self.model = IAS_MODEL
+        # 结果缓存等使用的模型标识
+        self.model_id = IAS_MODEL
+        # 复用 keep-alive 连接，避免每次调用都重新建立连接
+        self.session = requests.Session()
         
     def _do_request(
         self, 
@@ -59,11 +66,11 @@ class LLMIasApi:
         
         try:
             # 发送POST请求
-            response = requests.post(
+            response = self.session.post(
                 url,
                 headers=headers,
                 json=data,
-                timeout=60
+                timeout=(IAS_API_CONNECT_TIMEOUT, IAS_API_TIMEOUT)
             )
             
             
@@ -88,7 +95,7 @@ class LLMIasApi:
             print("⏰ LLM API 请求超时")
             print("=" * 80)
             print(f"❌ 错误类型: Timeout")
-            print(f"⏱️  超时时间: 60秒")
+            print(f"⏱️  超时时间: {IAS_API_TIMEOUT}秒")
             print("=" * 80)
             
             return {
@@ -0,0 +1,86 @@
+import os
+import contextlib
+from typing import Dict, List, Tuple, Any, Optional, Callable, ContextManager
+
+import numpy as np
+
+from vector_index_builder import VectorIndexBuilder
+
+# 所有表合并后保留的候选数量（全局排序，不再按表分配固定名额）
+VECTOR_TOP_K = int(os.getenv("VECTOR_TOP_K", 45))
+
+# 一个候选：(粗筛得分 0~100, 表名, 记录)
+Candidate = Tuple[float, str, Dict[str, Any]]
+
+
+class FederatedSearcher:
+    """
+    多表联合检索
+
+    每个表的索引用该表的查询矩阵检索一次（一次调用可包含多条查询），
+    各表结果在 numpy 中合并，按得分全局排序后返回带表来源的前 K 条。
+    """
+
+    def __init__(self, read_lock: Optional[Callable[[], ContextManager]] = None):
+        # 返回检索期间需持有的锁（与 CDC 原地修改索引互斥，见 IndexRefresher.read_lock）；为 None 时不加锁
+        self.read_lock = read_lock or contextlib.nullcontext
+
+    def search(self, vector_indexes: Dict[str, Tuple[Any, Dict[int, Dict[str, Any]]]],
+               queries: Dict[str, np.ndarray], k: int = VECTOR_TOP_K,
+               exclude: Optional[List[Optional[Tuple[str, Any]]]] = None) -> List[List[Candidate]]:
+        """
+        Args:
+            vector_indexes: {表名: (index, records)} 快照
+            queries: {表名: 已归一化的查询矩阵 (nq, dim)}，各表行数相同，第 i 行对应第 i 个目标
+            k: 每个目标返回的候选数
+            exclude: 第 i 个目标需要排除的 (表名, 主键)，通常是目标记录本身
+        Returns:
+            每个目标一个候选列表，按得分降序
+        """
+        nq = next(iter(queries.values())).shape[0] if queries else 0
+        exclude = exclude or [None] * nq
+        tables, all_scores, all_ids = [], [], []
+        with self.read_lock():
+            for table, query in queries.items():
+                index, records = vector_indexes.get(table, (None, {}))
+                if index is None or not records:
+                    continue
+                # 多取已删除但未压缩的向量数和目标本身，保证过滤后仍有 k 条
+                fetch = min(k + 1 + VectorIndexBuilder.orphan_count(index, records), index.ntotal)
+                scores, ids = index.search(np.ascontiguousarray(query, dtype=np.float32), fetch)
+                tables.append(table)
+                all_scores.append(scores)
+                all_ids.append(ids)
+
+            if not tables:
+                return [[] for _ in range(nq)]
+
+            # (nq, 各表结果拼接) 后按得分降序排列
+            scores = np.concatenate(all_scores, axis=1)
+            ids = np.concatenate(all_ids, axis=1)
+            owners = np.concatenate([np.full(s.shape[1], i) for i, s in enumerate(all_scores)])
+            order = np.argsort(-scores, axis=1, kind="stable")
+
+            results = []
+            for q in range(nq):
+                candidates = []
+                seen = set()
+                skip = exclude[q]
+                for col in order[q]:
+                    vid = int(ids[q, col])
+                    if vid < 0:
+                        continue
+                    table = tables[owners[col]]
+                    record = vector_indexes[table][1].get(vid)
+                    if record is None:
+                        continue  # 记录已删除而向量尚未压缩
+                    if skip is not None and skip[0] == table and str(skip[1]) == str(vid):
+                        continue  # 目标数据本身
+                    if (table, vid) in seen:
+                        continue  # HNSW 中更新前的旧向量尚未重建移除
+                    seen.add((table, vid))
+                    candidates.append((float(scores[q, col]) * 100, table, record))
+                    if len(candidates) >= k:
+                        break
+                results.append(candidates)
+            return results
@@ -0,0 +1,251 @@
+"""
+列式记录存储
+
+替代整表 pickle 的记录字典：每个表一个文件，包含
+    - 主键列（int64 数组），行号即记录在文件中的位置
+    - 主键 -> 行号的开放寻址哈希表（int64 数组），按主键查找 O(1)，不需要把全部主键载入 Python 字典
+    - 每个 text 列一段连续的 UTF-8 数据、一个偏移表（int64，n+1）和空值标记（uint8）
+所有数组都可以直接内存映射，只读进程打开文件几乎不耗时，多个进程共享同一份页缓存。
+按主键取出的记录是惰性的：只有真正读取某个字段时才解码该字段的文本。
+
+文件是不可变的；写进程的新增、修改和删除记在内存中的覆盖层里，落盘时整体写出新文件。
+
+文件格式：MAGIC + 8 字节头长度 + JSON 头 + 按 8 字节对齐的数组，
+头中记录主键列名、text 列名、行数和每个数组的 (偏移, 类型, 元素数)。
+"""
+import os
+import json
+import struct
+from collections.abc import Mapping, MutableMapping
+from typing import Dict, Any, List, Iterable, Iterator, Optional, Tuple
+
+import numpy as np
+
+MAGIC = b"DUPREC1\n"
+_LENGTH = struct.Struct("<Q")
+# Fibonacci 哈希的乘数（2^64 / 黄金分割比）
+_HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+_UINT64_MASK = (1 << 64) - 1
+
+
+def _align8(n: int) -> int:
+    return (n + 7) & ~7
+
+
+def _hash_bits(count: int) -> int:
+    """哈希表槽位数取不小于 2 倍记录数的 2 的幂，装载因子不超过 0.5"""
+    return max(3, int(2 * count - 1).bit_length()) if count else 0
+
+
+def _build_hash_table(pks: np.ndarray) -> np.ndarray:
+    """
+    向量化构建线性探测哈希表：每轮把仍未放置的主键放到各自探测序列的下一个槽位，
+    同一空槽位只放第一个，其余进入下一轮。槽位内容为行号，-1 表示空
+    """
+    bits = _hash_bits(len(pks))
+    if not bits:
+        return np.zeros(0, dtype=np.int64)
+    mask = (1 << bits) - 1
+    table = np.full(1 << bits, -1, dtype=np.int64)
+    home = ((pks.astype(np.uint64) * np.uint64(_HASH_MULTIPLIER)) >> np.uint64(64 - bits)).astype(np.int64)
+    rows = np.arange(len(pks), dtype=np.int64)
+    step = np.zeros(len(pks), dtype=np.int64)
+    while len(rows):
+        slots = (home[rows] + step[rows]) & mask
+        free = table[slots] < 0
+        placed_slots, first = np.unique(slots[free], return_index=True)
+        placed_rows = rows[free][first]
+        table[placed_slots] = placed_rows
+        done = np.zeros(len(rows), dtype=bool)
+        done[np.flatnonzero(free)[first]] = True
+        rows = rows[~done]
+        step[rows] += 1
+    return table
+
+
+class _ColumnFile:
+    """一个记录文件的只读视图"""
+
+    def __init__(self, buffer: np.ndarray):
+        header_size = _LENGTH.unpack(bytes(buffer[len(MAGIC):len(MAGIC) + _LENGTH.size]))[0]
+        if bytes(buffer[:len(MAGIC)]) != MAGIC:
+            raise ValueError("不是有效的记录存储文件")
+        start = len(MAGIC) + _LENGTH.size
+        header = json.loads(bytes(buffer[start:start + header_size]).decode("utf-8"))
+        data_start = _align8(start + header_size)
+
+        def _array(name: str) -> np.ndarray:
+            offset, dtype, count = header["arrays"][name]
+            begin = data_start + offset
+            return buffer[begin:begin + count * np.dtype(dtype).itemsize].view(dtype)
+
+        self.pk: str = header["pk"]
+        self.columns: List[str] = header["columns"]
+        self.count: int = header["count"]
+        self.pks = _array("pks")
+        self.table = _array("hash")
+        self.bits = _hash_bits(self.count)
+        self.texts = {col: (_array(f"{i}.offsets"), _array(f"{i}.nulls"), _array(f"{i}.data"))
+                      for i, col in enumerate(self.columns)}
+
+    @classmethod
+    def empty(cls, pk: str = "") -> "_ColumnFile":
+        return cls(np.frombuffer(_serialize(pk, [], np.zeros(0, dtype=np.int64), {}), dtype=np.uint8))
+
+    def find(self, pk: int) -> int:
+        """主键所在行号，不存在时返回 -1"""
+        if not self.bits:
+            return -1
+        mask = (1 << self.bits) - 1
+        slot = ((pk * _HASH_MULTIPLIER) & _UINT64_MASK) >> (64 - self.bits)
+        while True:
+            row = int(self.table[slot])
+            if row < 0:
+                return -1
+            if int(self.pks[row]) == pk:
+                return row
+            slot = (slot + 1) & mask
+
+    def value(self, row: int, col: str) -> Any:
+        if col == self.pk:
+            return int(self.pks[row])
+        offsets, nulls, data = self.texts[col]
+        if nulls[row]:
+            return None
+        return bytes(data[int(offsets[row]):int(offsets[row + 1])]).decode("utf-8")
+
+
+def _serialize(pk: str, columns: List[str], pks: np.ndarray, texts: Dict[str, List[Optional[str]]]) -> bytes:
+    """把主键列和各 text 列编码为记录文件内容"""
+    arrays: List[Tuple[str, np.ndarray]] = [("pks", pks), ("hash", _build_hash_table(pks))]
+    for i, col in enumerate(columns):
+        values = texts[col]
+        encoded = [b"" if v is None else str(v).encode("utf-8") for v in values]
+        offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        if encoded:
+            np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        arrays.append((f"{i}.offsets", offsets))
+        arrays.append((f"{i}.nulls", np.array([v is None for v in values], dtype=np.uint8)))
+        arrays.append((f"{i}.data", np.frombuffer(b"".join(encoded), dtype=np.uint8)))
+
+    layout, position = {}, 0
+    for name, array in arrays:
+        layout[name] = [position, array.dtype.str, int(array.size)]
+        position = _align8(position + array.nbytes)
+    header = json.dumps({"pk": pk, "columns": columns, "count": int(len(pks)), "arrays": layout},
+                        ensure_ascii=False).encode("utf-8")
+
+    head = MAGIC + _LENGTH.pack(len(header)) + header
+    parts = [head, b"\0" * (_align8(len(head)) - len(head))]
+    for name, array in arrays:
+        data = array.tobytes()
+        parts.append(data)
+        parts.append(b"\0" * (_align8(len(data)) - len(data)))
+    return b"".join(parts)
+
+
+class StoredRecord(Mapping):
+    """记录文件中的一行，字段在读取时才解码"""
+
+    __slots__ = ("_file", "_row")
+
+    def __init__(self, file: _ColumnFile, row: int):
+        self._file = file
+        self._row = row
+
+    def __getitem__(self, col: str) -> Any:
+        if col != self._file.pk and col not in self._file.texts:
+            raise KeyError(col)
+        return self._file.value(self._row, col)
+
+    def __iter__(self) -> Iterator[str]:
+        yield self._file.pk
+        yield from self._file.columns
+
+    def __len__(self) -> int:
+        return 1 + len(self._file.columns)
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+
+class RecordStore(MutableMapping):
+    """
+    主键 -> 记录 的映射，接口与原来的记录字典相同
+
+    基础数据来自不可变的记录文件（可内存映射），写入记在覆盖层中：
+    覆盖层的值为新记录，或 None 表示该主键已删除
+    """
+
+    def __init__(self, file: Optional[_ColumnFile] = None):
+        self._file = file or _ColumnFile.empty()
+        self._overlay: Dict[int, Optional[Dict[str, Any]]] = {}
+        self._count = self._file.count
+
+    @classmethod
+    def open(cls, path: str, mmap: bool = False) -> "RecordStore":
+        """打开记录文件；mmap=True 时以只读内存映射方式打开，否则读入内存"""
+        if mmap:
+            buffer = np.memmap(path, dtype=np.uint8, mode="r")
+        else:
+            buffer = np.fromfile(path, dtype=np.uint8)
+        return cls(_ColumnFile(buffer))
+
+    @staticmethod
+    def write(path: str, pk: str, records: Iterable[Mapping[str, Any]]):
+        """把记录写为列式文件：先写临时文件再 os.replace，读取方不会看到写了一半的文件"""
+        records = list(records)
+        columns = list(dict.fromkeys(col for record in records for col in record if col != pk))
+        pks = np.fromiter((int(record[pk]) for record in records), dtype=np.int64, count=len(records))
+        texts = {col: [record.get(col) for record in records] for col in columns}
+        tmp_file = f"{path}.tmp{os.getpid()}"
+        with open(tmp_file, "wb") as f:
+            f.write(_serialize(pk, columns, pks, texts))
+        os.replace(tmp_file, path)
+
+    def save(self, path: str, pk: str):
+        """把当前全部记录（含覆盖层）写为新的记录文件"""
+        self.write(path, pk, self.values())
+
+    def __contains__(self, pk: object) -> bool:
+        pk = int(pk) if isinstance(pk, np.integer) else pk
+        if pk in self._overlay:
+            return self._overlay[pk] is not None
+        return isinstance(pk, int) and self._file.find(pk) >= 0
+
+    def __getitem__(self, pk: int) -> Mapping[str, Any]:
+        pk = int(pk) if isinstance(pk, np.integer) else pk
+        if pk in self._overlay:
+            record = self._overlay[pk]
+            if record is None:
+                raise KeyError(pk)
+            return record
+        row = self._file.find(pk) if isinstance(pk, int) else -1
+        if row < 0:
+            raise KeyError(pk)
+        return StoredRecord(self._file, row)
+
+    def __setitem__(self, pk: int, record: Mapping[str, Any]):
+        pk = int(pk)
+        if pk not in self:
+            self._count += 1
+        self._overlay[pk] = dict(record)
+
+    def __delitem__(self, pk: int):
+        pk = int(pk)
+        if pk not in self:
+            raise KeyError(pk)
+        self._overlay[pk] = None
+        self._count -= 1
+
+    def __iter__(self) -> Iterator[int]:
+        overlay = self._overlay
+        for pk in self._file.pks.tolist():
+            if overlay.get(pk, True) is not None:
+                yield pk
+        for pk, record in list(overlay.items()):
+            if record is not None and self._file.find(pk) < 0:
+                yield pk
+
+    def __len__(self) -> int:
+        return self._count
@@ -0,0 +1,53 @@
+"""
+本地重排序模型
+
+在 FAISS 粗筛和远程大模型精筛之间，用交叉编码器（如 bge-reranker-base）对候选重新打分，
+只把得分最高的少数候选交给大模型。交叉编码器同时读入两段文本，比向量余弦更准确，
+在 CPU 上按批次推理。
+"""
+import os
+from typing import List, Tuple, Optional
+
+# 交叉编码器模型目录，未配置时不启用重排序
+RERANKER_MODEL_PATH = os.getenv("RERANKER_MODEL_PATH")
+# 重排序后交给大模型的候选数
+RERANK_TOP_N = int(os.getenv("RERANK_TOP_N", 10))
+# 推理批大小和最大输入长度
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", 32))
+RERANK_MAX_LENGTH = int(os.getenv("RERANK_MAX_LENGTH", 512))
+
+
+class CrossEncoderReranker:
+    """基于 sentence_transformers.CrossEncoder 的重排序器"""
+
+    def __init__(self, model_path: str = RERANKER_MODEL_PATH, batch_size: int = RERANK_BATCH_SIZE,
+                 max_length: int = RERANK_MAX_LENGTH):
+        from sentence_transformers import CrossEncoder
+        self.model = CrossEncoder(model_path, max_length=max_length, device="cpu")
+        self.batch_size = batch_size
+
+    def score(self, pairs: List[Tuple[str, str]]) -> List[float]:
+        """对 (目标文本, 候选文本) 列表打分，一次批量推理，分数越高越相关"""
+        if not pairs:
+            return []
+        scores = self.model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False)
+        return [float(s) for s in scores]
+
+    def rerank(self, pairs: List[Tuple[str, str]], top_n: int = RERANK_TOP_N) -> List[int]:
+        """返回得分最高的 top_n 个 pair 的下标，按得分降序"""
+        scores = self.score(pairs)
+        order = sorted(range(len(pairs)), key=lambda i: scores[i], reverse=True)
+        return order[:top_n]
+
+
+def create_reranker() -> Optional[CrossEncoderReranker]:
+    """根据环境变量创建重排序器，未配置或加载失败时返回 None（不做重排序）"""
+    if not RERANKER_MODEL_PATH:
+        return None
+    try:
+        reranker = CrossEncoderReranker(RERANKER_MODEL_PATH)
+        print(f"已加载重排序模型: {RERANKER_MODEL_PATH}")
+        return reranker
+    except Exception as e:
+        print(f"加载重排序模型 {RERANKER_MODEL_PATH} 失败: {e}，不做重排序")
+        return None
@@ -0,0 +1,159 @@
+"""
+相同查重请求的合并（single-flight）
+
+同一时刻对同一 (类型, ID, 索引代数) 的多个请求只计算一次：
+    - 同一 worker 内：后到的请求等待先到请求的 Future，共享同一个结果
+    - 同一主机的不同 worker 之间：按请求键对锁文件加 flock，抢到锁的 worker 负责计算并把结果写入结果文件，
+      其他 worker 轮询等待结果文件出现后直接读取；计算失败或等待超时时各自计算
+结果文件只用于交接正在进行的计算，保留 SINGLE_FLIGHT_RESULT_TTL 秒后删除，不作为结果缓存。
+"""
+import os
+import json
+import time
+import asyncio
+import hashlib
+from typing import Dict, Any, Tuple, Callable, Awaitable, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 flock，只合并同一进程内的请求
+    fcntl = None
+
+# 是否合并相同的并发查重请求
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "1") == "1"
+# 跨 worker 合并使用的锁文件和结果文件目录（需在同一主机的本地磁盘上）
+SINGLE_FLIGHT_DIR = os.getenv("SINGLE_FLIGHT_DIR", os.path.join("vector_indexes", "inflight"))
+# 等待其他 worker 计算结果的最长时间（秒），超时后自行计算
+SINGLE_FLIGHT_WAIT = float(os.getenv("SINGLE_FLIGHT_WAIT", 300))
+# 结果文件保留时间（秒）
+SINGLE_FLIGHT_RESULT_TTL = float(os.getenv("SINGLE_FLIGHT_RESULT_TTL", 30))
+# 轮询其他 worker 结果的间隔（秒）
+_POLL_INTERVAL = 0.05
+
+
+class SingleFlight:
+    def __init__(self, directory: str = SINGLE_FLIGHT_DIR, enabled: bool = SINGLE_FLIGHT_ENABLED):
+        self.enabled = enabled
+        self.directory = directory
+        self.cross_process = enabled and fcntl is not None
+        self._inflight: Dict[Tuple, asyncio.Future] = {}
+        if self.cross_process:
+            os.makedirs(directory, exist_ok=True)
+            self._remove_expired()
+
+    async def run(self, key: Tuple, fn: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        """执行 fn 并返回结果；键相同的并发调用共享同一次执行"""
+        if not self.enabled:
+            return await fn()
+        future = self._inflight.get(key)
+        if future is not None:
+            # shield：某个等待方被取消时不影响正在进行的计算和其他等待方
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await (self._run_across_workers(key, fn) if self.cross_process else fn())
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            # 没有其他等待方时避免 "Future exception was never retrieved" 警告
+            future.exception()
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    def _remove_expired(self):
+        """删除进程退出前来不及删除的过期结果文件"""
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if name.endswith(".json") and now - os.stat(path).st_mtime > SINGLE_FLIGHT_RESULT_TTL:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _paths(self, key: Tuple) -> Tuple[str, str]:
+        name = hashlib.sha1(json.dumps(key, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{name}.lock"), os.path.join(self.directory, f"{name}.json")
+
+    async def _run_across_workers(self, key: Tuple, fn: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        lock_file, result_file = self._paths(key)
+        started = time.time()
+        deadline = time.monotonic() + SINGLE_FLIGHT_WAIT
+        while True:
+            result = self._read_result(result_file, started)
+            if result is not None:
+                return result
+            fd = self._try_lock(lock_file)
+            if fd is not None:
+                break
+            if time.monotonic() >= deadline:
+                print(f"等待其他 worker 的查重结果超时，自行计算: {key}")
+                return await fn()
+            await asyncio.sleep(_POLL_INTERVAL)
+
+        try:
+            result = await fn()
+            self._write_result(result_file, result)
+            return result
+        finally:
+            # 先删除锁文件再释放锁：等待方拿到锁后发现文件已被替换，会重新检查结果
+            try:
+                os.remove(lock_file)
+            except OSError:
+                pass
+            os.close(fd)
+
+    @staticmethod
+    def _try_lock(lock_file: str) -> Optional[int]:
+        """非阻塞地获取锁文件的 flock，锁被其他进程持有时返回 None"""
+        while True:
+            fd = os.open(lock_file, os.O_CREAT | os.O_RDWR, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return None
+            try:
+                # 加锁期间锁文件可能已被上一个持有者删除，此时打开的是失效的文件，需要重新打开
+                if os.fstat(fd).st_ino == os.stat(lock_file).st_ino:
+                    return fd
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    @staticmethod
+    def _read_result(result_file: str, started: float) -> Optional[Dict[str, Any]]:
+        """读取开始等待之后写入的结果，更早的结果属于之前的计算，不使用"""
+        try:
+            if os.stat(result_file).st_mtime < started:
+                return None
+            with open(result_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _write_result(result_file: str, result: Dict[str, Any]):
+        try:
+            tmp_file = f"{result_file}.tmp{os.getpid()}"
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(result, f, ensure_ascii=False, default=str)
+            os.replace(tmp_file, result_file)
+        except (OSError, TypeError, ValueError) as e:
+            print(f"写入查重结果文件失败: {e}")
+            return
+        asyncio.get_running_loop().call_later(SINGLE_FLIGHT_RESULT_TTL, _remove_quietly, result_file)
+
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
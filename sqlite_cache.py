@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from typing import Dict, Any, List, Optional, Sequence, Iterator
+
+# SQLite 单条语句中 IN 参数的最大个数
+SQLITE_BATCH = 500
+# 每写入多少次检查一次过期和条数上限
+_EVICT_EVERY = 200
+
+
+class SQLiteConnections:
+    """
+    多个 worker 进程共享的 SQLite 文件的连接（WAL 模式）
+
+    sqlite 连接不能跨线程/跨进程使用，按线程创建，fork 之后在子进程中重新创建；
+    schema 为建表语句，每个新连接执行一次
+    """
+
+    def __init__(self, path: str, schema: Sequence[str]):
+        self.path = path
+        self.schema = list(schema)
+        self._local = threading.local()
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def get(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            for statement in self.schema:
+                conn.execute(statement)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+
+def select_in(conn: sqlite3.Connection, sql: str, keys: List[str], params: Sequence[Any] = ()) -> Iterator[tuple]:
+    """按 SQLITE_BATCH 分批执行带 IN 条件的查询：sql 中的 {placeholders} 替换为本批的参数占位符，params 追加在本批键之后"""
+    for i in range(0, len(keys), SQLITE_BATCH):
+        batch = keys[i:i + SQLITE_BATCH]
+        yield from conn.execute(sql.format(placeholders=",".join("?" * len(batch))), [*batch, *params])
+
+
+class SQLiteCache:
+    """
+    多个 worker 进程共享的本地键值缓存
+
+    值以 JSON 保存在 SQLite（WAL 模式）中；超过 ttl 秒的条目视为未命中并在清理时删除，
+    条目数超过 max_entries 时按写入时间删除最旧的条目
+    """
+
+    def __init__(self, path: str, table: str, ttl: Optional[float] = None, max_entries: Optional[int] = None):
+        self.path = path
+        self.table = table
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._connections = SQLiteConnections(path, [
+            f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)",
+            f"CREATE INDEX IF NOT EXISTS {table}_created ON {table} (created)",
+        ])
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+
+    def _conn(self) -> sqlite3.Connection:
+        return self._connections.get()
+
+    def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        """批量读取，返回命中的 {key: value}"""
+        found = {}
+        min_created = time.time() - self.ttl if self.ttl else 0
+        try:
+            sql = f"SELECT key, value FROM {self.table} WHERE key IN ({{placeholders}}) AND created >= ?"
+            for key, value in select_in(self._conn(), sql, keys, [min_created]):
+                found[key] = json.loads(value)
+        except (sqlite3.Error, ValueError) as e:
+            print(f"读取缓存 {self.table} 失败: {e}")
+        return found
+
+    def get(self, key: str) -> Optional[Any]:
+        return self.get_many([key]).get(key)
+
+    def set_many(self, items: Dict[str, Any]):
+        """批量写入（覆盖已有条目）"""
+        if not items:
+            return
+        now = time.time()
+        try:
+            conn = self._conn()
+            with conn:
+                conn.executemany(f"INSERT OR REPLACE INTO {self.table} (key, value, created) VALUES (?, ?, ?)",
+                                 [(key, json.dumps(value, ensure_ascii=False), now) for key, value in items.items()])
+            with self._writes_lock:
+                self._writes += len(items)
+                evict = self._writes >= _EVICT_EVERY
+                if evict:
+                    self._writes = 0
+            if evict:
+                self.evict()
+        except sqlite3.Error as e:
+            print(f"写入缓存 {self.table} 失败: {e}")
+
+    def set(self, key: str, value: Any):
+        self.set_many({key: value})
+
+    def evict(self):
+        """删除过期条目，并把条目数控制在 max_entries 以内"""
+        conn = self._conn()
+        with conn:
+            if self.ttl:
+                conn.execute(f"DELETE FROM {self.table} WHERE created < ?", (time.time() - self.ttl,))
+            if self.max_entries:
+                count = conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+                if count > self.max_entries:
+                    conn.execute(f"DELETE FROM {self.table} WHERE key IN "
+                                 f"(SELECT key FROM {self.table} ORDER BY created LIMIT ?)",
+                                 (count - self.max_entries,))
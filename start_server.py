@@ -26,10 +26,23 @@ def start_development():
         "--port", "8000"
     ])
 
-def start_production():
+def start_embedding_server():
+    """启动独立的向量化服务进程，所有 worker 通过 Unix socket 共享同一份模型"""
+    socket_path = os.environ.setdefault("EMBEDDING_SERVER_SOCKET", "/tmp/dup_check_embedding.sock")
+    print(f"启动向量化服务: {socket_path}")
+    return subprocess.Popen([sys.executable, "embedding_server.py"])
+
+def start_production(embedding_server=False):
     """生产模式启动"""
     system = platform.system()
     print(f"检测到操作系统: {system}")
+
+    server_process = None
+    if embedding_server:
+        if system == "Windows":
+            print("Windows环境不支持Unix socket，忽略 --embedding-server")
+        else:
+            server_process = start_embedding_server()
     
     if system == "Windows":
         print("Windows环境下使用uvicorn多worker模式...")
@@ -44,11 +57,15 @@ def start_production():
     else:
         print("Unix环境下使用Gunicorn多Worker部署...")
         # Unix环境下使用gunicorn启动生产服务器
-        subprocess.run([
-            "gunicorn", 
-            "-c", "gunicorn.conf.py",
-            "api:app"
-        ])
+        try:
+            subprocess.run([
+                "gunicorn", 
+                "-c", "gunicorn.conf.py",
+                "api:app"
+            ])
+        finally:
+            if server_process is not None:
+                server_process.terminate()
 
 def main():
     parser = argparse.ArgumentParser(description="重复检测服务启动脚本")
@@ -58,13 +75,18 @@ def main():
         default="dev",
         help="运行模式: dev(开发模式) | prod(生产模式)"
     )
+    parser.add_argument(
+        "--embedding-server",
+        action="store_true",
+        help="生产模式下启动独立的向量化服务进程，所有worker共享一份模型并合并批量推理"
+    )
     
     args = parser.parse_args()
     
     if args.mode == "dev":
         start_development()
     elif args.mode == "prod":
-        start_production()
+        start_production(args.embedding_server)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,120 @@
+"""
+测试共用的替身：内存中的数据库和不需要模型的向量化
+
+FakeDB 按 db_client.DBClient 的接口返回数据，每行带有 updateTime 列，配置 DB_WATERMARK_COLUMN=updateTime 时作为水位列；
+HashEncoder 用字符二元组哈希生成向量，文本重合度越高向量越相似。
+"""
+import os
+import sys
+import zlib
+from typing import Any, Dict, List
+
+import numpy as np
+import pytest
+
+# 使用项目根目录下的模块（test 目录中有旧版本的同名文件）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db_client
+import vector_index_builder
+from db_client import TABLE_PK_MAP
+
+TEXT_COLUMNS = ["mainConsultContent", "title"]
+
+
+class HashEncoder:
+    def __init__(self, dim: int = 64):
+        self.dim = dim
+        self.encoded: List[str] = []
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+    def encode(self, texts, **kwargs) -> np.ndarray:
+        texts = [texts] if isinstance(texts, str) else list(texts)
+        self.encoded.extend(texts)
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for a, b in zip(text, text[1:]):
+                embeddings[i, zlib.crc32((a + b).encode("utf-8")) % self.dim] += 1.0
+            embeddings[i, 0] += 0.01  # 避免空文本得到零向量
+        return embeddings
+
+
+class FakeDB:
+    def __init__(self):
+        self.tables: Dict[str, Dict[int, Dict[str, Any]]] = {table: {} for table in TABLE_PK_MAP}
+        self.conn_params = {}
+
+    def put(self, table: str, pk: int, content: str, title: str = "标题", update_time: int = 1):
+        self.tables[table][pk] = {TABLE_PK_MAP[table]: pk, "mainConsultContent": content,
+                                  "title": title, "updateTime": update_time}
+
+    def delete(self, table: str, pk: int):
+        del self.tables[table][pk]
+
+    def _record(self, table: str, row: Dict[str, Any]) -> Dict[str, Any]:
+        pk = TABLE_PK_MAP[table]
+        return {pk: row[pk], **{col: row[col] for col in TEXT_COLUMNS}}
+
+    def clone(self) -> "FakeDB":
+        return self
+
+    def get_text_columns(self, table: str) -> List[str]:
+        return list(TEXT_COLUMNS)
+
+    def get_record_by_id(self, table: str, record_id: int):
+        row = self.tables[table].get(int(record_id))
+        return self._record(table, row) if row else None
+
+    def get_records_by_ids(self, table: str, record_ids):
+        rows = self.tables[table]
+        return [self._record(table, rows[int(i)]) for i in record_ids if int(i) in rows]
+
+    def get_all_records(self, table: str):
+        return [self._record(table, row) for row in self.tables[table].values()]
+
+    def get_max_watermark(self, table: str):
+        wcol = db_client.get_watermark_column(table)
+        return max((row[wcol] for row in self.tables[table].values()), default=None)
+
+    def get_records_since(self, table: str, watermark):
+        pk = TABLE_PK_MAP[table]
+        wcol = db_client.get_watermark_column(table)
+        rows = sorted((row for row in self.tables[table].values()
+                       if (row[wcol] > watermark if wcol == pk else row[wcol] >= watermark)),
+                      key=lambda row: row[wcol])
+        new_watermark = rows[-1][wcol] if rows else watermark
+        boundary_pks = {str(row[pk]) for row in rows if row[wcol] == new_watermark}
+        return [self._record(table, row) for row in rows], new_watermark, boundary_pks
+
+    def get_all_pks(self, table: str):
+        return {str(pk) for pk in self.tables[table]}
+
+    def get_binlog_position(self):
+        return None
+
+
+@pytest.fixture
+def db() -> FakeDB:
+    return FakeDB()
+
+
+@pytest.fixture
+def encoder() -> HashEncoder:
+    return HashEncoder()
+
+
+@pytest.fixture
+def builder(db, encoder, tmp_path, monkeypatch) -> vector_index_builder.VectorIndexBuilder:
+    """索引文件写在临时目录下的 vector_indexes 中"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(vector_index_builder, "get_embedding_model", lambda: encoder)
+    return vector_index_builder.VectorIndexBuilder(db)
+
+
+@pytest.fixture
+def updated_at(monkeypatch):
+    """以 updateTime 列作为水位列"""
+    monkeypatch.setattr(db_client, "WATERMARK_COLUMN", "updateTime")
+    monkeypatch.setattr(vector_index_builder, "WATERMARK_COLUMN", "updateTime")
@@ -0,0 +1,94 @@
+"""
+向量模型后端一致性测试
+
+用同一批文本分别以 torch 和指定后端（onnx / openvino）编码，比较两者向量的余弦相似度，
+并检查两个后端下近邻排序是否一致，同时给出编码耗时。
+
+用法：
+    EMBEDDING_BACKEND=openvino python test/embedding_backend_parity.py
+    python test/embedding_backend_parity.py --backend onnx --model-file onnx/model_qint8_avx512.onnx
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+# 使用项目根目录下的模块（test 目录中有旧版本的同名文件）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import embedding_backend
+
+DEFAULT_MODEL_PATH = r"/DB_Duplication_Check/sentence-transformers/all-MiniLM-L6-v2"
+
+SAMPLE_TEXTS = [
+    "杭州智能制造企业生产线数字化改造技术攻关需求",
+    "杭州智能制造企业生产线数字化改造合作研发诉求",
+    "现有设备精度不足，良品率只有60%左右，希望与高校或科研院所开展合作",
+    "目前依赖进口，采购周期长、成本高，计划申报省级科技项目",
+    "需要解决生产过程中数据无法互通的问题",
+    "配电网故障快速定位与自愈控制技术研究",
+    "变电站巡检机器人图像识别算法优化",
+    "新能源汽车充电桩负荷预测与有序充电管理",
+    "供电服务热线工单智能分类",
+    "Power grid load forecasting with deep learning",
+    "",
+    "短",
+]
+
+
+def _encode(model, texts, batch_size):
+    start = time.perf_counter()
+    embeddings = np.asarray(model.encode(texts, batch_size=batch_size), dtype=np.float32)
+    elapsed = time.perf_counter() - start
+    embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+    return embeddings, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="向量模型后端一致性测试")
+    parser.add_argument("--model-path", default=os.getenv("LOCAL_MODEL_PATH", DEFAULT_MODEL_PATH))
+    parser.add_argument("--backend", default=os.getenv("EMBEDDING_BACKEND", "openvino"), choices=["onnx", "openvino"])
+    parser.add_argument("--model-file", default=None, help="相对模型目录的模型文件，默认使用后端的默认文件")
+    parser.add_argument("--threshold", type=float, default=0.98, help="每条文本余弦相似度的下限")
+    parser.add_argument("--repeat", type=int, default=20, help="计时时重复样本的倍数")
+    args = parser.parse_args()
+
+    if args.model_file:
+        embedding_backend.EMBEDDING_MODEL_FILE = args.model_file
+    reference = embedding_backend.create_embedding_model(args.model_path, "torch")
+    candidate = embedding_backend.create_embedding_model(args.model_path, args.backend)
+
+    ref, _ = _encode(reference, SAMPLE_TEXTS, 32)
+    out, _ = _encode(candidate, SAMPLE_TEXTS, 32)
+    if ref.shape != out.shape:
+        print(f"❌ 向量维度不一致: torch {ref.shape}，{args.backend} {out.shape}")
+        sys.exit(1)
+
+    cosines = (ref * out).sum(axis=1)
+    for text, cos in zip(SAMPLE_TEXTS, cosines):
+        print(f"{cos:.5f}  {text[:30]!r}")
+
+    # 近邻排序：每条文本在其余文本中的最近邻应一致
+    ref_sim, out_sim = ref @ ref.T, out @ out.T
+    np.fill_diagonal(ref_sim, -np.inf)
+    np.fill_diagonal(out_sim, -np.inf)
+    same_neighbor = np.mean(ref_sim.argmax(axis=1) == out_sim.argmax(axis=1))
+
+    texts = SAMPLE_TEXTS * args.repeat
+    _, torch_seconds = _encode(reference, texts, 32)
+    _, backend_seconds = _encode(candidate, texts, 32)
+
+    print(f"\n最小余弦相似度: {cosines.min():.5f}，平均: {cosines.mean():.5f}")
+    print(f"最近邻一致比例: {same_neighbor:.2%}")
+    print(f"编码 {len(texts)} 条耗时: torch {torch_seconds:.2f}s，{args.backend} {backend_seconds:.2f}s")
+
+    if cosines.min() < args.threshold:
+        print(f"❌ 存在余弦相似度低于 {args.threshold} 的文本")
+        sys.exit(1)
+    print("✅ 一致性测试通过")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+向量检索阶段的离线基准测试
+
+生成带有人为近似重复的中文需求合成数据，按 1万/10万/100万 等规模为每种索引类型建索引，
+用 check_duplicates 中的联合检索（FederatedSearcher）逐条检索，
+统计 p50/p99 延迟、QPS、索引大小，以及相对 flat 精确检索结果的 recall@k。
+不需要 MySQL 和大模型；默认使用字符二元组哈希向量，--encoder model 时使用本地向量模型。
+
+用法：
+    python test/retrieval_benchmark.py --scales 10000,100000 --types flat,ivf_flat,hnsw
+"""
+import os
+import sys
+import time
+import zlib
+import random
+import argparse
+from typing import Dict, List, Tuple
+
+import numpy as np
+import faiss
+
+# 使用项目根目录下的模块（test 目录中有旧版本的同名文件）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ann_index
+from db_client import TABLE_PK_MAP
+from vector_index_builder import VectorIndexBuilder
+from multi_table_search import FederatedSearcher, VECTOR_TOP_K
+
+TABLE = "demandProposal"
+PK = TABLE_PK_MAP[TABLE]
+
+REGIONS = ["北京", "上海", "广州", "深圳", "杭州", "成都", "武汉", "西安", "南京", "重庆", "苏州", "合肥"]
+INDUSTRIES = ["智能制造", "新能源汽车", "生物医药", "集成电路", "人工智能", "现代农业",
+              "新材料", "节能环保", "数字经济", "航空航天", "高端装备", "食品加工"]
+TOPICS = ["关键零部件国产化", "生产线数字化改造", "检测设备研发", "生产工艺优化", "专业人才培训",
+          "工业数据平台建设", "供应链协同管理", "产品质量追溯", "能耗监测与节能降耗", "智能仓储物流"]
+DEMANDS = ["技术攻关", "合作研发", "成果转化", "技术咨询", "设备采购", "共建联合实验室"]
+DETAILS = [
+    "现有设备精度不足，良品率只有{n}%左右",
+    "希望与高校或科研院所开展合作",
+    "预计投入研发资金{n}0万元",
+    "要求在{m}个月内完成样机试制",
+    "目前依赖进口，采购周期长、成本高",
+    "需要解决生产过程中数据无法互通的问题",
+    "企业年产值约{n}亿元，员工{m}00余人",
+    "已有初步方案，缺少中试验证条件",
+    "希望引进成熟技术并提供后续运维服务",
+    "对环保和安全生产有较高要求",
+    "计划申报省级科技项目",
+    "产品主要出口东南亚市场，需满足当地认证标准",
+]
+# 近似重复时使用的同义替换
+SYNONYMS = [("需求", "诉求"), ("希望", "期望"), ("合作", "协作"), ("研发", "开发"),
+            ("解决", "处理"), ("目前", "现阶段"), ("计划", "准备")]
+
+
+def _detail(rng: random.Random) -> str:
+    return rng.choice(DETAILS).format(n=rng.randint(1, 99), m=rng.randint(1, 24))
+
+
+def make_record(rng: random.Random, pk: int) -> Dict:
+    name = f"{rng.choice(REGIONS)}{rng.choice(INDUSTRIES)}企业{rng.choice(TOPICS)}{rng.choice(DEMANDS)}需求"
+    content = "，".join(_detail(rng) for _ in range(rng.randint(3, 5))) + "。"
+    return {PK: pk, "demandName": name, "mainConsultContent": content}
+
+
+def make_near_duplicate(rng: random.Random, base: Dict, pk: int) -> Dict:
+    """在原记录上做同义替换、增删一句描述，模拟重复提交的需求"""
+    name, content = base["demandName"], base["mainConsultContent"].rstrip("。")
+    for old, new in rng.sample(SYNONYMS, 2):
+        name, content = name.replace(old, new), content.replace(old, new)
+    parts = content.split("，")
+    if len(parts) > 3 and rng.random() < 0.5:
+        parts.pop(rng.randrange(len(parts)))
+    else:
+        parts.insert(rng.randrange(len(parts) + 1), _detail(rng))
+    return {PK: pk, "demandName": name, "mainConsultContent": "，".join(parts) + "。"}
+
+
+def generate(n: int, dup_ratio: float, seed: int = 0):
+    """
+    生成 n 条记录，其中约 dup_ratio 比例是之前某条记录的近似重复
+    返回生成器，逐条产出 (记录, 被重复的原记录主键或 None)
+    """
+    rng = random.Random(seed)
+    recent: List[Dict] = []
+    for pk in range(1, n + 1):
+        if recent and rng.random() < dup_ratio:
+            base = rng.choice(recent)
+            yield make_near_duplicate(rng, base, pk), base[PK]
+        else:
+            record = make_record(rng, pk)
+            # 只保留最近一部分原记录作为重复的来源，控制内存
+            if len(recent) < 10000:
+                recent.append(record)
+            else:
+                recent[rng.randrange(len(recent))] = record
+            yield record, None
+
+
+class HashEncoder:
+    """字符二元组哈希向量：文本重合度越高向量越相似，无需模型即可模拟近似重复"""
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+        self._buckets: Dict[str, Tuple[int, float]] = {}
+
+    def _bucket(self, gram: str) -> Tuple[int, float]:
+        bucket = self._buckets.get(gram)
+        if bucket is None:
+            h = zlib.crc32(gram.encode("utf-8"))
+            bucket = self._buckets[gram] = (h % self.dim, 1.0 if (h >> 16) & 1 else -1.0)
+        return bucket
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        rows, cols, vals = [], [], []
+        for i, text in enumerate(texts):
+            for j in range(len(text) - 1):
+                col, sign = self._bucket(text[j:j + 2])
+                rows.append(i)
+                cols.append(col)
+                vals.append(sign)
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        np.add.at(embeddings, (np.array(rows), np.array(cols)), np.array(vals, dtype=np.float32))
+        return embeddings
+
+
+class ModelEncoder:
+    """本地句向量模型"""
+
+    def __init__(self):
+        from sentence_transformers import SentenceTransformer
+        model_path = os.getenv("LOCAL_MODEL_PATH", r"/DB_Duplication_Check/sentence-transformers/all-MiniLM-L6-v2")
+        self.model = SentenceTransformer(model_path)
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        return np.asarray(self.model.encode(texts, batch_size=256), dtype=np.float32)
+
+
+def build_dataset(n: int, encoder, dup_ratio: float, chunk: int = 10000):
+    """分块生成并向量化，只保留向量矩阵和重复关系，不在内存中保留全部文本"""
+    embeddings = None
+    duplicates: Dict[int, int] = {}
+    batch: List[Dict] = []
+
+    def _flush(start: int):
+        vecs = encoder.encode([VectorIndexBuilder.combine_text(TABLE, r) for r in batch])
+        faiss.normalize_L2(vecs)
+        embeddings[start:start + len(batch)] = vecs
+        batch.clear()
+
+    for record, base_pk in generate(n, dup_ratio):
+        if embeddings is None:
+            probe = encoder.encode(["维度探测"])
+            embeddings = np.zeros((n, probe.shape[1]), dtype=np.float32)
+        if base_pk is not None:
+            duplicates[record[PK]] = base_pk
+        batch.append(record)
+        if len(batch) >= chunk:
+            _flush(record[PK] - len(batch))
+    if batch:
+        _flush(n - len(batch))
+    return embeddings, duplicates
+
+
+def run_queries(searcher: FederatedSearcher, index, records, embeddings: np.ndarray,
+                query_pks: List[int], k: int) -> Tuple[List[List[int]], np.ndarray]:
+    """逐条检索（与 check_duplicates 的单条请求一致），返回每条的候选主键和耗时（秒）"""
+    pairs = {TABLE: (index, records)}
+    results, latencies = [], []
+    for pk in query_pks:
+        query = embeddings[pk - 1:pk]
+        start = time.perf_counter()
+        candidates = searcher.search(pairs, {TABLE: query}, k=k, exclude=[(TABLE, pk)])[0]
+        latencies.append(time.perf_counter() - start)
+        results.append([int(record[PK]) for _, _, record in candidates])
+    return results, np.array(latencies)
+
+
+def benchmark(n: int, index_types: List[str], encoder, args):
+    print(f"\n===== 规模 {n} =====")
+    start = time.perf_counter()
+    embeddings, duplicates = build_dataset(n, encoder, args.dup_ratio)
+    print(f"生成并向量化 {n} 条记录耗时 {time.perf_counter() - start:.1f}s，其中近似重复 {len(duplicates)} 条")
+
+    ids = np.arange(1, n + 1, dtype=np.int64)
+    # 检索只需要按主键取回记录，基准中只保留主键
+    records = {int(pk): {PK: int(pk)} for pk in ids}
+    rng = random.Random(1)
+    dup_pks = list(duplicates.keys())
+    query_pks = rng.sample(dup_pks, min(len(dup_pks), args.queries // 2))
+    query_pks += rng.sample(range(1, n + 1), min(n, args.queries - len(query_pks)))
+
+    searcher = FederatedSearcher()
+    truth = None
+    rows = []
+    # flat 是精确检索，作为其他类型的基准，总是第一个运行
+    for index_type in ["flat"] + [t for t in index_types if t != "flat"]:
+        start = time.perf_counter()
+        index = ann_index.build_index(embeddings, ids, index_type)
+        build_seconds = time.perf_counter() - start
+        overrides = {"nprobe": args.nprobe, "ef_search": args.ef_search}
+        ann_index.configure(index, {**ann_index.params_of(index),
+                                    **{key: v for key, v in overrides.items() if v is not None}})
+        size_mb = faiss.serialize_index(index).size / 1024 / 1024
+
+        run_queries(searcher, index, records, embeddings, query_pks[:args.warmup], args.k)
+        results, latencies = run_queries(searcher, index, records, embeddings, query_pks, args.k)
+        if truth is None:
+            truth = results
+
+        recall = np.mean([len(set(r) & set(t)) / len(t) for r, t in zip(results, truth) if t])
+        found = [duplicates[pk] in r for pk, r in zip(query_pks, results) if pk in duplicates]
+        dup_recall = np.mean(found) if found else float("nan")
+        rows.append((index_type, build_seconds, size_mb,
+                     np.percentile(latencies, 50) * 1000, np.percentile(latencies, 99) * 1000,
+                     len(latencies) / latencies.sum(), recall, dup_recall))
+        if index_type in index_types:
+            print(f"{index_type} 完成：{ann_index.params_of(index)}")
+        del index
+
+    print(f"\n{'类型':<10}{'构建(s)':>10}{'大小(MB)':>10}{'p50(ms)':>10}{'p99(ms)':>10}"
+          f"{'QPS':>10}{f'recall@{args.k}':>12}{'重复召回':>10}")
+    for index_type, build_s, size_mb, p50, p99, qps, recall, dup_recall in rows:
+        if index_type not in index_types:
+            continue
+        print(f"{index_type:<10}{build_s:>10.1f}{size_mb:>10.1f}{p50:>10.2f}{p99:>10.2f}"
+              f"{qps:>10.0f}{recall:>12.3f}{dup_recall:>10.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="向量检索离线基准测试")
+    parser.add_argument("--scales", default="10000,100000,1000000", help="数据规模，逗号分隔")
+    parser.add_argument("--types", default=",".join(ann_index.INDEX_TYPES), help="索引类型，逗号分隔")
+    parser.add_argument("--encoder", choices=["hash", "model"], default="hash", help="向量化方式")
+    parser.add_argument("--k", type=int, default=VECTOR_TOP_K, help="每条查询的候选数")
+    parser.add_argument("--queries", type=int, default=1000, help="查询条数，约一半为近似重复记录")
+    parser.add_argument("--warmup", type=int, default=50, help="预热查询条数")
+    parser.add_argument("--dup-ratio", type=float, default=0.05, help="近似重复记录的比例")
+    parser.add_argument("--nprobe", type=int, default=None, help="覆盖 IVF 的 nprobe")
+    parser.add_argument("--ef-search", type=int, default=None, help="覆盖 HNSW 的 efSearch")
+    parser.add_argument("--threads", type=int, default=None, help="FAISS 使用的线程数")
+    args = parser.parse_args()
+
+    if args.threads:
+        faiss.omp_set_num_threads(args.threads)
+    encoder = HashEncoder() if args.encoder == "hash" else ModelEncoder()
+    index_types = [t.strip() for t in args.types.split(",") if t.strip()]
+    for n in [int(s) for s in args.scales.split(",")]:
+        benchmark(n, index_types, encoder, args)
+
+
+if __name__ == "__main__":
+    main()
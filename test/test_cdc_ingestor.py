@@ -0,0 +1,140 @@
+"""
+CDC 逐行同步（cdc_ingestor.CDCIngestor）的行为测试
+
+用本地回放文件（ReplayFileChangeSource）代替 binlog，变更逐条经 apply_change 应用到 IndexRefresher 的快照，
+检查快照内容、flush 落盘的索引文件和 cdc_position.json，以及重复应用和断点续传。
+使用 conftest.py 中内存数据库和哈希向量的替身，不需要 MySQL 和向量模型。
+
+用法：
+    python -m pytest test/test_cdc_ingestor.py
+"""
+import os
+import json
+
+import faiss
+
+from cdc_ingestor import CDCIngestor, ReplayFileChangeSource
+from index_refresher import IndexRefresher
+
+CHANGES = [
+    {"table": "demandProposal", "op": "insert",
+     "row": {"idDemandProposal": 1, "mainConsultContent": "配电网故障定位需求", "title": "故障定位", "status": 0}},
+    {"table": "demandProposal", "op": "insert",
+     "row": {"idDemandProposal": 2, "mainConsultContent": "储能电站运维需求", "title": "储能", "status": 0}},
+    {"table": "demandProposal", "op": "update",
+     "row": {"idDemandProposal": 1, "mainConsultContent": "变电站巡检机器人需求", "title": "巡检", "status": 1}},
+    {"table": "demandProposal", "op": "delete",
+     "row": {"idDemandProposal": 2, "mainConsultContent": "储能电站运维需求", "title": "储能", "status": 0}},
+    {"table": "demandPlan", "op": "insert",
+     "row": {"idDemandPlan": 7, "mainConsultContent": "光伏组件检测方案", "title": None}},
+    {"table": "otherTable", "op": "insert", "row": {"id": 1}},
+    {"table": "demandCollection", "op": "delete", "row": {"idDemandCollection": 9}},
+]
+
+
+def _write_replay(path: str, changes):
+    with open(path, "a", encoding="utf-8") as f:
+        for change in changes:
+            f.write(json.dumps(change, ensure_ascii=False) + "\n")
+
+
+def _replay(ingestor: CDCIngestor, source: ReplayFileChangeSource):
+    for change, position in source.changes(ingestor._position):
+        ingestor.apply_change(change, position)
+
+
+def _contents(snapshot):
+    return {table: {pk: dict(record) for pk, record in records.items()}
+            for table, (_, records) in snapshot.items()}
+
+
+EXPECTED = {
+    "demandProposal": {1: {"idDemandProposal": 1, "mainConsultContent": "变电站巡检机器人需求", "title": "巡检"}},
+    "demandPlan": {7: {"idDemandPlan": 7, "mainConsultContent": "光伏组件检测方案", "title": None}},
+}
+
+
+def test_replay_file_applies_changes_and_persists_position(builder, encoder, tmp_path):
+    replay_file = str(tmp_path / "replay.jsonl")
+    _write_replay(replay_file, CHANGES)
+    refresher = IndexRefresher(builder, interval=None, shared=False, in_place=True)
+    source = ReplayFileChangeSource(replay_file, follow=False)
+    ingestor = CDCIngestor(builder, refresher, source)
+    ingestor.prepare()
+    assert ingestor._position == {"source": "replay", "path": replay_file, "offset": 0}
+
+    # 快照中原本没有任何表，插入时为表新建索引并发布
+    _replay(ingestor, source)
+    snapshot = refresher.snapshot()
+    assert _contents(snapshot) == EXPECTED
+    index = snapshot["demandProposal"][0]
+    query = encoder.encode(["变电站巡检机器人需求 巡检"])
+    faiss.normalize_L2(query)
+    _, ids = index.search(query, 1)
+    assert ids[0][0] == 1
+    assert ingestor._dirty == {"demandProposal", "demandPlan"}
+
+    ingestor.flush()
+    assert not ingestor._dirty
+    with open(ingestor.position_file, encoding="utf-8") as f:
+        assert json.load(f) == {"source": "replay", "path": replay_file, "offset": os.path.getsize(replay_file)}
+    for table, records in EXPECTED.items():
+        _, saved = builder.load_index(table)
+        assert {pk: dict(r) for pk, r in saved.items()} == records
+
+    # 从头重复应用同样的变更，结果不变
+    ingestor._position = source.initial_position()
+    _replay(ingestor, source)
+    assert _contents(refresher.snapshot()) == EXPECTED
+    # 已生效的变更再次应用时不重新向量化，也不标记需要落盘
+    ingestor.flush()
+    encoded = len(encoder.encoded)
+    for change in CHANGES[2:]:
+        ingestor.apply_change(change)
+    assert len(encoder.encoded) == encoded
+    assert not ingestor._dirty
+
+
+def test_restart_resumes_from_saved_position(builder, encoder, tmp_path):
+    replay_file = str(tmp_path / "replay.jsonl")
+    _write_replay(replay_file, CHANGES)
+    refresher = IndexRefresher(builder, interval=None, shared=False, in_place=True)
+    ingestor = CDCIngestor(builder, refresher, ReplayFileChangeSource(replay_file, follow=False))
+    ingestor.prepare()
+    _replay(ingestor, ingestor.source)
+    ingestor.flush()
+
+    # 重启：从落盘的索引和消费位置继续，只应用之后追加的变更
+    _write_replay(replay_file, [{"table": "demandProposal", "op": "update",
+                                 "row": {"idDemandProposal": 1, "mainConsultContent": "配网自动化终端需求",
+                                         "title": "配网自动化"}}])
+    refresher = IndexRefresher(builder, interval=None, shared=False, in_place=True)
+    refresher.refresh()
+    ingestor = CDCIngestor(builder, refresher, ReplayFileChangeSource(replay_file, follow=False))
+    ingestor.prepare()
+    encoded = len(encoder.encoded)
+    _replay(ingestor, ingestor.source)
+    assert encoder.encoded[encoded:] == ["配网自动化终端需求 配网自动化"]
+    records = refresher.snapshot()["demandProposal"][1]
+    assert list(records) == [1] and records[1]["mainConsultContent"] == "配网自动化终端需求"
+    assert ingestor._position["offset"] == os.path.getsize(replay_file)
+
+
+def test_applied_changes_bump_snapshot_generation(builder, tmp_path):
+    refresher = IndexRefresher(builder, interval=None, shared=False, in_place=True)
+    ingestor = CDCIngestor(builder, refresher, ReplayFileChangeSource(str(tmp_path / "replay.jsonl"), follow=False))
+    ingestor.apply_change(CHANGES[0])
+    generation = refresher.generation
+    assert ingestor.has_unsaved_changes()
+
+    # 内容没有变化、或不涉及索引的变更不改变代数
+    for change in (CHANGES[0], CHANGES[5], CHANGES[6]):
+        ingestor.apply_change(change)
+    assert refresher.generation == generation
+
+    ingestor.apply_change(CHANGES[2])
+    assert refresher.generation == generation + 1
+    file_generation = builder.known_generation()
+    ingestor.flush()
+    assert not ingestor.has_unsaved_changes()
+    assert builder.known_generation() == builder.read_generation() == file_generation + 1
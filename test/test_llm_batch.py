@@ -0,0 +1,113 @@
+"""
+合并比对（llm_client 的 build_batch_prompt / chunk_by_token_budget / parse_batch_output）的行为测试
+
+覆盖模型输出乱序、缺项、重复编号和非 JSON 时的解析，按 token 预算分组的边界，
+以及 compare_many_async 对缺失候选逐条补比、结果缓存命中后不再调用。不需要访问大模型。
+
+用法：
+    python -m pytest test/test_llm_batch.py
+"""
+import os
+import sys
+import json
+import asyncio
+
+import pytest
+
+# 使用项目根目录下的模块（test 目录中有旧版本的同名文件）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llm_client
+from llm_client import (LLMClient, build_batch_prompt, chunk_by_token_budget, estimate_tokens,
+                        parse_batch_output, _BATCH_TOKENS_PER_CANDIDATE)
+
+FIELD = "mainConsultContent"
+
+
+def _items(*items) -> str:
+    return json.dumps([{"id": i, "score": s, "reason": r} for i, s, r in items], ensure_ascii=False)
+
+
+def test_build_batch_prompt_numbers_candidates_from_one():
+    prompt = build_batch_prompt("目标", ["甲", "乙"], FIELD)
+    assert "2 个候选文本" in prompt
+    assert "[1] 甲\n[2] 乙" in prompt
+    assert "目标文本: 目标" in prompt
+
+
+def test_parse_out_of_order_and_fenced_output():
+    raw = "```json\n" + _items((3, 20, "c"), (1, 90, "a"), (2, 55, "b")) + "\n```"
+    assert parse_batch_output(raw, 3) == {1: {"score": 90, "reason": "a"},
+                                          2: {"score": 55, "reason": "b"},
+                                          3: {"score": 20, "reason": "c"}}
+    # {"results": [...]} 形式和字符串形式的数字
+    raw = json.dumps({"results": [{"id": "2", "score": "70", "reason": "b"}]})
+    assert parse_batch_output(raw, 2) == {2: {"score": 70, "reason": "b"}}
+
+
+def test_parse_missing_invalid_and_out_of_range_items():
+    raw = json.dumps([{"id": 1, "score": 80},                      # 缺少 reason 时为 "无"
+                      {"id": 2},                                    # 缺少 score
+                      {"id": 3, "score": "高", "reason": "x"},      # score 不是数字
+                      "[4] 90",                                     # 不是对象
+                      {"id": 0, "score": 10, "reason": "x"},        # 编号越界
+                      {"id": 6, "score": 10, "reason": "x"}])
+    assert parse_batch_output(raw, 5) == {1: {"score": 80, "reason": "无"}}
+    assert parse_batch_output(json.dumps({"score": 80}), 1) == {}
+    assert parse_batch_output("[]", 3) == {}
+
+
+def test_parse_repeated_id_is_dropped():
+    raw = _items((1, 90, "a"), (2, 10, "b"), (1, 20, "a2"))
+    assert parse_batch_output(raw, 2) == {2: {"score": 10, "reason": "b"}}
+
+
+def test_parse_non_json_raises():
+    for raw in ("抱歉，我无法完成比对", "", "[{\"id\": 1, \"score\": 90"):
+        with pytest.raises(ValueError):
+            parse_batch_output(raw, 1)
+
+
+def _fixed(text1: str) -> int:
+    return estimate_tokens(build_batch_prompt(text1, [], FIELD))
+
+
+def test_chunk_boundaries():
+    text1 = "目标文本"
+    fixed = _fixed(text1)
+    cost = 10 + _BATCH_TOKENS_PER_CANDIDATE
+    texts = ["字" * 10] * 5
+
+    # 恰好用满预算的候选仍在同一组，多一个 token 即分到下一组
+    assert chunk_by_token_budget(text1, texts, FIELD, budget=fixed + 3 * cost, max_candidates=10) == [[0, 1, 2], [3, 4]]
+    assert chunk_by_token_budget(text1, texts, FIELD, budget=fixed + 3 * cost - 1, max_candidates=10) == [[0, 1], [2, 3], [4]]
+    # 候选数上限
+    assert chunk_by_token_budget(text1, texts, FIELD, budget=10 ** 6, max_candidates=2) == [[0, 1], [2, 3], [4]]
+    # 单个候选超出预算时独占一组，不影响前后的分组
+    texts = ["字" * 10, "字" * 1000, "字" * 10, "字" * 10]
+    assert chunk_by_token_budget(text1, texts, FIELD, budget=fixed + 2 * cost, max_candidates=10) == [[0], [1], [2, 3]]
+    assert chunk_by_token_budget(text1, [], FIELD) == []
+
+
+def test_compare_many_async_falls_back_for_missing_items(tmp_path, monkeypatch):
+    monkeypatch.setattr(llm_client, "LLM_CACHE_PATH", str(tmp_path / "verdicts.sqlite3"))
+    client = LLMClient()
+    prompts = []
+
+    async def fake_call(prompt: str) -> str:
+        prompts.append(prompt)
+        if "个候选文本" in prompt:
+            # 乱序、缺少第 2 项、第 3 项编号重复
+            return _items((4, 30, "d"), (1, 90, "a"), (3, 60, "c"), (3, 61, "c"))
+        return json.dumps({"score": 50, "reason": "单独比对"}, ensure_ascii=False)
+
+    monkeypatch.setattr(client, "_call_async", fake_call)
+    texts = ["甲", "乙", "丙", "丁"]
+    verdicts = asyncio.run(client.compare_many_async("目标", texts, FIELD))
+    assert verdicts == [{"score": 90, "reason": "a"}, {"score": 50, "reason": "单独比对"},
+                        {"score": 50, "reason": "单独比对"}, {"score": 30, "reason": "d"}]
+    assert len(prompts) == 3
+
+    # 全部命中缓存，不再调用大模型
+    assert asyncio.run(client.compare_many_async("目标", texts, FIELD)) == verdicts
+    assert len(prompts) == 3
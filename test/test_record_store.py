@@ -0,0 +1,136 @@
+"""
+列式记录存储（record_store.RecordStore）的行为测试
+
+覆盖写入后读回（含负数和很大的主键、空值、中文）、内存映射打开、覆盖层的删除与重新插入、
+覆盖层落盘后重新打开，以及空存储。不需要数据库和向量模型。
+
+用法：
+    python -m pytest test/test_record_store.py
+    python test/test_record_store.py
+"""
+import os
+import sys
+import random
+import tempfile
+
+import numpy as np
+
+# 使用项目根目录下的模块（test 目录中有旧版本的同名文件）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from record_store import RecordStore
+
+PK = "idDemandProposal"
+
+
+def _record(pk: int, content, title="标题") -> dict:
+    return {PK: pk, "mainConsultContent": content, "title": title}
+
+
+def _write_and_open(records, mmap: bool) -> RecordStore:
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "records.dat")
+    RecordStore.write(path, PK, records)
+    return RecordStore.open(path, mmap=mmap)
+
+
+def test_round_trip():
+    records = [
+        _record(1, "配电网故障定位需求"),
+        _record(-7, "负数主键", None),
+        _record(2 ** 62 + 3, "很大的主键"),
+        _record(-2 ** 63 + 1, "最小附近的主键"),
+        _record(0, "", "空字符串与 None 不同"),
+        _record(42, None, None),
+    ]
+    for mmap in (False, True):
+        store = _write_and_open(records, mmap)
+        assert len(store) == len(records)
+        assert set(store) == {r[PK] for r in records}
+        for record in records:
+            pk = record[PK]
+            assert pk in store
+            assert np.int64(pk) in store
+            assert dict(store[pk]) == record
+            assert store[pk] == record
+            assert store[np.int64(pk)][PK] == pk
+        for missing in (2, -8, 2 ** 62, "1"):
+            assert missing not in store
+            try:
+                store[missing]
+                assert False, f"主键 {missing!r} 不应存在"
+            except KeyError:
+                pass
+
+
+def test_many_keys_with_collisions():
+    rng = random.Random(0)
+    pks = rng.sample(range(-10 ** 12, 10 ** 12), 5000) + list(range(1000, 2000))
+    records = [_record(pk, f"内容{pk}") for pk in pks]
+    store = _write_and_open(records, mmap=True)
+    assert len(store) == len(pks)
+    for pk in pks:
+        assert store[pk]["mainConsultContent"] == f"内容{pk}"
+    present = set(pks)
+    for pk in rng.sample(range(-10 ** 12, 10 ** 12), 2000):
+        assert (pk in store) == (pk in present)
+
+
+def test_overlay_delete_and_reinsert():
+    store = _write_and_open([_record(1, "a"), _record(2, "b"), _record(-3, "c")], mmap=True)
+
+    del store[2]
+    assert 2 not in store
+    assert len(store) == 2
+    assert set(store) == {1, -3}
+    try:
+        del store[2]
+        assert False, "重复删除应抛出 KeyError"
+    except KeyError:
+        pass
+
+    store[2] = _record(2, "b2")
+    assert store[2]["mainConsultContent"] == "b2"
+    assert len(store) == 3
+
+    # 覆盖已有主键、插入新主键、删除后再插入新主键
+    store[1] = _record(1, "a2")
+    store[10] = _record(10, "new")
+    del store[10]
+    assert 10 not in store
+    store[10] = _record(10, "new2")
+    assert len(store) == 4
+    assert store.pop(-3)["mainConsultContent"] == "c"
+    assert set(store) == {1, 2, 10}
+    assert len(store) == 3
+
+    # 覆盖层落盘后重新打开，内容一致
+    path = os.path.join(tempfile.mkdtemp(), "records.dat")
+    store.save(path, PK)
+    reopened = RecordStore.open(path, mmap=True)
+    assert {pk: dict(r) for pk, r in reopened.items()} == {pk: dict(r) for pk, r in store.items()}
+    assert reopened[1]["mainConsultContent"] == "a2"
+    assert -3 not in reopened
+
+
+def test_empty_store():
+    store = RecordStore()
+    assert len(store) == 0
+    assert list(store) == []
+    assert 5 not in store
+    store[5] = _record(5, "x")
+    assert len(store) == 1 and store[5]["mainConsultContent"] == "x"
+
+    for mmap in (False, True):
+        empty = _write_and_open([], mmap)
+        assert len(empty) == 0
+        assert list(empty) == []
+        assert 0 not in empty
+        assert empty.get(1) is None
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+            print(f"{name} 通过")
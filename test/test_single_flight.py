@@ -0,0 +1,146 @@
+"""
+相同查重请求合并（single_flight.SingleFlight）的行为测试
+
+覆盖同一 worker 内并发的相同请求只计算一次、计算失败时每个等待方都收到同一异常、
+不同的键分别计算，以及多个 worker 进程之间通过锁文件只计算一次。不需要数据库和向量模型。
+
+用法：
+    python -m pytest test/test_single_flight.py
+    python test/test_single_flight.py
+"""
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 使用项目根目录下的模块（test 目录中有旧版本的同名文件）
+sys.path.insert(0, ROOT)
+
+from single_flight import SingleFlight, fcntl
+
+KEY = ("demandProposal", 123, 7)
+
+
+async def _gather_same_key(flight: SingleFlight, fn, n: int = 10):
+    return await asyncio.gather(*(flight.run(KEY, fn) for _ in range(n)), return_exceptions=True)
+
+
+def _counting_fn(calls: list, delay: float = 0.2):
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        return {"duplicates": [{"id": 1, "score": 0.93}], "call": len(calls)}
+    return fn
+
+
+def test_concurrent_same_key_runs_once():
+    for cross_process in (False, True):
+        flight = SingleFlight(directory=tempfile.mkdtemp())
+        flight.cross_process = cross_process and fcntl is not None
+        calls = []
+        results = asyncio.run(_gather_same_key(flight, _counting_fn(calls)))
+        assert len(calls) == 1
+        assert all(r == results[0] for r in results)
+        assert results[0]["call"] == 1
+        assert not flight._inflight
+
+        # 上一次计算结束后再次请求会重新计算，结果不被缓存
+        results = asyncio.run(_gather_same_key(flight, _counting_fn(calls), n=3))
+        assert len(calls) == 2
+        assert all(r["call"] == 2 for r in results)
+
+
+def test_error_propagates_to_every_waiter():
+    for cross_process in (False, True):
+        flight = SingleFlight(directory=tempfile.mkdtemp())
+        flight.cross_process = cross_process and fcntl is not None
+        calls = []
+
+        async def failing():
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            raise ValueError("大模型调用失败")
+
+        results = asyncio.run(_gather_same_key(flight, failing))
+        assert len(calls) == 1
+        assert all(isinstance(r, ValueError) and str(r) == "大模型调用失败" for r in results)
+        assert not flight._inflight
+
+        # 失败不会留下结果，下一次请求重新计算
+        results = asyncio.run(_gather_same_key(flight, _counting_fn(calls), n=2))
+        assert len(calls) == 2
+        assert all(r["call"] == 2 for r in results)
+
+
+def test_different_keys_run_separately():
+    flight = SingleFlight(directory=tempfile.mkdtemp())
+    calls = []
+
+    async def main():
+        fn = _counting_fn(calls)
+        return await asyncio.gather(flight.run(("demandProposal", 1, 7), fn),
+                                    flight.run(("demandProposal", 2, 7), fn),
+                                    flight.run(("demandProposal", 1, 8), fn))
+
+    asyncio.run(main())
+    assert len(calls) == 3
+
+
+def test_disabled_runs_every_call():
+    flight = SingleFlight(directory=tempfile.mkdtemp(), enabled=False)
+    calls = []
+    results = asyncio.run(_gather_same_key(flight, _counting_fn(calls, delay=0.05), n=4))
+    assert len(calls) == 4
+    assert sorted(r["call"] for r in results) == [4, 4, 4, 4]
+
+
+# 在独立进程中执行的 worker：约定时刻同时发起相同请求，计算时向 calls 文件追加一行
+_WORKER = r"""
+import sys, time, json, asyncio
+sys.path.insert(0, sys.argv[1])
+from single_flight import SingleFlight
+
+directory, calls_file, start_at = sys.argv[2], sys.argv[3], float(sys.argv[4])
+
+async def compute():
+    with open(calls_file, "a") as f:
+        f.write("1\n")
+    await asyncio.sleep(1.0)
+    return {"duplicates": [{"id": 1, "score": 0.93}]}
+
+async def main():
+    flight = SingleFlight(directory=directory)
+    time.sleep(max(0.0, start_at - time.time()))
+    print(json.dumps(await flight.run(("demandProposal", 123, 7), compute)))
+
+asyncio.run(main())
+"""
+
+
+def test_workers_on_same_host_run_once():
+    if fcntl is None:
+        print("当前平台没有 flock，跳过跨 worker 测试")
+        return
+    directory = tempfile.mkdtemp()
+    calls_file = os.path.join(directory, "calls.txt")
+    start_at = time.time() + 1.0
+    workers = [
+        subprocess.Popen([sys.executable, "-c", _WORKER, ROOT, directory, calls_file, str(start_at)],
+                         stdout=subprocess.PIPE, text=True)
+        for _ in range(4)
+    ]
+    outputs = [w.communicate(timeout=60)[0].strip() for w in workers]
+    assert all(w.returncode == 0 for w in workers)
+    with open(calls_file) as f:
+        assert len(f.readlines()) == 1
+    assert len(set(outputs)) == 1 and '"score": 0.93' in outputs[0]
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+            print(f"{name} 通过")
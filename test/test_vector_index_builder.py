@@ -0,0 +1,142 @@
+"""
+向量索引增量更新（vector_index_builder.VectorIndexBuilder）的行为测试
+
+使用 conftest.py 中内存数据库和哈希向量的替身，不需要 MySQL 和向量模型。
+
+用法：
+    python -m pytest test/test_vector_index_builder.py
+"""
+import faiss
+import numpy as np
+import pytest
+
+import ann_index
+from db_client import TABLE_PK_MAP
+from multi_table_search import FederatedSearcher
+from vector_index_builder import VectorIndexBuilder
+
+TABLE = "demandProposal"
+
+
+def _count_loads(builder, monkeypatch) -> list:
+    loads = []
+    load_index = builder.load_index
+
+    def counting(table, mmap=False):
+        loads.append(table)
+        return load_index(table, mmap=mmap)
+
+    monkeypatch.setattr(builder, "load_index", counting)
+    return loads
+
+
+def test_refresh_without_changes_does_not_load_index(builder, db, encoder, updated_at, monkeypatch):
+    # 多行处于同一水位上，按 >= 拉取时每次都会重新拉到；其他表为空
+    for pk in range(1, 6):
+        db.put(TABLE, pk, f"配电网故障定位需求{pk}", update_time=100)
+    db.put(TABLE, 6, "储能电站运维需求", update_time=90)
+    builder.update_all_indexes_incremental()
+    generation = builder.read_generation()
+    loads = _count_loads(builder, monkeypatch)
+    encoded = len(encoder.encoded)
+
+    for _ in range(3):
+        assert builder.update_all_indexes_incremental(skip_unchanged=TABLE_PK_MAP) == {}
+    assert loads == []
+    assert builder.read_generation() == generation
+    assert len(encoder.encoded) == encoded
+
+    # 与水位同一时刻的修改仍能被发现，应用后再次刷新不再读取索引文件
+    db.put(TABLE, 3, "变电站巡检机器人需求", update_time=100)
+    updated = builder.update_all_indexes_incremental(skip_unchanged=TABLE_PK_MAP)
+    assert list(updated) == [TABLE] and loads == [TABLE]
+    assert updated[TABLE][1][3]["mainConsultContent"] == "变电站巡检机器人需求"
+    assert encoder.encoded[encoded:] == ["变电站巡检机器人需求 标题"]
+    assert builder.update_all_indexes_incremental(skip_unchanged=TABLE_PK_MAP) == {}
+    assert loads == [TABLE]
+
+
+def test_empty_table_is_not_full_diffed_every_refresh(builder, db, updated_at, monkeypatch):
+    builder.update_all_indexes_incremental()
+    loads = _count_loads(builder, monkeypatch)
+    full_diffs = []
+    get_all_records = db.get_all_records
+    monkeypatch.setattr(db, "get_all_records", lambda table: full_diffs.append(table) or get_all_records(table))
+
+    for _ in range(3):
+        assert builder.update_all_indexes_incremental(skip_unchanged=TABLE_PK_MAP) == {}
+    assert loads == [] and full_diffs == []
+
+    # 表中出现记录后全量比对一次取得水位，之后按水位增量拉取
+    db.put(TABLE, 1, "配电网故障定位需求", update_time=5)
+    updated = builder.update_all_indexes_incremental(skip_unchanged=TABLE_PK_MAP)
+    assert list(updated) == [TABLE] and 1 in updated[TABLE][1]
+    assert full_diffs == [TABLE]
+    assert builder.load_meta(TABLE)["watermark"] == 5
+    assert builder.update_all_indexes_incremental(skip_unchanged=TABLE_PK_MAP) == {}
+    assert full_diffs == [TABLE] and loads == [TABLE]
+
+
+def _record(pk: int, content: str) -> dict:
+    return {TABLE_PK_MAP[TABLE]: pk, "mainConsultContent": content, "title": f"标题{pk % 7}"}
+
+
+def _query(encoder, record: dict) -> np.ndarray:
+    query = encoder.encode([VectorIndexBuilder.combine_text(TABLE, record)])
+    faiss.normalize_L2(query)
+    return query
+
+
+def _search(index, records, query, k: int = 5) -> list:
+    hits = FederatedSearcher().search({TABLE: (index, records)}, {TABLE: query}, k=k)[0]
+    return [record[TABLE_PK_MAP[TABLE]] for _, _, record in hits]
+
+
+@pytest.mark.parametrize("index_type", ann_index.INDEX_TYPES)
+def test_upsert_and_delete_by_pk(builder, encoder, index_type):
+    records = {pk: _record(pk, f"{pk}号配电网设备需求{pk * 7919 % 1000}") for pk in range(1, 301)}
+    embeddings = encoder.encode([VectorIndexBuilder.combine_text(TABLE, r) for r in records.values()])
+    faiss.normalize_L2(embeddings)
+    index = ann_index.build_index(embeddings, np.array(list(records), dtype=np.int64), index_type)
+    assert ann_index.index_type_of(index) == index_type
+    if index_type in ("ivf_flat", "ivf_pq"):
+        assert faiss.extract_index_ivf(index).direct_map.type == faiss.DirectMap.Hashtable
+    removable = ann_index.supports_remove(index)
+    assert removable == (index_type != "hnsw")
+    ntotal = index.ntotal
+    encoded = len(encoder.encoded)
+
+    # 文本没有变化：不重新向量化，也不写索引
+    assert not builder.upsert_record(TABLE, index, records, dict(records[5]))
+    assert len(encoder.encoded) == encoded and index.ntotal == ntotal
+
+    # 修改：按主键替换向量；HNSW 不能删除，旧向量留到压缩重建，检索时同一主键只返回一次
+    updated = _record(5, "变电站巡检机器人需求")
+    assert builder.upsert_record(TABLE, index, records, updated)
+    assert records[5] == updated
+    assert index.ntotal == (ntotal if removable else ntotal + 1)
+    query = _query(encoder, updated)
+    hits = _search(index, records, query)
+    assert hits.count(5) == 1
+    if ann_index.stores_exact_vectors(index):
+        assert hits[0] == 5
+        assert np.allclose(index.reconstruct(5), query[0], atol=1e-5)
+
+    # 新主键（包括很大的主键）
+    added = _record(2 ** 40, "光伏组件检测方案")
+    assert builder.upsert_record(TABLE, index, records, added)
+    assert 2 ** 40 in _search(index, records, _query(encoder, added))
+
+    # 删除：只移除记录，向量留到压缩，检索时跳过
+    deleted = records[7]
+    assert builder.delete_record(TABLE, records, 7)
+    assert not builder.delete_record(TABLE, records, 7)
+    assert 7 not in records
+    assert VectorIndexBuilder.orphan_count(index, records) == (1 if removable else 2)
+    assert 7 not in _search(index, records, _query(encoder, deleted))
+
+    # 压缩后索引中只剩当前记录的向量
+    compacted = builder.compact_index(TABLE, index, records)
+    assert compacted.ntotal == len(records)
+    assert set(ann_index.index_ids(compacted).tolist()) == set(records)
+    assert _search(compacted, records, query).count(5) == 1
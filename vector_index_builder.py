@@ -1,22 +1,41 @@
 import os
 import json
-from typing import Dict, Tuple, List, Any, Optional
+import time
+import hashlib
+from typing import Dict, Tuple, List, Any, Optional, Iterable, Mapping, MutableMapping
 
 import faiss
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from db_client import DBClient, TABLE_PK_MAP
+from db_client import DBClient, TABLE_PK_MAP, WATERMARK_COLUMN, get_watermark_column
+from embedding_service import get_embedding_model
+import ann_index
+from record_store import RecordStore
 import pickle
 
+# 表记录：主键 -> 记录（主键 + text 列），主键同时作为向量在索引中的ID；
+# 从磁盘加载时为列式的 RecordStore，新构建或新建的表为普通字典
+Records = MutableMapping[int, Mapping[str, Any]]
+
+# 未配置 DB_WATERMARK_COLUMN 时按自增主键增量拉取，发现不了被修改的行，
+# 每隔该时间（秒）改为全量比对一次以发现修改；设为 0 时每次都全量比对
+INDEX_FULL_DIFF_INTERVAL = float(os.getenv("INDEX_FULL_DIFF_INTERVAL", 600))
+
+
 class VectorIndexBuilder:
     def __init__(self, db_client: DBClient):
         self.db = db_client
 
-        # DEFAULT_MODEL_PATH = r"F:\Downloads\modelscope\models\sentence-transformers\all-MiniLM-L6-v2"
-        DEFAULT_MODEL_PATH = r"/DB_Duplication_Check/sentence-transformers/all-MiniLM-L6-v2"
-        LOCAL_MODEL_PATH = os.getenv("LOCAL_MODEL_PATH", DEFAULT_MODEL_PATH)
-        self.model = SentenceTransformer(LOCAL_MODEL_PATH)
+        # 进程内共享的带缓存向量模型，重建索引时只对没见过的文本调用模型
+        self.model = get_embedding_model()
         self.index_dir = "vector_indexes"
+        # 各表 text 列的缓存，逐行应用变更时避免反复查询 information_schema
+        self._text_columns: Dict[str, List[str]] = {}
+        # 各表最近一次返回给调用方时索引文件的状态，用于判断文件是否被其他进程改写过
+        self._loaded_state: Dict[str, Optional[Tuple[int, int]]] = {}
+        # 每次保存索引文件后加一，只读加载索引的进程据此判断是否需要重新加载
+        self.generation_file = os.path.join(self.index_dir, "index_generation")
+        # 最近一次读取或写入的索引代数，请求路径据此组成缓存键，不必每次读取文件
+        self._generation: Optional[int] = None
         
         # 创建索引存储目录
         if not os.path.exists(self.index_dir):
@@ -32,201 +51,419 @@ class VectorIndexBuilder:
         
         print("所有向量索引构建完成并已保存到磁盘")
 
-    def _build_table_index(self, table: str):
+    def _build_table_index(self, table: str) -> Tuple[faiss.Index, Records]:
         """为单个表构建向量索引"""
+        # 先记下水位再拉取全表，拉取期间的变更会在下次增量更新时再次拉到
+        watermark = self.db.get_max_watermark(table)
         # 获取表的所有记录
-        records = self.db.get_all_records(table)
+        pk = TABLE_PK_MAP[table]
+        records: Records = {int(record[pk]): record for record in self.db.get_all_records(table)}
         if not records:
-            print(f"表 {table} 没有记录，跳过")
-            return
-
-        # 收集所有文本内容用于向量化
-        texts = []
-        for record in records:
-            # 将记录的所有文本字段合并为一个文本
-            text_fields = [str(record[col]) for col in record.keys() if col != TABLE_PK_MAP[table] and record[col]]
-            combined_text = ' '.join(text_fields)
-            texts.append(combined_text)
-
-        # 向量化所有文本
-        print(f"正在向量化 {len(texts)} 条记录...")
-        embeddings = self.model.encode(texts)
-        
-        # 创建FAISS索引
-        dimension = embeddings.shape[1]
-        index = faiss.IndexFlatIP(dimension)  # 使用内积相似度
-        faiss.normalize_L2(embeddings)  # 归一化向量以获得更好的相似度计算
-        index.add(embeddings.astype(np.float32))
-        
-        # 保存索引到磁盘
-        index_file = os.path.join(self.index_dir, f"{table}_index.faiss")
-        faiss.write_index(index, index_file)
+            print(f"表 {table} 没有记录，写入空索引")
+
+        # 按记录数选择索引类型并创建FAISS索引，向量ID即表主键
+        index = self.build_index(table, records)
         
-        # 保存记录数据到磁盘
-        records_file = os.path.join(self.index_dir, f"{table}_records.pkl")
-        with open(records_file, 'wb') as f:
-            pickle.dump(records, f)
+        # 保存索引和记录数据到磁盘
+        index_file, records_file = self.save_index(table, index, records)
+        self.save_meta(table, {"watermark_column": get_watermark_column(table), "watermark": watermark,
+                               "watermark_rows": self._watermark_rows(table, watermark, records),
+                               "count": len(records), "full_diff_at": time.time()})
+        # 换成刚写出的列式存储，不再持有整表的记录字典
+        records = RecordStore.open(records_file)
         
-        print(f"表 {table} 的索引已保存: {index_file}")
+        print(f"表 {table} 的索引（{ann_index.index_type_of(index)}）已保存: {index_file}")
         print(f"表 {table} 的记录已保存: {records_file}")
+        return index, records
+
+    @staticmethod
+    def combine_text(table: str, record: Dict[str, Any]) -> str:
+        """将记录的所有非主键文本字段拼接为一个文本，作为该记录的向量化输入"""
+        text_fields = [str(record[col]) for col in record.keys() if col != TABLE_PK_MAP[table] and record[col]]
+        return ' '.join(text_fields)
+
+    def get_text_columns(self, table: str) -> List[str]:
+        """获取（并缓存）表的 text 列"""
+        if table not in self._text_columns:
+            self._text_columns[table] = self.db.get_text_columns(table)
+        return self._text_columns[table]
+
+    def new_index(self) -> faiss.Index:
+        """创建一个空的精确向量索引，向量ID为表主键；记录数增长后由压缩流程升级为近似索引"""
+        dim = self.model.get_sentence_embedding_dimension()
+        return ann_index.create_index(ann_index.default_params("flat", 0, dim))
+
+    def build_index(self, table: str, records: Records) -> faiss.Index:
+        """
+        用全部记录构建向量索引：按记录数（或 VECTOR_INDEX_TYPE）选择索引类型，
+        IVF 类索引用本次的向量抽样训练，所有文本合并为一次 encode
+        """
+        if not records:
+            return self.new_index()
+        ids = np.fromiter(records.keys(), dtype=np.int64, count=len(records))
+        embeddings = self.model.encode([self.combine_text(table, r) for r in records.values()])
+        faiss.normalize_L2(embeddings)
+        return ann_index.build_index(embeddings, ids)
+
+    def to_index_record(self, table: str, row: Dict[str, Any]) -> Dict[str, Any]:
+        """将一整行数据裁剪为索引记录（主键 + text 列），与 get_all_records 返回的格式一致"""
+        pk = TABLE_PK_MAP[table]
+        record = {pk: row.get(pk)}
+        for col in self.get_text_columns(table):
+            record[col] = row.get(col)
+        return record
+
+    def upsert_record(self, table: str, index: faiss.Index, records: Records, record: Dict[str, Any]) -> bool:
+        """单行插入或更新，只向量化这一行，返回索引是否发生了变化"""
+        return self.upsert_records(table, index, records, [record]) > 0
+
+    def upsert_records(self, table: str, index: faiss.Index, records: Records,
+                       changed_records: List[Dict[str, Any]]) -> int:
+        """
+        批量插入或更新，只向量化文本确实发生变化的行（一次 encode）
+
+        先按主键移除旧向量（包括已删除但尚未压缩掉的向量），再以主键为ID写入新向量；
+        HNSW 索引不支持删除，旧向量保留到下次压缩重建，检索时同一主键只取一次。
+        返回实际写入索引的行数
+        """
+        pk = TABLE_PK_MAP[table]
+        to_write: Records = {}
+        for record in changed_records:
+            key = int(record[pk])
+            if records.get(key) == record:
+                continue  # text 列没有变化（例如只改了其他列），无需重新向量化
+            to_write[key] = record  # 同一主键多次变更只保留最后一次
+        if not to_write:
+            return 0
+
+        ids = np.fromiter(to_write.keys(), dtype=np.int64, count=len(to_write))
+        embeddings = self.model.encode([self.combine_text(table, r) for r in to_write.values()])
+        faiss.normalize_L2(embeddings)
+        if index.ntotal and ann_index.supports_remove(index):
+            index.remove_ids(ids)
+        index.add_with_ids(embeddings.astype(np.float32), ids)
+        records.update(to_write)
+        return len(to_write)
+
+    @staticmethod
+    def delete_record(table: str, records: Records, pk_value: Any) -> bool:
+        """
+        单行删除：只移除记录，检索时会跳过没有记录的向量ID，
+        向量本身由后台压缩（compact_index）批量移除。返回是否有记录被删除
+        """
+        return records.pop(int(pk_value), None) is not None
+
+    @staticmethod
+    def orphan_count(index: faiss.Index, records: Records) -> int:
+        """索引中已删除但尚未压缩掉的向量数量"""
+        return max(index.ntotal - len(records), 0)
+
+    def compact_index(self, table: str, index: faiss.Index, records: Records) -> faiss.Index:
+        """
+        压缩索引：在副本上移除已删除记录的向量并落盘，返回新索引
+        原索引不做修改，正在使用它的检索不受影响。
+        HNSW 不支持删除、或记录数已达到更大规模索引类型的阈值时，按当前记录重建索引
+        """
+        if not ann_index.supports_remove(index) or ann_index.upgrade_needed(index, len(records)):
+            # 重建时文本向量基本都能从向量缓存中取到
+            compacted = self.build_index(table, dict(records))
+            print(f"表 {table} 的索引已重建为 {ann_index.index_type_of(compacted)}，共 {compacted.ntotal} 个向量")
+        else:
+            ids = ann_index.index_ids(index)
+            orphan_ids = ids[~np.isin(ids, np.fromiter(records.keys(), dtype=np.int64, count=len(records)))]
+            compacted = faiss.clone_index(index)
+            ann_index.configure(compacted, ann_index.params_of(index))
+            if len(orphan_ids):
+                compacted.remove_ids(orphan_ids)
+            print(f"表 {table} 的索引已压缩，移除 {len(orphan_ids)} 个已删除向量")
+        self.save_index(table, compacted, records)
+        self._loaded_state[table] = self._file_state(table)
+        return compacted
+
+    def save_index(self, table: str, index: faiss.Index, records: Records) -> Tuple[str, str]:
+        """
+        原子地保存索引和记录文件：先写临时文件再 os.replace，
+        保证其他进程/线程读取时不会看到写了一半的文件。
+        索引类型和检索参数同时写入元数据，加载时据此恢复
+        """
+        index_file = os.path.join(self.index_dir, f"{table}_index.faiss")
+        records_file = self.records_file(table)
+        tmp_suffix = f".tmp{os.getpid()}"
+
+        faiss.write_index(index, index_file + tmp_suffix)
+        RecordStore.write(records_file, TABLE_PK_MAP[table], records.values())
+        os.replace(index_file + tmp_suffix, index_file)
+        self.save_meta(table, {"index": ann_index.params_of(index)})
+        self._bump_generation()
+        return index_file, records_file
+
+    def records_file(self, table: str) -> str:
+        """列式记录文件路径"""
+        return os.path.join(self.index_dir, f"{table}_records.dat")
+
+    def read_generation(self) -> int:
+        """索引文件的代数，没有保存过时为 0"""
+        try:
+            with open(self.generation_file, 'r', encoding='utf-8') as f:
+                self._generation = int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            self._generation = 0
+        return self._generation
+
+    def known_generation(self) -> int:
+        """
+        最近一次读取或写入的索引代数，不访问文件：写进程落盘时更新，
+        只读进程由 IndexRefresher.reload 定期读取更新
+        """
+        if self._generation is None:
+            return self.read_generation()
+        return self._generation
+
+    def _bump_generation(self):
+        tmp_file = f"{self.generation_file}.tmp{os.getpid()}"
+        generation = self.read_generation() + 1
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write(str(generation))
+        os.replace(tmp_file, self.generation_file)
+        self._generation = generation
+
+    def load_index(self, table: str, mmap: bool = False) -> Tuple[faiss.Index, Records]:
+        """
+        从磁盘加载索引和记录
+        旧版本的 pickle 记录文件会被转换为列式记录文件；其中按下标对齐的 IndexFlatIP + 记录列表（含墓碑行）
+        同时转换为以主键为ID的索引，向量直接从旧索引中取出，无需重新向量化
+
+        Args:
+            mmap: 以只读内存映射方式打开索引和记录（不负责写索引的进程使用），返回的索引不能修改
+        """
+        index_file = os.path.join(self.index_dir, f"{table}_index.faiss")
+        records_file = self.records_file(table)
+        index = ann_index.read_index(index_file, mmap=mmap)
+        if os.path.exists(records_file):
+            records = RecordStore.open(records_file, mmap=mmap)
+        else:
+            if mmap:
+                raise RuntimeError(f"表 {table} 的记录为旧格式，需由负责写索引的进程转换后再加载")
+            index, records = self._convert_legacy(table, index)
+
+        # 按元数据恢复检索参数（nprobe / efSearch），修改元数据即可调整而无需重建
+        params = self.load_meta(table).get("index")
+        if params:
+            if params.get("type") != ann_index.index_type_of(index):
+                print(f"表 {table} 的索引元数据类型 {params.get('type')} 与索引文件不一致，使用索引文件中的参数")
+            else:
+                ann_index.configure(index, params)
+        return index, records
+
+    def _convert_legacy(self, table: str, index: faiss.Index) -> Tuple[faiss.Index, Records]:
+        """把旧版本的 {table}_records.pkl 转换为列式记录文件，转换后删除 pickle 文件"""
+        legacy_file = os.path.join(self.index_dir, f"{table}_records.pkl")
+        with open(legacy_file, 'rb') as f:
+            records = pickle.load(f)
+
+        if isinstance(records, list):
+            print(f"表 {table} 的索引为旧格式，转换为按主键映射的索引...")
+            pk = TABLE_PK_MAP[table]
+            live = [(i, r) for i, r in enumerate(records) if not r.get("__deleted__") and i < index.ntotal]
+            vectors = index.reconstruct_n(0, index.ntotal)
+            records = {int(r[pk]): r for _, r in live}
+            index = faiss.IndexIDMap2(faiss.IndexFlatIP(index.d))
+            if live:
+                index.add_with_ids(vectors[[i for i, _ in live]],
+                                   np.array([int(r[pk]) for _, r in live], dtype=np.int64))
+        else:
+            print(f"表 {table} 的记录为 pickle 格式，转换为列式记录文件...")
+
+        _, records_file = self.save_index(table, index, records)
+        os.remove(legacy_file)
+        return index, RecordStore.open(records_file)
+
+    def load_meta(self, table: str) -> Dict[str, Any]:
+        """读取与索引文件一起保存的元数据（水位等）"""
+        meta_file = os.path.join(self.index_dir, f"{table}_meta.json")
+        if not os.path.exists(meta_file):
+            return {}
+        try:
+            with open(meta_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"读取表 {table} 的索引元数据失败: {e}")
+            return {}
+
+    def save_meta(self, table: str, meta: Dict[str, Any]):
+        """原子地保存索引元数据（与已有字段合并），日期等类型的水位按字符串保存"""
+        meta = {**self.load_meta(table), **meta}
+        meta_file = os.path.join(self.index_dir, f"{table}_meta.json")
+        tmp_file = f"{meta_file}.tmp{os.getpid()}"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, default=str)
+        os.replace(tmp_file, meta_file)
+
+    def reload_changed_indexes(self) -> Dict[str, Tuple[faiss.Index, Records]]:
+        """只读（mmap）加载索引文件自上次加载以来有变化的表，供不负责写索引的进程使用"""
+        updated: Dict[str, Tuple[faiss.Index, Records]] = {}
+        for table in TABLE_PK_MAP.keys():
+            state = self._file_state(table)
+            if state is None or state == self._loaded_state.get(table):
+                continue
+            try:
+                updated[table] = self.load_index(table, mmap=True)
+                self._loaded_state[table] = state
+            except Exception as e:
+                print(f"只读加载表 {table} 的索引失败: {e}")
+        return updated
 
-    def update_index_incremental(self, table: str, new_records: list = None) -> Optional[Tuple[faiss.Index, List[Dict[str, Any]]]]:
+    def _file_state(self, table: str) -> Optional[Tuple[int, int]]:
+        """索引文件与元数据文件的修改时间"""
+        try:
+            return (os.stat(os.path.join(self.index_dir, f"{table}_index.faiss")).st_mtime_ns,
+                    os.stat(os.path.join(self.index_dir, f"{table}_meta.json")).st_mtime_ns)
+        except OSError:
+            return None
+
+    def _watermark_rows(self, table: str, watermark: Any, records: Mapping[int, Mapping[str, Any]]) -> Dict[str, str]:
         """
-        增量更新指定表的向量索引
+        全量拉取后处于水位上的行的摘要（见 _fetch_changes），只记下与本次应用的内容一致的行；
+        拉取期间有新的变更时返回空，这些行留给下次增量拉取
+        """
+        if WATERMARK_COLUMN is None or watermark is None:
+            return {}
+        rows, new_watermark, _ = self.db.get_records_since(table, watermark)
+        if new_watermark != watermark:
+            return {}
+        pk = TABLE_PK_MAP[table]
+        return {str(row[pk]): _row_digest(row) for row in rows if records.get(int(row[pk])) == row}
+
+    def _fetch_changes(self, table: str) -> Optional[Tuple[Dict[str, Any], List[Dict[str, Any]], set]]:
+        """
+        按水位拉取变更：返回 (元数据, 变更记录, 当前全部主键)
+        元数据中没有可用水位（首次运行或更换了水位列）、或按主键拉取且已到全量比对时间时返回 None
+
+        按更新时间列拉取时每次都会重新拉到处于水位上的行，元数据的 watermark_rows 记下这些行已应用文本的摘要，
+        文本没有变化的行在这里去掉，没有真正的变更时调用方才能跳过读取索引文件
+        """
+        meta = self.load_meta(table)
+        if meta.get("watermark_column") != get_watermark_column(table):
+            return None
+        if meta.get("watermark") is None:
+            # 空表没有水位：表仍为空时无需全量比对，出现记录后全量比对一次即可取得水位
+            if meta.get("count") == 0 and self.db.get_max_watermark(table) is None:
+                return meta, [], set()
+            return None
+        if WATERMARK_COLUMN is None and time.time() - meta.get("full_diff_at", 0) >= INDEX_FULL_DIFF_INTERVAL:
+            # 按主键拉取只能发现新增和删除，定期全量比对一次以发现被修改的行
+            return None
+        rows, watermark, boundary_pks = self.db.get_records_since(table, meta["watermark"])
+        live_pks = self.db.get_all_pks(table)
+
+        pk = TABLE_PK_MAP[table]
+        applied = meta.get("watermark_rows") or {}
+        digests = {str(row[pk]): _row_digest(row) for row in rows}
+        changed = [row for row in rows if applied.get(str(row[pk])) != digests[str(row[pk])]]
+        watermark_rows = {key: digests[key] for key in boundary_pks if key in live_pks}
+        return {**meta, "watermark": watermark, "watermark_rows": watermark_rows}, changed, live_pks
+
+    def update_index_incremental(self, table: str, new_records: list = None,
+                                 skip_unchanged: bool = False) -> Optional[Tuple[faiss.Index, Records]]:
+        """
+        增量更新指定表的向量索引：新增和修改的行只向量化该行并按主键替换向量，删除的行移除记录
         
         Args:
             table: 表名
-            new_records: 新记录列表，如果为None则从数据库获取所有记录并重建索引
+            new_records: 表的全部记录列表，提供时与现有记录逐条比对；
+                         为None时按水位只拉取变更的记录和主键集合
+            skip_unchanged: 为True时若按水位未发现任何变更，直接返回None，不读取索引文件
         """
         print(f"开始增量更新表 {table} 的向量索引...")
         
         # 索引和记录文件路径
         index_file = os.path.join(self.index_dir, f"{table}_index.faiss")
-        records_file = os.path.join(self.index_dir, f"{table}_records.pkl")
-        
+        records_file = self.records_file(table)
+        legacy_file = os.path.join(self.index_dir, f"{table}_records.pkl")
+
         # 如果索引文件不存在，则构建完整索引
-        if not os.path.exists(index_file) or not os.path.exists(records_file):
+        if not os.path.exists(index_file) or not (os.path.exists(records_file) or os.path.exists(legacy_file)):
             print(f"索引文件不存在，构建完整索引...")
-            self._build_table_index(table)
-            index = faiss.read_index(index_file)
-            with open(records_file, 'rb') as f:
-                records = pickle.load(f)
-            return index, records
+            return self._build_table_index(table)
+
+        meta, changed, live_pks = None, None, None
+        if new_records is None:
+            delta = self._fetch_changes(table)
+            if delta is not None:
+                meta, changed, live_pks = delta
+                if skip_unchanged and not changed and len(live_pks) == meta.get("count"):
+                    # 没有新增/修改，主键数也没变，说明也没有删除
+                    print("水位之后没有变更，跳过更新")
+                    return None
         
         # 加载现有索引和记录
         try:
-            index = faiss.read_index(index_file)
-            with open(records_file, 'rb') as f:
-                existing_records = pickle.load(f)
+            index, records = self.load_index(table)
         except Exception as e:
             print(f"加载现有索引失败: {e}，重新构建完整索引...")
-            self._build_table_index(table)
-            index = faiss.read_index(index_file)
-            with open(records_file, 'rb') as f:
-                records = pickle.load(f)
-            return index, records
-        
-        # 如果没有提供新记录，则从数据库获取所有记录（相当于重建索引）
-        if new_records is None:
-            print("未提供新记录，获取数据库中的所有记录...")
-            new_records = self.db.get_all_records(table)
-            
-            # 检查是否需要更新（简单的记录数比较）
-            if len(existing_records) == len(new_records):
-                print("记录数未发生变化，跳过更新")
-        
-        # 确定需要添加的新记录
-        existing_ids = {record[TABLE_PK_MAP[table]] for record in existing_records}
-        records_to_add = [
-            record for record in new_records 
-            if record[TABLE_PK_MAP[table]] not in existing_ids
-        ]
-        
-        if not records_to_add:
-            print("没有需要添加的新记录")
-        else:
-            print(f"发现 {len(records_to_add)} 条新记录需要添加")
-            
-        print(f"发现 {len(records_to_add)} 条新记录需要添加")
-        
-        # 准备新记录的文本内容
-        texts = []
-        for record in records_to_add:
-            text_fields = [str(record[col]) for col in record.keys() if col != TABLE_PK_MAP[table] and record[col]]
-            combined_text = ' '.join(text_fields)
-            texts.append(combined_text)
-        
-        if not texts:
-            print("没有有效的文本内容需要向量化")
-        else:
-            # 向量化新记录
-            print(f"正在向量化 {len(texts)} 条新记录...")
-            new_embeddings = self.model.encode(texts)
-            faiss.normalize_L2(new_embeddings)
+            return self._build_table_index(table)
 
-            # 添加到现有索引
-            index.add(new_embeddings.astype(np.float32))
+        if meta is None:
+            pk = TABLE_PK_MAP[table]
+            if new_records is None:
+                # 没有可用水位或需要定期全量比对：先记下水位，再全量比对一次，之后即可按水位增量拉取
+                print("全量比对，获取数据库中的所有记录...")
+                watermark = self.db.get_max_watermark(table)
+                new_records = self.db.get_all_records(table)
+                meta = {"watermark_column": get_watermark_column(table), "watermark": watermark,
+                        "watermark_rows": self._watermark_rows(table, watermark, {int(r[pk]): r for r in new_records}),
+                        "full_diff_at": time.time()}
+            changed = new_records
+            live_pks = {str(r[pk]) for r in new_records}
 
-            # 更新记录列表
-            existing_records.extend(records_to_add)
+        # 新增和修改：只向量化文本发生变化的行
+        written = self.upsert_records(table, index, records, changed)
+        # 删除：只移除记录，向量由后台压缩
+        deleted = [key for key in records if str(key) not in live_pks]
+        for key in deleted:
+            self.delete_record(table, records, key)
+        print(f"发现 {len(changed)} 条候选变更（重新向量化 {written} 条），删除 {len(deleted)} 条")
 
-        pk = TABLE_PK_MAP[table]
-        new_ids = {str(r[pk]) for r in (new_records or [])}
-
-        # 修改检测：主键相同但文本不同
-        modified = False
-        new_map = {str(r[pk]): r for r in (new_records or [])}
-        for i, r in enumerate(existing_records):
-            rid = r.get(pk) if isinstance(r, dict) else None
-            if rid is None:
-                continue
-            if str(rid) not in new_ids:
-                # 占位为“墓碑行”，保留主键，增加 __deleted__ 标记，不能删除元素因为要保持下标对齐
-                existing_records[i] = {pk: rid, "__deleted__": True}  # 标记删除：只改 records，不改 FAISS
-                continue
-            new_r = new_map.get(str(rid))
-            old_data = {k: v for k, v in r.items() if k != pk}
-            new_data = {k: v for k, v in new_r.items() if k != pk}
-            if old_data != new_data:
-                modified = True
-                break
-        print("【modified:", modified)
-
-        # # 另存为 JSON
-        # existing_json_file = os.path.join(self.index_dir, f"{table}_records_existing.json")
-        # new_json_file = os.path.join(self.index_dir, f"{table}_records_new.json")
-        # try:
-        #     with open(existing_json_file, 'w', encoding='utf-8') as f:
-        #         json.dump(existing_records, f, ensure_ascii=False, indent=2, default=str)
-        #     with open(new_json_file, 'w', encoding='utf-8') as f:
-        #         json.dump(new_records or [], f, ensure_ascii=False, indent=2, default=str)
-        #     print(f"已导出现有记录到: {existing_json_file}")
-        #     print(f"已导出新记录到: {new_json_file}")
-        # except Exception as e:
-        #     print(f"导出 JSON 失败: {e}")
-
-        if modified:
-            texts = []
-            existing_records = new_records
-            for record in existing_records:
-                # 保持你原有的“拼接所有非主键字段”的规则，不改动字段选择逻辑
-                text_fields = [str(record[col]) for col in record.keys() if col != pk and record[col]]
-                combined_text = ' '.join(text_fields)
-                texts.append(combined_text)
-
-            if texts:
-                print(f"检测到文本改动，准备全量向量化 {len(texts)} 条记录并重建索引...")
-                new_embeddings = self.model.encode(texts)
-                faiss.normalize_L2(new_embeddings)
-                dim = new_embeddings.shape[1]
-                index = faiss.IndexFlatIP(dim)
-                index.add(new_embeddings.astype(np.float32))
-            else:
-                print("存活记录为空，写入空索引...")
-                dim = self.model.get_sentence_embedding_dimension()
-                index = faiss.IndexFlatIP(dim)
-        
         # 保存更新后的索引和记录
-        faiss.write_index(index, index_file)
-        with open(records_file, 'wb') as f:
-            pickle.dump(existing_records, f)
+        if written or deleted:
+            self.save_index(table, index, records)
+        if meta is not None:
+            self.save_meta(table, {**meta, "count": len(records)})
             
-        print(f"表 {table} 的索引已更新，当前共有 {len(existing_records)} 条记录")
-        return index, existing_records
+        print(f"表 {table} 的索引已更新，当前共有 {len(records)} 条记录")
+        return index, records
 
-    def update_all_indexes_incremental(self) -> Dict[str, Tuple[faiss.Index, List[Dict[str, Any]]]]:
-        """增量更新所有表的向量索引"""
+    def update_all_indexes_incremental(self, skip_unchanged: Iterable[str] = ()) -> Dict[str, Tuple[faiss.Index, Records]]:
+        """
+        增量更新所有表的向量索引
+
+        Args:
+            skip_unchanged: 调用方已持有最新索引的表，这些表没有变更时不出现在返回结果中
+        """
         print("开始增量更新所有表的向量索引...")
-        updated: Dict[str, Tuple[faiss.Index, List[Dict[str, Any]]]] = {}
+        skip_unchanged = set(skip_unchanged)
+        updated: Dict[str, Tuple[faiss.Index, Records]] = {}
         for table in TABLE_PK_MAP.keys():
             print(f"正在处理表: {table}")
-            # 获取当前表的所有记录用于增量更新
-            current_records = self.db.get_all_records(table)
-            updated[table] = self.update_index_incremental(table, current_records)
+            try:
+                # 按水位只拉取变更的记录；索引文件被其他进程改写过时需要重新加载
+                skip = table in skip_unchanged and self._loaded_state.get(table) == self._file_state(table)
+                pair = self.update_index_incremental(table, skip_unchanged=skip)
+                if pair is not None:
+                    updated[table] = pair
+                    self._loaded_state[table] = self._file_state(table)
+            except Exception as e:
+                # 单表失败不影响其他表，调用方继续使用该表的旧索引
+                print(f"表 {table} 的索引增量更新失败: {e}")
         print("所有表的向量索引增量更新完成")
         return updated
 
 
+def _row_digest(row: Mapping[str, Any]) -> str:
+    """记录内容（主键 + text 列）的摘要，用于判断重复拉到的行是否已经应用过"""
+    return hashlib.sha1(json.dumps(row, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+
 def main():
     """主函数，用于构建所有表的向量索引"""
     from dotenv import load_dotenv